@@ -0,0 +1,100 @@
+"""
+Measures the cost of the self time and critical path analysis of
+finished request traces, for traces of increasing size. The time per
+span should stay flat, and the fitted exponent of the total time
+close to 1 (linear).
+
+    $ python benchmarks/bench_analysis.py [--runs 5] [--max-spans 100000]
+"""
+import argparse
+import math
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from pyramid_opentracing._request_tracer import SpanRecord  # noqa
+from pyramid_opentracing.analysis import summary_tags  # noqa
+
+
+_perf_counter = getattr(time, 'perf_counter', time.time)
+
+
+def make_trace(size, seed=0):
+    """
+    Returns the SpanRecords of a trace shaped like a busy view: a root
+    span with many (partly overlapping) children, some of them with a
+    few children of their own.
+    """
+    rnd = random.Random(seed)
+    root = SpanRecord('view')
+    root.start, root.duration, root.index = 0.0, float(size), 0
+    records = [root]
+
+    cursor = 0.0
+    while len(records) < size:
+        child = SpanRecord('child%d' % rnd.randint(0, 20), root)
+        child.start = cursor
+        child.duration = rnd.uniform(0.5, 2.0)
+        child.index = len(records)
+        records.append(child)
+        cursor += rnd.uniform(0.2, 1.0)
+
+        for _ in range(rnd.randint(0, 3)):
+            if len(records) >= size:
+                break
+            grandchild = SpanRecord('query', child)
+            grandchild.start = child.start + rnd.uniform(0.0, 0.2)
+            grandchild.duration = rnd.uniform(0.05, 0.3)
+            grandchild.index = len(records)
+            records.append(grandchild)
+
+    root.duration = cursor + 2.0
+    return records
+
+
+def run(size, runs):
+    records = make_trace(size)
+    timings = []
+    for _ in range(runs):
+        start = _perf_counter()
+        summary_tags(records)
+        timings.append(_perf_counter() - start)
+
+    return min(timings)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip())
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--max-spans', type=int, default=100000)
+    args = parser.parse_args()
+
+    sizes = []
+    size = 100
+    while size <= args.max_spans:
+        sizes.append(size)
+        size *= 10
+
+    print('%10s %12s %14s' % ('spans', 'total (ms)', 'per span (us)'))
+    results = []
+    for size in sizes:
+        elapsed = run(size, args.runs)
+        results.append((size, elapsed))
+        print('%10d %12.2f %14.3f' % (size, elapsed * 1e3,
+                                      elapsed / size * 1e6))
+
+    # least squares slope of log(time) over log(size).
+    xs = [math.log(size) for size, _ in results]
+    ys = [math.log(elapsed) for _, elapsed in results]
+    mean_x = sum(xs) / len(xs)
+    mean_y = sum(ys) / len(ys)
+    slope = (sum((x - mean_x) * (y - mean_y) for x, y in zip(xs, ys)) /
+             sum((x - mean_x) ** 2 for x in xs))
+    print('growth exponent: %.2f' % slope)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,68 @@
+"""
+Measures the cold start cost of pyramid_opentracing: importing the
+package, resolving its public names, and building an application that
+includes the tween. Each step runs in a fresh interpreter, and is reported
+on top of the interpreter start-up time.
+
+    $ python benchmarks/bench_startup.py [--runs 20]
+"""
+import argparse
+import os
+import subprocess
+import sys
+import time
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+STEPS = [
+    ('interpreter', 'pass'),
+    ('import package', 'import pyramid_opentracing'),
+    ('resolve PyramidTracing',
+     'import pyramid_opentracing; pyramid_opentracing.PyramidTracing'),
+    ('build app', """
+from pyramid.config import Configurator
+config = Configurator(settings={
+    'ot.tracer_callable': 'opentracing.mocktracer.MockTracer',
+})
+config.include('pyramid_opentracing')
+config.make_wsgi_app()
+"""),
+]
+
+
+def run_step(code, runs):
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join(filter(None, [
+        ROOT, env.get('PYTHONPATH')
+    ]))
+
+    timings = []
+    for _ in range(runs):
+        start = time.time()
+        subprocess.check_call([sys.executable, '-c', code], env=env)
+        timings.append(time.time() - start)
+
+    timings.sort()
+    return timings[len(timings) // 2], timings[0]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip())
+    parser.add_argument('--runs', type=int, default=20)
+    args = parser.parse_args()
+
+    print('%-24s %12s %12s' % ('step', 'median (ms)', 'min (ms)'))
+    baseline = None
+    for name, code in STEPS:
+        median, best = run_step(code, args.runs)
+        if baseline is None:
+            baseline = median
+            print('%-24s %12.1f %12.1f' % (name, median * 1e3, best * 1e3))
+        else:
+            print('%-24s %12.1f %12.1f' % (name, (median - baseline) * 1e3,
+                                           (best - baseline) * 1e3))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,351 @@
+"""
+Drives concurrent HTTP load through an application instrumented with
+the tween, reporting its spans to a local stand-in collector over UDP,
+and reports throughput, latency percentiles, span drop rate and the
+collector-side ingestion rate for each tracing configuration.
+
+    $ python benchmarks/load_harness.py [--duration 10] [--clients 16]
+        [--threads 8] [--config traced] ...
+
+The application mirrors example/tween-example, served by waitress if
+installed, or by a multi-threaded wsgiref server otherwise.
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import socket
+import sys
+import threading
+import time
+
+try:
+    from http.client import HTTPConnection
+    from queue import Full, Queue
+    from socketserver import ThreadingMixIn
+except ImportError:  # Python 2.
+    from httplib import HTTPConnection
+    from Queue import Full, Queue
+    from SocketServer import ThreadingMixIn
+
+from wsgiref.simple_server import WSGIRequestHandler, WSGIServer, make_server
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from opentracing.mocktracer import MockTracer  # noqa
+from pyramid.config import Configurator  # noqa
+from pyramid.view import view_config  # noqa
+
+import pyramid_opentracing  # noqa
+
+
+PATHS = ['/', '/simple', '/log']
+
+CONFIGS = {
+    'untraced': {
+        'ot.trace_all': 'false',
+    },
+    'traced': {},
+    'traced_attributes': {
+        'ot.traced_attributes': 'host method path',
+    },
+    'limits_compact_errors': {
+        'ot.max_child_spans': '100',
+        'ot.max_span_logs': '10',
+        'ot.error_mode': 'compact',
+    },
+    'resource_usage': {
+        'ot.resource_usage': 'true',
+    },
+    'exemplars': {
+        'ot.exemplars': 'true',
+    },
+}
+
+
+# Collector
+
+def run_collector(port_conn, stats_conn):
+    """
+    Counts the spans received over UDP until told to stop,
+    then sends back (spans, bytes, first_time, last_time).
+    """
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4 * 1024 * 1024)
+    sock.bind(('127.0.0.1', 0))
+    sock.settimeout(0.1)
+    port_conn.send(sock.getsockname()[1])
+
+    spans = nbytes = 0
+    first = last = None
+    while not stats_conn.poll():
+        try:
+            data = sock.recv(65536)
+        except socket.timeout:
+            continue
+
+        now = time.time()
+        first = first or now
+        last = now
+        spans += 1
+        nbytes += len(data)
+
+    stats_conn.recv()
+    stats_conn.send((spans, nbytes, first, last))
+
+
+class Collector(object):
+    def __init__(self):
+        self._port_parent, port_child = multiprocessing.Pipe()
+        self._stats_parent, stats_child = multiprocessing.Pipe()
+        self._process = multiprocessing.Process(
+            target=run_collector, args=(port_child, stats_child))
+
+    def start(self):
+        self._process.start()
+        self.port = self._port_parent.recv()
+
+    def stop(self):
+        self._stats_parent.send('stop')
+        result = self._stats_parent.recv()
+        self._process.join()
+        return result
+
+
+# Reporting tracer
+
+class UDPReportingTracer(MockTracer):
+    """
+    MockTracer reporting its finished spans as JSON datagrams from a
+    background thread, through a bounded queue, like real reporters do.
+    Spans that do not fit in the queue are dropped.
+    """
+    def __init__(self, port, queue_size=10000):
+        super(UDPReportingTracer, self).__init__()
+        self._address = ('127.0.0.1', port)
+        self._queue = Queue(queue_size)
+        self._sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.finished = 0
+        self.dropped = 0
+
+        self._thread = threading.Thread(target=self._send_spans)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _append_finished_span(self, span):
+        # called from every server thread, like MockTracer does.
+        with self._spans_lock:
+            self.finished += 1
+            try:
+                self._queue.put_nowait(span)
+            except Full:
+                self.dropped += 1
+
+    def _send_spans(self):
+        while True:
+            span = self._queue.get()
+            data = json.dumps({
+                'trace_id': span.context.trace_id,
+                'span_id': span.context.span_id,
+                'parent_id': span.parent_id,
+                'operation_name': span.operation_name,
+                'start_time': span.start_time,
+                'finish_time': span.finish_time,
+                'tags': dict((k, str(v)) for k, v in span.tags.items()),
+                'logs': len(span.logs),
+            })
+            try:
+                self._sock.sendto(data.encode('utf-8'), self._address)
+            except socket.error:
+                with self._spans_lock:
+                    self.dropped += 1
+            self._queue.task_done()
+
+    def flush(self):
+        self._queue.join()
+
+
+# Application
+
+@view_config(route_name='root', renderer='json')
+def server_index(request):
+    return {'message': 'Hello world!'}
+
+
+@view_config(route_name='simple', renderer='json')
+def server_simple(request):
+    tracing = request.registry.settings['ot.tracing']
+    with tracing.tracer.start_active_span('child'):
+        return {'message': 'This is a simple traced request.'}
+
+
+@view_config(route_name='log', renderer='json')
+def server_log(request):
+    span = request.registry.settings['ot.tracing'].get_span(request)
+    if span is not None:
+        span.log_kv({'event': 'Hello, World!'})
+    return {'message': 'Something was logged'}
+
+
+def make_app(tracer, settings):
+    settings = dict(settings)
+    settings['ot.tracing'] = pyramid_opentracing.PyramidTracing(tracer)
+
+    config = Configurator(settings=settings)
+    config.include('pyramid_opentracing')
+    config.add_route('root', '/')
+    config.add_route('simple', '/simple')
+    config.add_route('log', '/log')
+    config.scan(__name__)
+    return config.make_wsgi_app()
+
+
+class _QuietHandler(WSGIRequestHandler):
+    def log_message(self, *args):
+        pass
+
+
+class _ThreadingWSGIServer(ThreadingMixIn, WSGIServer):
+    daemon_threads = True
+    request_queue_size = 128
+
+
+def serve(app, threads):
+    """
+    Serves the app from a background thread, returning its port
+    and a function stopping it.
+    """
+    try:
+        from waitress.server import create_server
+    except ImportError:
+        server = make_server('127.0.0.1', 0, app,
+                             server_class=_ThreadingWSGIServer,
+                             handler_class=_QuietHandler)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+        def stop():
+            server.shutdown()
+            server.server_close()
+        return server.server_port, stop
+
+    server = create_server(app, host='127.0.0.1', port=0, threads=threads)
+    thread = threading.Thread(target=server.run)
+    thread.daemon = True
+    thread.start()
+    return server.effective_port, server.close
+
+
+# Load
+
+def run_client(port, deadline, latencies, errors):
+    i = 0
+    while time.time() < deadline:
+        path = PATHS[i % len(PATHS)]
+        i += 1
+
+        start = time.time()
+        try:
+            conn = HTTPConnection('127.0.0.1', port, timeout=10)
+            conn.request('GET', path)
+            response = conn.getresponse()
+            response.read()
+            conn.close()
+        except (socket.error, IOError):
+            errors.append(1)
+            continue
+
+        if response.status >= 500:
+            errors.append(1)
+
+        latencies.append(time.time() - start)
+
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+
+    return values[min(int(len(values) * pct / 100.0), len(values) - 1)]
+
+
+def run_config(name, settings, args):
+    collector = Collector()
+    collector.start()
+
+    tracer = UDPReportingTracer(collector.port)
+    port, stop_server = serve(make_app(tracer, settings), args.threads)
+
+    latencies = []
+    errors = []
+    start = time.time()
+    clients = [threading.Thread(target=run_client,
+                                args=(port, start + args.duration,
+                                      latencies, errors))
+               for _ in range(args.clients)]
+    for client in clients:
+        client.start()
+    for client in clients:
+        client.join()
+    elapsed = time.time() - start
+
+    stop_server()
+    tracer.flush()
+    time.sleep(0.5)  # Let the collector drain its socket.
+    received, nbytes, first, last = collector.stop()
+
+    latencies.sort()
+    dropped = max(tracer.finished - received, 0)
+    ingest_time = (last - first) if first and last and last > first else 0
+    return {
+        'config': name,
+        'requests': len(latencies),
+        'errors': len(errors),
+        'rps': len(latencies) / elapsed,
+        'p50_ms': percentile(latencies, 50) * 1e3,
+        'p95_ms': percentile(latencies, 95) * 1e3,
+        'p99_ms': percentile(latencies, 99) * 1e3,
+        'spans': tracer.finished,
+        'received': received,
+        'drop_rate': dropped / float(tracer.finished or 1),
+        'ingest_rate': received / ingest_time if ingest_time else 0.0,
+        'ingest_kbytes': nbytes / 1024.0,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip())
+    parser.add_argument('--duration', type=float, default=10.0,
+                        help='seconds of load per configuration')
+    parser.add_argument('--clients', type=int, default=16,
+                        help='concurrent clients')
+    parser.add_argument('--threads', type=int, default=8,
+                        help='server threads (waitress only)')
+    parser.add_argument('--config', action='append',
+                        choices=sorted(CONFIGS),
+                        help='configuration to run, defaults to all')
+    parser.add_argument('--json', action='store_true',
+                        help='print the results as JSON')
+    args = parser.parse_args()
+
+    results = [run_config(name, CONFIGS[name], args)
+               for name in (args.config or sorted(CONFIGS))]
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+
+    header = ('%-22s %9s %8s %8s %8s %7s %8s %8s %10s'
+              % ('config', 'req/s', 'p50 ms', 'p95 ms', 'p99 ms',
+                 'errors', 'spans', 'drop %', 'ingest/s'))
+    print(header)
+    print('-' * len(header))
+    for r in results:
+        print('%-22s %9.1f %8.2f %8.2f %8.2f %7d %8d %8.2f %10.1f'
+              % (r['config'], r['rps'], r['p50_ms'], r['p95_ms'],
+                 r['p99_ms'], r['errors'], r['spans'],
+                 r['drop_rate'] * 100, r['ingest_rate']))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,3 +1,39 @@
-from .tracing import PyramidTracing  # noqa
-from .tracing import PyramidTracing as PyramidTracer  # noqa, deprecated
-from .tween_factory import includeme, opentracing_tween_factory  # noqa
+import importlib
+import sys
+
+# Submodules are only imported when one of their names is first accessed,
+# so merely importing the package (e.g. from CLI scripts or pshell) does
+# not load pyramid or the tracer clients.
+_LAZY_ATTRS = {
+    'SpanLimits': '.limits',
+    'PyramidTracing': '.tracing',
+    'PyramidTracer': '.tracing',  # deprecated
+    'includeme': '.tween_factory',
+    'opentracing_tween_factory': '.tween_factory',
+}
+
+__all__ = sorted(_LAZY_ATTRS)
+
+
+def __getattr__(name):
+    module_name = _LAZY_ATTRS.get(name, None)
+    if module_name is None:
+        raise AttributeError('module %r has no attribute %r' %
+                             (__name__, name))
+
+    module = importlib.import_module(module_name, __name__)
+    value = getattr(module, 'PyramidTracing' if name == 'PyramidTracer'
+                    else name)
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(set(globals()) | set(__all__))
+
+
+if sys.version_info < (3, 7):  # No module-level __getattr__ (PEP 562).
+    from .limits import SpanLimits  # noqa
+    from .tracing import PyramidTracing  # noqa
+    from .tracing import PyramidTracing as PyramidTracer  # noqa, deprecated
+    from .tween_factory import includeme, opentracing_tween_factory  # noqa
@@ -1 +1,7 @@
 SCOPE_ATTR = '__scope'
+RESOURCE_ATTR = '__resource_usage'
+CLOCK_ATTR = '__clock'
+LOG_BUFFER_ATTR = '__log_buffer'
+CONFIG_ATTR = '__tracing_config'
+PHASES_ATTR = '__phases'
+OPERATION_ATTR = '__operation_name'
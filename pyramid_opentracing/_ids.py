@@ -0,0 +1,99 @@
+import numbers
+import weakref
+
+
+# Encoded (trace_id, span_id) per span, computed once.
+_span_ids = weakref.WeakKeyDictionary()
+
+
+def _encode_id(value):
+    if value is None:
+        return None
+
+    if isinstance(value, numbers.Integral):
+        return '%x' % value
+
+    return str(value)
+
+
+def span_ids(span):
+    """
+    Returns the (trace_id, span_id) of a span as strings, hex-encoded
+    if they are integers, or None for the ones the tracer does not expose.
+    """
+    try:
+        ids = _span_ids.get(span)
+    except TypeError:  # Not weak-referenceable.
+        ids = None
+
+    if ids is not None:
+        return ids
+
+    context = span.context
+    ids = (_encode_id(getattr(context, 'trace_id', None)),
+           _encode_id(getattr(context, 'span_id', None)))
+
+    try:
+        _span_ids[span] = ids
+    except TypeError:
+        pass
+
+    return ids
+
+
+def is_sampled(span):
+    """
+    Returns whether the tracer will report the span, assuming
+    it does if its context does not tell.
+    """
+    context = span.context
+    sampled = getattr(context, 'is_sampled', None)
+    if callable(sampled):
+        return bool(sampled())
+
+    sampled = getattr(context, 'sampled', True)
+    return bool(sampled)
+
+
+# Encoded W3C trace context per span, computed once.
+_traceresponses = weakref.WeakKeyDictionary()
+
+
+def _is_hex(value, length):
+    if value is None or len(value) > length:
+        return False
+
+    try:
+        int(value, 16)
+    except ValueError:
+        return False
+
+    return True
+
+
+def traceresponse(span):
+    """
+    Returns the W3C trace context of a span, as set in the
+    traceresponse header, or None if its ids are not hex-encoded
+    integers (or too long).
+    """
+    try:
+        value = _traceresponses.get(span)
+    except TypeError:  # Not weak-referenceable.
+        value = None
+
+    if value is not None:
+        return value
+
+    trace_id, span_id = span_ids(span)
+    if not _is_hex(trace_id, 32) or not _is_hex(span_id, 16):
+        return None
+
+    value = '00-%s-%s-%s' % (trace_id.zfill(32), span_id.zfill(16),
+                             '01' if is_sampled(span) else '00')
+    try:
+        _traceresponses[span] = value
+    except TypeError:
+        pass
+
+    return value
@@ -0,0 +1,455 @@
+import opentracing
+from opentracing.ext import tags
+
+from .analysis import summary_tags
+from .clock import Clock
+
+
+# the standard tags of the request span, not charged against
+# max_tag_bytes so they are never dropped.
+ROOT_TAGS = frozenset([
+    tags.COMPONENT,
+    tags.SPAN_KIND,
+    tags.HTTP_METHOD,
+    tags.HTTP_URL,
+    tags.HTTP_STATUS_CODE,
+    tags.ERROR,
+    'pyramid.route',
+    'pyramid.tracing_level',
+])
+
+
+class RequestState(object):
+    """
+    Bookkeeping shared by all the spans of a single traced request.
+    @param clock the RequestClock the spans take their timestamps from
+    @param baggage an optional BaggagePolicy the items set on the
+    spans have to comply with
+    """
+    def __init__(self, limits, track_calls=False, record_spans=False,
+                 summary_size=None, clock=None, baggage=None):
+        if clock is None:
+            clock = Clock().request_clock()
+
+        self.limits = limits
+        self.clock = clock
+        self.baggage = baggage
+        self.root = None
+        self.calls = [] if track_calls else None
+        self.records = [] if record_spans or summary_size else None
+        self.summary_size = summary_size
+        self.open_spans = set()
+        self.child_spans = 0
+        self.tag_bytes = 0
+        self.deadline = None
+        self.deadline_exceeded = False
+
+        self.dropped_spans = 0
+        self.dropped_logs = 0
+        self.dropped_tags = 0
+        self.dropped_baggage = 0
+        self.forced_finishes = 0
+
+        if limits.max_span_duration is not None:
+            self.deadline = clock.start + int(limits.max_span_duration * 1e9)
+
+    def check_deadline(self, now=None):
+        if self.deadline_exceeded:
+            return False
+
+        if self.deadline is None:
+            return True
+
+        if now is None:
+            now = self.clock.now()
+        if now < self.deadline:
+            return True
+
+        self.deadline_exceeded = True
+        self.finish_open_spans()
+        return False
+
+    def start_record(self, operation_name, now, parent=None, dropped=False):
+        """
+        Returns a SpanRecord for a new span if the calls or the spans
+        are tracked, or None. Dropped spans are only tracked as calls.
+        @param now the monotonic time the span started at
+        """
+        keep = self.records is not None and not dropped
+        if self.calls is None and not keep:
+            return None
+
+        record = SpanRecord(operation_name, parent, keep,
+                            self.clock.to_seconds(now))
+        if keep:
+            record.index = len(self.records)
+            self.records.append(record)
+
+        return record
+
+    def finish_record(self, record, now):
+        record.duration = self.clock.to_seconds(now) - record.start
+        if (self.calls is not None and
+                record.kind == tags.SPAN_KIND_RPC_CLIENT):
+            self.calls.append(record)
+
+    def finish_open_spans(self):
+        for span in list(self.open_spans):
+            self.forced_finishes += 1
+            span.finish()
+
+    def consume_tag(self, key, value):
+        max_bytes = self.limits.max_tag_bytes
+        if max_bytes is None:
+            return True
+
+        if isinstance(value, (int, float, bool)):
+            size = len(key) + 8
+        else:
+            size = len(key) + len(str(value))
+
+        if self.tag_bytes + size > max_bytes:
+            self.dropped_tags += 1
+            return False
+
+        self.tag_bytes += size
+        return True
+
+    def finish_tags(self):
+        """
+        Returns the tags set on the root span when it finishes.
+        """
+        result = {}
+        for key, value in (('limits.dropped_spans', self.dropped_spans),
+                           ('limits.dropped_logs', self.dropped_logs),
+                           ('limits.dropped_tags', self.dropped_tags),
+                           ('limits.forced_finishes', self.forced_finishes),
+                           ('baggage.dropped', self.dropped_baggage)):
+            if value:
+                result[key] = value
+
+        if self.deadline_exceeded:
+            result['limits.deadline_exceeded'] = True
+
+        if self.summary_size:
+            result.update(summary_tags(self.records, self.summary_size))
+
+        return result
+
+
+class SpanRecord(object):
+    """
+    What the dependency graph (for the calls, kept even if the span
+    itself is dropped by the limits) and the timeline need to know
+    about a span.
+    """
+    __slots__ = ('operation_name', 'kind', 'peer', 'error', 'start',
+                 'duration', 'parent', 'index', 'tags')
+
+    def __init__(self, operation_name, parent=None, keep_tags=False,
+                 start=0.0):
+        self.operation_name = operation_name
+        self.kind = None
+        self.peer = None
+        self.error = False
+        self.start = start
+        self.duration = None
+        self.parent = parent
+        self.index = None
+        self.tags = {} if keep_tags else None
+
+    def set_tag(self, key, value):
+        if key == tags.SPAN_KIND:
+            self.kind = value
+        elif key == tags.PEER_SERVICE:
+            self.peer = value
+        elif key == tags.PEER_HOSTNAME and self.peer is None:
+            self.peer = value
+        elif key == tags.ERROR:
+            self.error = bool(value)
+        elif key == tags.HTTP_STATUS_CODE:
+            try:
+                self.error = self.error or int(value) >= 500
+            except (TypeError, ValueError):
+                pass
+
+
+class RequestSpan(opentracing.Span):
+    """
+    Wraps a span of the underlying tracer, enforcing the limits
+    of the request it belongs to.
+    """
+    def __init__(self, tracer, span, state, record=None):
+        super(RequestSpan, self).__init__(tracer, None)
+        self.span = span
+        self.state = state
+        self.record = record
+        self.logs_count = 0
+        self.is_finished = False
+
+    @property
+    def context(self):
+        return self.span.context
+
+    def set_operation_name(self, operation_name):
+        self.span.set_operation_name(operation_name)
+        if self.record is not None:
+            self.record.operation_name = operation_name
+        return self
+
+    def set_tag(self, key, value):
+        if self.is_finished:
+            return self
+
+        record = self.record
+        if record is not None:
+            record.set_tag(key, value)
+
+        state = self.state
+        is_root = self is state.root
+        if not state.check_deadline() and not is_root:
+            state.dropped_tags += 1
+            return self
+
+        if (is_root and key in ROOT_TAGS) or state.consume_tag(key, value):
+            self.span.set_tag(key, value)
+            if record is not None and record.tags is not None:
+                record.tags[key] = value
+
+        return self
+
+    def log_kv(self, key_values, timestamp=None):
+        if self.is_finished:
+            return self
+
+        # the error of the request, like the ROOT_TAGS.
+        if (self is self.state.root and
+                key_values.get('event') == tags.ERROR):
+            self.span.log_kv(key_values, timestamp)
+            return self
+
+        max_logs = self.state.limits.max_span_logs
+        if (not self.state.check_deadline() or
+                (max_logs is not None and self.logs_count >= max_logs)):
+            self.state.dropped_logs += 1
+            return self
+
+        self.logs_count += 1
+        self.span.log_kv(key_values, timestamp)
+        return self
+
+    def set_baggage_item(self, key, value):
+        policy = self.state.baggage
+        if (policy is not None and
+                not policy.allows_item(self.span.context.baggage, key, value)):
+            self.state.dropped_baggage += 1
+            return self
+
+        self.span.set_baggage_item(key, value)
+        return self
+
+    def get_baggage_item(self, key):
+        return self.span.get_baggage_item(key)
+
+    def finish(self, finish_time=None):
+        if self.is_finished:
+            return
+
+        self.is_finished = True
+        state = self.state
+        if finish_time is None:
+            now = state.clock.now()
+            finish_time = state.clock.to_wall(now)
+        else:
+            now = state.clock.from_wall(finish_time)
+
+        state.open_spans.discard(self)
+        if self.record is not None:
+            state.finish_record(self.record, now)
+
+        if self is state.root:
+            state.finish_open_spans()
+            for key, value in state.finish_tags().items():
+                self.span.set_tag(key, value)
+
+        self.span.finish(finish_time)
+
+    def __getattr__(self, name):
+        # Expose the attributes of the underlying span,
+        # e.g. MockSpan.tags or MockSpan.operation_name.
+        return getattr(self.span, name)
+
+
+class DroppedSpan(opentracing.Span):
+    """
+    Stands in for a child span discarded because of the limits. It
+    reuses the context of its parent, so its own children are attached
+    to the last recorded span.
+    """
+    def __init__(self, tracer, context, state, record=None,
+                 parent_record=None):
+        super(DroppedSpan, self).__init__(tracer, context)
+        self.state = state
+        self.record = record
+        self.parent_record = parent_record
+
+    def set_operation_name(self, operation_name):
+        if self.record is not None:
+            self.record.operation_name = operation_name
+        return self
+
+    def set_tag(self, key, value):
+        if self.record is not None:
+            self.record.set_tag(key, value)
+        return self
+
+    def log_kv(self, key_values, timestamp=None):
+        self.state.dropped_logs += 1
+        return self
+
+    def finish(self, finish_time=None):
+        record, self.record = self.record, None
+        if record is not None:
+            self.state.finish_record(record, self.state.clock.now())
+
+
+class RequestTracer(opentracing.Tracer):
+    """
+    Wraps a tracer so every span started under a traced request
+    is accounted for in its RequestState, and timestamped by
+    its RequestClock.
+    """
+    def __init__(self, tracer):
+        super(RequestTracer, self).__init__(tracer.scope_manager)
+        self.tracer = tracer
+
+    def start_root_span(self, state, operation_name, child_of=None):
+        clock = state.clock
+        span = self.tracer.start_span(operation_name, child_of=child_of,
+                                      start_time=clock.wall)
+        wrapper = RequestSpan(self, span, state,
+                              state.start_record(operation_name, clock.start))
+        state.root = wrapper
+        return wrapper
+
+    def start_active_root_span(self, state, operation_name, child_of=None,
+                               finish_on_close=True):
+        span = self.start_root_span(state, operation_name, child_of)
+        return self.scope_manager.activate(span, finish_on_close)
+
+    def start_active_span(self,
+                          operation_name,
+                          child_of=None,
+                          references=None,
+                          tags=None,
+                          start_time=None,
+                          ignore_active_span=False,
+                          finish_on_close=True):
+        span = self.start_span(operation_name,
+                               child_of=child_of,
+                               references=references,
+                               tags=tags,
+                               start_time=start_time,
+                               ignore_active_span=ignore_active_span)
+        return self.scope_manager.activate(span, finish_on_close)
+
+    def start_span(self,
+                   operation_name=None,
+                   child_of=None,
+                   references=None,
+                   tags=None,
+                   start_time=None,
+                   ignore_active_span=False):
+        state, parent = self._find_parent(child_of, references,
+                                          ignore_active_span)
+        if isinstance(child_of, opentracing.Span):
+            child_of = child_of.context
+
+        if state is None:
+            return self.tracer.start_span(
+                operation_name,
+                child_of=child_of,
+                references=references,
+                tags=tags,
+                start_time=start_time,
+                ignore_active_span=ignore_active_span)
+
+        # the closest recorded ancestor, skipping the dropped spans.
+        if isinstance(parent, DroppedSpan):
+            parent_record = parent.parent_record
+        else:
+            parent_record = parent.record
+
+        now = state.clock.now()
+        max_children = state.limits.max_child_spans
+        if (not state.check_deadline(now) or
+                (max_children is not None and
+                 state.child_spans >= max_children)):
+            state.dropped_spans += 1
+            dropped = DroppedSpan(self, parent.context, state,
+                                  state.start_record(operation_name, now,
+                                                     parent_record, True),
+                                  parent_record)
+            if tags:
+                for key, value in tags.items():
+                    dropped.set_tag(key, value)
+            return dropped
+
+        state.child_spans += 1
+        if child_of is None and references is None:
+            child_of = parent.context
+
+        if start_time is None:
+            start_time = state.clock.to_wall(now)
+
+        span = self.tracer.start_span(operation_name,
+                                      child_of=child_of,
+                                      references=references,
+                                      start_time=start_time,
+                                      ignore_active_span=True)
+        wrapper = RequestSpan(self, span, state,
+                              state.start_record(operation_name, now,
+                                                 parent_record))
+        state.open_spans.add(wrapper)
+
+        if tags:
+            for key, value in tags.items():
+                wrapper.set_tag(key, value)
+
+        return wrapper
+
+    def _find_parent(self, child_of, references, ignore_active_span):
+        if isinstance(child_of, (RequestSpan, DroppedSpan)):
+            return child_of.state, child_of
+
+        active = None
+        if not ignore_active_span or child_of is not None or references:
+            active = self.active_span
+        if not isinstance(active, (RequestSpan, DroppedSpan)):
+            return None, None
+
+        # A SpanContext (or references) is only tracked if it
+        # belongs to the currently active request span.
+        if child_of is not None:
+            if child_of is active.context:
+                return active.state, active
+            return None, None
+
+        if references:
+            for ref in references:
+                if ref.referenced_context is active.context:
+                    return active.state, active
+            return None, None
+
+        return active.state, active
+
+    def inject(self, span_context, format, carrier):
+        return self.tracer.inject(span_context, format, carrier)
+
+    def extract(self, format, carrier):
+        return self.tracer.extract(format, carrier)
+
+    def __getattr__(self, name):
+        # Expose the attributes of the underlying tracer,
+        # e.g. Tracer.close() or MockTracer.finished_spans().
+        return getattr(self.tracer, name)
@@ -0,0 +1,29 @@
+import threading
+
+
+class ThreadShards(object):
+    """
+    One object per thread, created by factory the first time a thread
+    asks for it, so request threads only ever update their own shard
+    and never wait on each other. Readers go through all the shards.
+    The lock is only taken when a thread creates its shard, and by
+    readers.
+    """
+    def __init__(self, factory):
+        self._factory = factory
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._shards = []
+
+    def get(self):
+        shard = getattr(self._local, 'shard', None)
+        if shard is None:
+            shard = self._local.shard = self._factory()
+            with self._lock:
+                self._shards.append(shard)
+
+        return shard
+
+    def all(self):
+        with self._lock:
+            return list(self._shards)
@@ -0,0 +1,155 @@
+DEFAULT_SUMMARY_SIZE = 3
+
+
+def _end(record):
+    return record.start + (record.duration or 0.0)
+
+
+def _sorted_by_start(records):
+    # records are kept in creation order, which is their start order
+    # unless spans were started from several threads.
+    for i in range(1, len(records)):
+        if records[i].start < records[i - 1].start:
+            return [records[0]] + sorted(records[1:],
+                                         key=lambda r: r.start)
+
+    return records
+
+
+def _children(records):
+    """
+    Returns the finished children of every record (by index),
+    in start order.
+    """
+    children = [[] for _ in records]
+    for record in _sorted_by_start(records)[1:]:
+        if record.parent is not None and record.duration is not None:
+            children[record.parent.index].append(record)
+
+    return children
+
+
+def self_times(records, children=None):
+    """
+    Returns the self time of every span (by index): its duration
+    minus the time covered by its children. Overlapping children are
+    only counted once, and clipped to their parent.
+    @param records the SpanRecords of a trace, the root one first and
+    every parent before its children
+    """
+    if children is None:
+        children = _children(records)
+
+    result = [0.0] * len(records)
+    for record in records:
+        if record.duration is None:
+            continue
+
+        start = record.start
+        end = start + record.duration
+        covered = 0.0
+        cursor = start
+
+        # children come in start order, so their union is
+        # computed in a single pass.
+        for child in children[record.index]:
+            child_start = max(child.start, cursor)
+            child_end = min(_end(child), end)
+            if child_end > child_start:
+                covered += child_end - child_start
+                cursor = child_end
+
+        result[record.index] = record.duration - covered
+
+    return result
+
+
+def critical_path(records, children=None):
+    """
+    Returns the critical path of a trace, as (SpanRecord, seconds)
+    segments in chronological order: going back from the end of a
+    span, the time is spent in the child that finished last (and,
+    recursively, in its own children), then in the span itself until
+    the end of the previous child, and so on.
+    The child that finished last among the ones started before any
+    point is found from the running maximum of their ends, so every
+    child is visited twice at most.
+    @param records the SpanRecords of a trace, the root one first and
+    every parent before its children
+    """
+    if not records:
+        return []
+
+    if children is None:
+        children = _children(records)
+
+    segments = []
+    stack = [(records[0], _end(records[0]))]
+    while stack:
+        record, cursor = stack.pop()
+        kids = children[record.index]
+
+        # latest[i] is the child ending last among kids[:i + 1].
+        latest = []
+        for child in kids:
+            if not latest or _end(child) > _end(latest[-1]):
+                latest.append(child)
+            else:
+                latest.append(latest[-1])
+
+        i = len(kids) - 1
+        while cursor > record.start:
+            while i >= 0 and kids[i].start >= cursor:
+                i -= 1
+            if i < 0:
+                break
+
+            child = latest[i]
+            child_end = min(_end(child), cursor)
+            if child_end < cursor:
+                segments.append((child_end, cursor, record))
+            stack.append((child, child_end))
+            cursor = child.start
+
+        if cursor > record.start:
+            segments.append((record.start, cursor, record))
+
+    segments.sort(key=lambda segment: segment[0])
+    return [(record, end - start) for start, end, record in segments]
+
+
+def summarize(items):
+    """
+    Returns the total seconds per operation name of the given
+    (SpanRecord, seconds), the longest first.
+    """
+    totals = {}
+    for record, seconds in items:
+        name = record.operation_name
+        totals[name] = totals.get(name, 0.0) + seconds
+
+    return sorted(totals.items(), key=lambda item: -item[1])
+
+
+def summary_tags(records, size=DEFAULT_SUMMARY_SIZE):
+    """
+    Returns the tags summarizing a trace on its root span: the top
+    operations by self time and by time on the critical path, as
+    'name:ms' lists.
+    """
+    if not records:
+        return {}
+
+    children = _children(records)
+    times = self_times(records, children)
+    return {
+        'pyramid.self_time': _format(summarize(
+            (record, times[record.index]) for record in records), size),
+        'pyramid.critical_path': _format(summarize(
+            critical_path(records, children)), size),
+    }
+
+
+def _format(totals, size):
+    return ','.join('%s:%.1f' % (name, seconds * 1e3)
+                    for name, seconds in totals[:size])
@@ -0,0 +1,183 @@
+import hashlib
+import random
+import re
+
+
+POLICY_HASH = 'hash'
+POLICY_REDACT = 'redact'
+POLICIES = (POLICY_HASH, POLICY_REDACT)
+
+REDACTED = '<redacted>'
+HASH_LENGTH = 16
+
+_SOURCE_RE = re.compile(r'^(\w+)(?:\[([^\]]+)\]|\.([\w.\-]+))?$')
+_MISSING = object()
+
+
+def _get_item(container, key):
+    if container is None:
+        return None
+
+    get = getattr(container, 'get', None)
+    if get is not None:
+        return get(key)
+
+    return getattr(container, key, None)
+
+
+def compile_getter(source):
+    """
+    Compiles an attribute source into a function returning its value
+    for a request, or None if it is missing:
+    'name' the request attribute, e.g. 'path' or 'method'
+    'name[key]' an item of a request attribute, e.g. 'headers[User-Agent]'
+    'name.key' an item (or attribute) of a request attribute, e.g.
+    'matchdict.id', 'params.page' or 'environ.REMOTE_ADDR', which may
+    go further down, e.g. 'json_body.user.id'
+    """
+    match = _SOURCE_RE.match(source)
+    if match is None:
+        raise ValueError('Invalid traced attribute: %r' % source)
+
+    name, key, path = match.groups()
+    if key is None and path is None:
+        def get(request):
+            value = getattr(request, name, _MISSING)
+            if value is _MISSING:
+                return None
+
+            # kept for the plain attributes, as these
+            # were always tagged even if None.
+            return 'None' if value is None else value
+
+        return get
+
+    if key is not None:
+        def get(request):
+            return _get_item(getattr(request, name, None), key)
+
+        return get
+
+    keys = tuple(path.split('.'))
+    if len(keys) == 1:
+        key = keys[0]
+
+        def get(request):
+            return _get_item(getattr(request, name, None), key)
+
+        return get
+
+    def get(request):
+        value = getattr(request, name, None)
+        for key in keys:
+            value = _get_item(value, key)
+        return value
+
+    return get
+
+
+class TracedAttribute(object):
+    """
+    A request attribute set as a tag on the request spans, with its
+    source compiled once into an accessor.
+    @param source where to take the value from, see compile_getter()
+    @param tag the tag name, defaults to the source
+    @param max_length the maximum length of the value, longer ones
+    being truncated
+    @param policy None to set the value as is, 'hash' to set a hash of
+    it, or 'redact' to only tell it was there
+    @param sample_rate the fraction of the requests to tag,
+    or None for all of them
+    """
+    def __init__(self, source, tag=None, max_length=None, policy=None,
+                 sample_rate=None):
+        if policy is not None and policy not in POLICIES:
+            raise ValueError('policy must be one of %s' %
+                             ', '.join(POLICIES))
+
+        self.source = source
+        self.tag = tag or source
+        self.max_length = max_length
+        self.policy = policy
+        self.sample_rate = sample_rate
+        self._get = compile_getter(source)
+
+    @classmethod
+    def parse(cls, spec):
+        """
+        Returns a TracedAttribute from a source followed by its
+        options, separated by '|', e.g.
+        'headers[User-Agent]|tag=http.user_agent|max_length=64',
+        'params.email|hash' or 'matchdict.id|sample=0.1'
+        """
+        parts = spec.split('|')
+        values = {}
+        for option in parts[1:]:
+            name, _, value = option.partition('=')
+            if name == 'tag':
+                values['tag'] = value
+            elif name == 'max_length':
+                values['max_length'] = int(value)
+            elif name in POLICIES and not value:
+                values['policy'] = name
+            elif name == 'sample':
+                values['sample_rate'] = float(value)
+            else:
+                raise ValueError('Invalid traced attribute option: %r in %r'
+                                 % (option, spec))
+
+        return cls(parts[0], **values)
+
+    def apply(self, span, request, cardinality=None):
+        """
+        Sets the tag on the span, unless the value is missing or empty,
+        or the request is not part of the sample.
+        @param cardinality an optional CardinalityLimiter the value
+        goes through
+        """
+        if (self.sample_rate is not None and
+                random.random() >= self.sample_rate):
+            return
+
+        value = self._get(request)
+        if value is None:
+            return
+
+        payload = str(value)
+        if not payload:
+            return
+
+        if self.policy == POLICY_HASH:
+            payload = hashlib.sha256(
+                payload.encode('utf-8')).hexdigest()[:HASH_LENGTH]
+        elif self.policy == POLICY_REDACT:
+            payload = REDACTED
+
+        if self.max_length is not None:
+            payload = payload[:self.max_length]
+
+        if cardinality is not None:
+            payload = cardinality.limit(self.tag, payload)
+
+        span.set_tag(self.tag, payload)
+
+
+class TracedAttributes(tuple):
+    """
+    The compiled attributes of a tween or decorated view.
+    """
+
+
+def compile_attributes(attributes):
+    """
+    Returns the TracedAttributes for a list of TracedAttribute objects
+    or specs (see TracedAttribute.parse()). Already compiled ones are
+    returned as they are.
+    """
+    if isinstance(attributes, TracedAttributes):
+        return attributes
+
+    return TracedAttributes(
+        attr if isinstance(attr, TracedAttribute)
+        else TracedAttribute.parse(attr)
+        for attr in attributes)
@@ -0,0 +1,169 @@
+from pyramid.settings import aslist
+
+
+# ot-baggage- for the basic and mock tracers, uberctx- for Jaeger.
+DEFAULT_PREFIXES = ('ot-baggage-', 'uberctx-')
+W3C_BAGGAGE = 'baggage'
+TAG_PREFIX = 'baggage.'
+
+
+def _size(key, value):
+    return len(key) + len(value)
+
+
+class BaggagePolicy(object):
+    """
+    Bounds the baggage of the traced requests: the items coming with a
+    request are trimmed from its headers before the context is
+    extracted, so that oversized baggage is not copied into every span
+    context of the request, and the items set while serving it are
+    checked likewise.
+    @param allowed_keys the keys let through, or None for any
+    @param max_item_bytes the maximum size of a key and its value
+    @param max_total_bytes the maximum size of all the items
+    @param tag_keys the keys set as 'baggage.<key>' tags on the
+    request spans
+    @param prefixes the prefixes of the headers carrying baggage items,
+    besides the W3C 'baggage' header
+    """
+    def __init__(self, allowed_keys=None, max_item_bytes=None,
+                 max_total_bytes=None, tag_keys=(),
+                 prefixes=DEFAULT_PREFIXES):
+        if allowed_keys is not None:
+            allowed_keys = frozenset(key.lower() for key in allowed_keys)
+
+        self.allowed_keys = allowed_keys
+        self.max_item_bytes = max_item_bytes
+        self.max_total_bytes = max_total_bytes
+        self.tag_keys = tuple(key.lower() for key in tag_keys)
+        self.prefixes = tuple(prefix.lower() for prefix in prefixes)
+
+    @classmethod
+    def from_settings(cls, settings):
+        """
+        Returns a BaggagePolicy from the 'ot.baggage_keys',
+        'ot.baggage_max_item_bytes', 'ot.baggage_max_bytes',
+        'ot.baggage_tags' and 'ot.baggage_prefixes' settings, or None
+        if none of the first four is set.
+        """
+        keys = settings.get('ot.baggage_keys', None)
+        max_item_bytes = settings.get('ot.baggage_max_item_bytes', None)
+        max_total_bytes = settings.get('ot.baggage_max_bytes', None)
+        tag_keys = aslist(settings.get('ot.baggage_tags', ''))
+        if (keys is None and max_item_bytes is None and
+                max_total_bytes is None and not tag_keys):
+            return None
+
+        return cls(
+            allowed_keys=None if keys is None else aslist(keys),
+            max_item_bytes=(None if max_item_bytes is None
+                            else int(max_item_bytes)),
+            max_total_bytes=(None if max_total_bytes is None
+                             else int(max_total_bytes)),
+            tag_keys=tag_keys,
+            prefixes=aslist(settings.get('ot.baggage_prefixes',
+                                         ' '.join(DEFAULT_PREFIXES))),
+        )
+
+    def allows(self, key, value, total=0):
+        """
+        Returns whether an item may be added to items of the given size.
+        """
+        allowed_keys = self.allowed_keys
+        if allowed_keys is not None and key.lower() not in allowed_keys:
+            return False
+
+        size = _size(key, value)
+        if self.max_item_bytes is not None and size > self.max_item_bytes:
+            return False
+
+        return (self.max_total_bytes is None or
+                total + size <= self.max_total_bytes)
+
+    def trim_carrier(self, carrier):
+        """
+        Returns the carrier without the baggage items the policy does not
+        allow (the first ones fitting within the total size are kept), and
+        the number of items removed. The carrier itself is returned if
+        nothing is removed, and a trimmed copy otherwise.
+        """
+        prefixes = self.prefixes
+        total = 0
+        removed = 0
+        changes = None
+        for name, value in carrier.items():
+            lower = name.lower()
+            if lower == W3C_BAGGAGE:
+                kept, dropped, total = self._trim_w3c(value, total)
+                if dropped:
+                    removed += dropped
+                    changes = changes or {}
+                    changes[name] = kept
+                continue
+
+            for prefix in prefixes:
+                if lower.startswith(prefix):
+                    key = lower[len(prefix):]
+                    if self.allows(key, value, total):
+                        total += _size(key, value)
+                    else:
+                        removed += 1
+                        changes = changes or {}
+                        changes[name] = None
+                    break
+
+        if changes is None:
+            return carrier, 0
+
+        trimmed = {}
+        for name, value in carrier.items():
+            value = changes.get(name, value)
+            if value:
+                trimmed[name] = value
+
+        return trimmed, removed
+
+    def _trim_w3c(self, header, total):
+        kept = []
+        dropped = 0
+        for member in header.split(','):
+            key, _, rest = member.strip().partition('=')
+            value = rest.split(';', 1)[0].strip()
+            key = key.strip()
+            if not key:
+                continue
+
+            if self.allows(key, value, total):
+                total += _size(key, value)
+                kept.append(member.strip())
+            else:
+                dropped += 1
+
+        return ','.join(kept), dropped, total
+
+    def allows_item(self, baggage, key, value):
+        """
+        Returns whether an item may be set on a span context
+        with the given baggage.
+        """
+        total = 0
+        if self.max_total_bytes is not None:
+            total = sum(_size(k, v) for k, v in baggage.items() if k != key)
+
+        return self.allows(key, value, total)
+
+    def promote(self, span, baggage, cardinality=None):
+        """
+        Sets the tag_keys items of the baggage as tags on the span.
+        @param cardinality an optional CardinalityLimiter the values
+        go through
+        """
+        for key in self.tag_keys:
+            value = baggage.get(key)
+            if value is None:
+                continue
+
+            tag = TAG_PREFIX + key
+            if cardinality is not None:
+                value = cardinality.limit(tag, value)
+            span.set_tag(tag, value)
@@ -0,0 +1,141 @@
+import hashlib
+import math
+import struct
+
+from .exemplars import OTHER_ROUTE
+
+
+DEFAULT_MAX_VALUES = 100
+OPERATION_KEY = 'operation_name'
+OTHER_VALUE = OTHER_ROUTE
+
+# 2^10 registers of one byte: about 3% standard error.
+HLL_PRECISION = 10
+
+_HASH = struct.Struct('<Q')
+
+
+def _hash64(value):
+    # not hash(), which is salted per process and
+    # the identity for small integers.
+    if not isinstance(value, bytes):
+        value = u'%s' % value
+        value = value.encode('utf-8')
+
+    return _HASH.unpack(hashlib.md5(value).digest()[:8])[0]
+
+
+class HyperLogLog(object):
+    """
+    Estimates the number of distinct values added, in a fixed
+    2^precision bytes.
+    """
+    def __init__(self, precision=HLL_PRECISION):
+        self._precision = precision
+        self._size = 1 << precision
+        self._shift = 64 - precision
+        self._registers = bytearray(self._size)
+
+        if self._size >= 128:
+            self._alpha = 0.7213 / (1 + 1.079 / self._size)
+        else:
+            self._alpha = {16: 0.673, 32: 0.697, 64: 0.709}[self._size]
+
+    def add(self, value):
+        h = _hash64(value)
+        index = h >> self._shift
+        rest = h & ((1 << self._shift) - 1)
+        rank = self._shift - rest.bit_length() + 1
+        if rank > self._registers[index]:
+            self._registers[index] = rank
+
+    def estimate(self):
+        registers = self._registers
+        size = self._size
+        total = sum(2.0 ** -r for r in registers)
+        estimate = self._alpha * size * size / total
+
+        zeros = registers.count(0)
+        if estimate <= 2.5 * size and zeros:
+            # linear counting is more accurate for small cardinalities.
+            estimate = size * math.log(size / float(zeros))
+
+        return int(round(estimate))
+
+
+class _KeyState(object):
+    def __init__(self):
+        self.values = set()
+        self.overflow = 0
+        self.distinct = HyperLogLog()
+
+
+class CardinalityLimiter(object):
+    """
+    Bounds the number of distinct operation names and tag values per
+    tag key: the first max_values distinct values of a key are let
+    through, and any other collapses to '__other__'. The number of
+    distinct values actually seen per key, including the collapsed
+    ones, is estimated with a HyperLogLog and reported by get_stats().
+    Like ExemplarTable, this takes no locks, so a key may let a few
+    more values through under contention.
+    @param max_values the maximum number of distinct values per key
+    """
+    def __init__(self, max_values=DEFAULT_MAX_VALUES):
+        self.max_values = max_values
+        self._keys = {}
+
+    @classmethod
+    def from_settings(cls, settings):
+        """
+        Returns a CardinalityLimiter from the 'ot.max_cardinality'
+        setting, or None if it is not set.
+        """
+        max_values = settings.get('ot.max_cardinality', None)
+        if max_values is None:
+            return None
+
+        return cls(int(max_values))
+
+    def limit(self, key, value):
+        """
+        Returns the value if it is one of the values let through for
+        the key, or there is still room for it, or '__other__'.
+        """
+        state = self._keys.get(key)
+        if state is None:
+            state = self._keys.setdefault(key, _KeyState())
+
+        values = state.values
+        if value in values:
+            return value
+
+        # every admitted value is only added to the estimate once,
+        # the collapsed ones every time they are seen.
+        state.distinct.add(value)
+        if len(values) < self.max_values:
+            values.add(value)
+            return value
+
+        state.overflow += 1
+        return OTHER_VALUE
+
+    def get_stats(self):
+        """
+        Returns, per key, the number of values let through, the
+        estimated number of distinct values and the number of
+        collapsed occurrences.
+        """
+        stats = {}
+        for key, state in self._keys.copy().items():
+            stats[key] = {
+                'values': len(state.values),
+                'estimate': max(state.distinct.estimate(),
+                                len(state.values)),
+                'overflow': state.overflow,
+            }
+
+        return stats
+
+    def reset(self):
+        self._keys = {}
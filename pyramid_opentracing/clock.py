@@ -0,0 +1,76 @@
+import time
+
+
+_perf_counter = getattr(time, 'perf_counter', time.time)
+
+
+def _perf_counter_ns_fallback():
+    return int(_perf_counter() * 1e9)
+
+
+_perf_counter_ns = getattr(time, 'perf_counter_ns', _perf_counter_ns_fallback)
+
+
+class Clock(object):
+    """
+    Where the traced requests take their timestamps from: the wall
+    clock is read once per request, as its anchor, and every other
+    timestamp of the request is derived from a monotonic clock, so
+    the spans of a request never go back in time nor drift apart
+    when the system time is adjusted.
+    @param wall returns the wall-clock time, in seconds
+    @param monotonic returns a monotonic time, in nanoseconds
+    """
+    def __init__(self, wall=time.time, monotonic=_perf_counter_ns):
+        self.wall = wall
+        self.monotonic = monotonic
+
+    def request_clock(self):
+        """
+        Returns a new RequestClock, anchored at the current time.
+        """
+        return RequestClock(self.wall(), self.monotonic)
+
+
+class RequestClock(object):
+    """
+    The clock of a single request, see Clock.
+    @param wall the wall-clock time of the anchor, in seconds
+    @param monotonic returns a monotonic time, in nanoseconds
+    """
+    __slots__ = ('wall', 'start', 'now')
+
+    def __init__(self, wall, monotonic):
+        self.now = monotonic
+        self.wall = wall
+        self.start = monotonic()
+
+    def to_wall(self, now):
+        """
+        Returns the wall-clock time, in seconds, of a monotonic time.
+        """
+        return self.wall + (now - self.start) / 1e9
+
+    def from_wall(self, wall):
+        """
+        Returns the monotonic time of a wall-clock time (in seconds).
+        """
+        return self.start + int(round((wall - self.wall) * 1e9))
+
+    def to_seconds(self, now):
+        """
+        Returns the seconds elapsed from the anchor to a monotonic time.
+        """
+        return (now - self.start) / 1e9
+
+    def wall_time(self):
+        """
+        Returns the current wall-clock time, in seconds.
+        """
+        return self.to_wall(self.now())
+
+    def elapsed(self):
+        """
+        Returns the seconds elapsed since the anchor.
+        """
+        return (self.now() - self.start) / 1e9
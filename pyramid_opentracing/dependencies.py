@@ -0,0 +1,220 @@
+import math
+
+from pyramid.settings import asbool
+
+from .exemplars import OTHER_ROUTE
+
+
+DEFAULT_MAX_EDGES = 1024
+DEFAULT_RELATIVE_ACCURACY = 0.05
+UNKNOWN_SERVICE = 'unknown'
+QUANTILES = (('p50', 0.5), ('p90', 0.9), ('p99', 0.99))
+
+# Latencies are tracked with their relative accuracy between these
+# bounds, in seconds, and clamped to them otherwise.
+MIN_LATENCY = 1e-5
+MAX_LATENCY = 1e3
+
+# the key of the caller names in the CardinalityLimiter.
+CALLER_KEY = 'dependencies.caller'
+
+
+class LatencySketch(object):
+    """
+    Latency distribution with logarithmically sized buckets, so every
+    quantile is estimated within relative_accuracy of its true value,
+    with a fixed number of counters (186 at 5%) however many latencies
+    are added. Like ExemplarTable, updates take no locks and may lose
+    increments under heavy contention.
+    @param relative_accuracy the relative error of the quantiles
+    """
+    def __init__(self, relative_accuracy=DEFAULT_RELATIVE_ACCURACY):
+        self._gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self._log_gamma = math.log(self._gamma)
+        size = int(math.ceil(math.log(MAX_LATENCY / MIN_LATENCY) /
+                             self._log_gamma)) + 1
+        self.counts = [0] * size
+        self.sum = 0.0
+        self.max = 0.0
+
+    def add(self, value):
+        """
+        @param value the latency, in seconds
+        """
+        if value <= MIN_LATENCY:
+            index = 0
+        else:
+            index = min(int(math.ceil(math.log(value / MIN_LATENCY) /
+                                      self._log_gamma)),
+                        len(self.counts) - 1)
+
+        self.counts[index] += 1
+        self.sum += value
+        if value > self.max:
+            self.max = value
+
+    def quantiles(self, quantiles):
+        """
+        Returns the estimates for the given quantiles (in increasing
+        order, between 0 and 1), or None for each if empty.
+        """
+        counts = list(self.counts)
+        total = sum(counts)
+        if not total:
+            return [None] * len(quantiles)
+
+        result = []
+        index = seen = 0
+        for q in quantiles:
+            rank = q * (total - 1)
+            while seen + counts[index] <= rank:
+                seen += counts[index]
+                index += 1
+            result.append(self._estimate(index))
+
+        return result
+
+    def _estimate(self, index):
+        if index == 0:
+            return min(MIN_LATENCY, self.max)
+
+        # bucket i holds the latencies in (MIN * gamma^(i-1), MIN * gamma^i]
+        value = MIN_LATENCY * 2 * self._gamma ** index / (self._gamma + 1)
+        return min(value, self.max)
+
+
+class _Edge(object):
+    def __init__(self):
+        self.calls = 0
+        self.errors = 0
+        self.latency = LatencySketch()
+
+
+class DependencyGraph(object):
+    """
+    Service dependency graph built in process from the traced requests,
+    with edges keyed by (caller service, route) -> (peer service,
+    operation), each counting the calls and errors along with a
+    latency sketch.
+    Outgoing edges come from the client spans (span.kind=client)
+    started through PyramidTracing.tracer while serving a request,
+    their peer being the peer.service tag, or else the peer.hostname
+    tag. Incoming edges are recorded for the requests naming their
+    caller in caller_header, with an unknown (None) caller route.
+    Updates take no locks, like ExemplarTable.
+    @param service_name the name of this service
+    @param caller_header the request header naming the calling
+    service, or None
+    @param max_edges maximum number of edges, any other edge is
+    accounted for under a single '__other__' edge
+    """
+    def __init__(self, service_name=None, caller_header=None,
+                 max_edges=DEFAULT_MAX_EDGES):
+        self.service_name = service_name or UNKNOWN_SERVICE
+        self.caller_header = caller_header
+        self._max_edges = max_edges
+        self._edges = {}
+
+    @classmethod
+    def from_settings(cls, settings):
+        """
+        Returns a DependencyGraph from the 'ot.service_name',
+        'ot.caller_header' and 'ot.dependencies_max_edges' settings,
+        or None unless 'ot.dependencies' is set.
+        """
+        if not asbool(settings.get('ot.dependencies', False)):
+            return None
+
+        return cls(settings.get('ot.service_name', None),
+                   settings.get('ot.caller_header', None),
+                   int(settings.get('ot.dependencies_max_edges',
+                                    DEFAULT_MAX_EDGES)))
+
+    def _get_edge(self, key):
+        edge = self._edges.get(key)
+        if edge is not None:
+            return edge
+
+        # the whole key, as the caller comes from a request header.
+        if len(self._edges) >= self._max_edges:
+            key = (OTHER_ROUTE, OTHER_ROUTE, OTHER_ROUTE, OTHER_ROUTE)
+
+        # setdefault() is atomic, so concurrent first calls
+        # for an edge end up sharing it.
+        return self._edges.setdefault(key, _Edge())
+
+    def record(self, caller, route, peer, operation, duration, error=False):
+        """
+        @param caller the calling service
+        @param route the caller route, or None if unknown
+        @param peer the called service
+        @param operation the called operation (or route)
+        @param duration the call duration, in seconds
+        @param error whether the call failed
+        """
+        edge = self._get_edge((caller, route, peer, operation))
+        edge.calls += 1
+        if error:
+            edge.errors += 1
+        edge.latency.add(duration)
+
+    def record_request(self, request, route, duration, error, calls,
+                       cardinality=None):
+        """
+        Records the edges of a traced request.
+        @param request the request
+        @param route the route (or operation) name
+        @param duration the request duration, in seconds
+        @param error whether the request failed
+        @param calls the SpanRecords of the client calls made while
+        serving it
+        @param cardinality an optional CardinalityLimiter the caller
+        names go through
+        """
+        if self.caller_header is not None:
+            caller = request.headers.get(self.caller_header)
+            if caller and cardinality is not None:
+                caller = cardinality.limit(CALLER_KEY, caller)
+            if caller:
+                self.record(caller, None, self.service_name, route,
+                            duration, error)
+
+        for call in calls:
+            self.record(self.service_name, route,
+                        call.peer or UNKNOWN_SERVICE, call.operation_name,
+                        call.duration, call.error)
+
+    def export(self):
+        """
+        Returns the graph as a JSON serializable dictionary, with the
+        edges with the most calls first.
+        """
+        edges = []
+        for key, edge in self._edges.copy().items():
+            caller, route, peer, operation = key
+            latency = edge.latency
+            values = latency.quantiles([q for _, q in QUANTILES])
+
+            calls = edge.calls
+            summary = dict(zip([name for name, _ in QUANTILES], values))
+            summary['max'] = latency.max
+            summary['avg'] = latency.sum / calls if calls else None
+
+            edges.append({
+                'caller': caller,
+                'route': route,
+                'peer': peer,
+                'operation': operation,
+                'calls': calls,
+                'errors': edge.errors,
+                'latency': summary,
+            })
+
+        edges.sort(key=lambda e: -e['calls'])
+        return {
+            'service': self.service_name,
+            'edges': edges,
+        }
+
+    def reset(self):
+        self._edges = {}
@@ -0,0 +1,114 @@
+import collections
+import hashlib
+import sys
+import threading
+import traceback
+
+from opentracing.ext import tags
+
+
+ERROR_MODE_OBJECT = 'object'
+ERROR_MODE_COMPACT = 'compact'
+ERROR_MODES = (ERROR_MODE_OBJECT, ERROR_MODE_COMPACT)
+
+DEFAULT_MAX_FINGERPRINTS = 1024
+DEFAULT_MAX_FRAMES = 64
+
+
+def _get_traceback(error):
+    tb = getattr(error, '__traceback__', None)
+    if tb is None:  # Python 2, only while handling the exception.
+        exc_type, exc_value, tb = sys.exc_info()
+        if exc_value is not error:
+            tb = None
+
+    return tb
+
+
+class ErrorRecorder(object):
+    """
+    Records errors on spans as plain strings instead of the live
+    exception object, which would keep every frame of its traceback
+    (and their locals) alive until the span is reported.
+    The stack is only formatted the first time a given traceback
+    is seen; repeated errors carry its fingerprint and a count.
+    @param max_fingerprints maximum number of fingerprints to remember
+    @param max_frames maximum number of frames to fingerprint and format
+    """
+    def __init__(self, max_fingerprints=DEFAULT_MAX_FINGERPRINTS,
+                 max_frames=DEFAULT_MAX_FRAMES):
+        self._max_fingerprints = max_fingerprints
+        self._max_frames = max_frames
+        self._lock = threading.Lock()
+        self._counts = collections.OrderedDict()
+
+    def fingerprint(self, error, tb):
+        """
+        Returns a short id for the exception type and the code
+        locations of its traceback, ignoring the message.
+        """
+        parts = [type(error).__module__, type(error).__name__]
+        frames = 0
+        while tb is not None and frames < self._max_frames:
+            code = tb.tb_frame.f_code
+            parts.append('%s:%s:%d' % (code.co_filename, code.co_name,
+                                       tb.tb_lineno))
+            tb = tb.tb_next
+            frames += 1
+
+        digest = hashlib.sha1('|'.join(parts).encode('utf-8'))
+        return digest.hexdigest()[:16]
+
+    def _increment(self, fingerprint):
+        with self._lock:
+            count = self._counts.pop(fingerprint, 0) + 1
+            self._counts[fingerprint] = count
+            if len(self._counts) > self._max_fingerprints:
+                self._counts.popitem(last=False)
+
+        return count
+
+    def log_error(self, span, error):
+        """
+        @param span the span to log the error to
+        @param error the exception
+        """
+        self.log_summary(span, self.summarize(error))
+
+    def summarize(self, error):
+        """
+        Returns the fields logged for an exception (its kind, message,
+        fingerprint, count, and stack the first time it is seen), so the
+        exception itself can be released before they are logged.
+        """
+        tb = _get_traceback(error)
+        fingerprint = self.fingerprint(error, tb)
+        count = self._increment(fingerprint)
+
+        key_values = {
+            'event': tags.ERROR,
+            'error.kind': type(error).__name__,
+            'message': str(error),
+            'error.fingerprint': fingerprint,
+            'error.count': count,
+        }
+        if count == 1:
+            lines = traceback.format_exception(type(error), error, tb,
+                                               limit=self._max_frames)
+            key_values['stack'] = ''.join(lines)
+
+        return key_values
+
+    def log_summary(self, span, key_values):
+        """
+        Logs the fields returned by summarize() to a span.
+        """
+        span.set_tag(tags.ERROR, True)
+        span.log_kv(key_values)
+
+    def counts(self):
+        """
+        Returns a copy of the remembered fingerprints and their counts.
+        """
+        with self._lock:
+            return dict(self._counts)
@@ -0,0 +1,123 @@
+import bisect
+import time
+
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1.0, 2.5, 5.0, 10.0)
+DEFAULT_MAX_ROUTES = 512
+OTHER_ROUTE = '__other__'
+
+METRIC_NAME = 'pyramid_request_duration_seconds'
+CONTENT_TYPE = 'application/openmetrics-text; version=1.0.0; charset=utf-8'
+
+
+class _RouteHistogram(object):
+    def __init__(self, size):
+        self.counts = [0] * size
+        self.exemplars = [None] * size
+        self.sum = 0.0
+
+
+class ExemplarTable(object):
+    """
+    Fixed-size latency histogram per route, keeping for every bucket
+    the ids of the most recent sampled request that landed in it.
+    Updates take no locks: every exemplar is replaced with a single
+    reference assignment, so readers always see a consistent one,
+    while counts may lose increments under heavy contention.
+    @param buckets the bucket upper bounds, in seconds
+    @param max_routes maximum number of routes, any other route is
+    accounted for under '__other__'
+    """
+    def __init__(self, buckets=DEFAULT_BUCKETS,
+                 max_routes=DEFAULT_MAX_ROUTES):
+        self.buckets = tuple(sorted(float(b) for b in buckets))
+        self._max_routes = max_routes
+        self._routes = {}
+
+    def _get_histogram(self, route):
+        histogram = self._routes.get(route)
+        if histogram is not None:
+            return histogram
+
+        if len(self._routes) >= self._max_routes:
+            route = OTHER_ROUTE
+
+        # setdefault() is atomic, so concurrent first requests
+        # for a route end up sharing the same histogram.
+        return self._routes.setdefault(
+            route, _RouteHistogram(len(self.buckets) + 1))
+
+    def observe(self, route, duration, ids=None):
+        """
+        @param route the route (or operation) name
+        @param duration the request duration, in seconds
+        @param ids the (trace_id, span_id) of a sampled request, or None
+        """
+        histogram = self._get_histogram(route)
+        index = bisect.bisect_left(self.buckets, duration)
+        histogram.counts[index] += 1
+        histogram.sum += duration
+
+        if ids is not None and ids[0] is not None:
+            histogram.exemplars[index] = (ids[0], ids[1], duration,
+                                          time.time())
+
+    def get_exemplar(self, route, duration):
+        """
+        Returns the (trace_id, span_id, duration, timestamp) exemplar of
+        the bucket the duration falls in for a route, or None.
+        """
+        histogram = self._routes.get(route)
+        if histogram is None:
+            return None
+
+        return histogram.exemplars[bisect.bisect_left(self.buckets,
+                                                      duration)]
+
+    def export(self):
+        """
+        Returns the histograms in the OpenMetrics text format,
+        with the exemplars attached to their buckets.
+        """
+        lines = [
+            '# TYPE %s histogram' % METRIC_NAME,
+            '# UNIT %s seconds' % METRIC_NAME,
+        ]
+        bounds = ['%g' % b for b in self.buckets] + ['+Inf']
+
+        for route, histogram in sorted(self._routes.copy().items()):
+            labels = 'route="%s"' % _escape(route)
+            counts = list(histogram.counts)
+            exemplars = list(histogram.exemplars)
+
+            total = 0
+            for bound, count, exemplar in zip(bounds, counts, exemplars):
+                total += count
+                line = '%s_bucket{%s,le="%s"} %d' % (METRIC_NAME, labels,
+                                                     bound, total)
+                if exemplar is not None:
+                    line += _format_exemplar(exemplar)
+                lines.append(line)
+
+            lines.append('%s_count{%s} %d' % (METRIC_NAME, labels, total))
+            lines.append('%s_sum{%s} %r' % (METRIC_NAME, labels,
+                                            histogram.sum))
+
+        lines.append('# EOF')
+        return '\n'.join(lines) + '\n'
+
+
+def _escape(value):
+    return (value.replace('\\', '\\\\')
+                 .replace('"', '\\"')
+                 .replace('\n', '\\n'))
+
+
+def _format_exemplar(exemplar):
+    trace_id, span_id, duration, timestamp = exemplar
+    labels = 'trace_id="%s"' % _escape(trace_id)
+    if span_id is not None:
+        labels += ',span_id="%s"' % _escape(span_id)
+
+    return ' # {%s} %r %.3f' % (labels, duration, timestamp)
@@ -0,0 +1,365 @@
+import itertools
+import random
+import time
+
+import opentracing
+from opentracing.scope_managers import ThreadLocalScopeManager
+
+from ._ids import span_ids
+
+
+TRACEPARENT = 'traceparent'
+BAGGAGE_PREFIX = 'ot-baggage-'
+
+# the recorded ids, as set on the exported spans.
+TRACE_ID_TAG = 'fanout.trace_id'
+SPAN_ID_TAG = 'fanout.span_id'
+
+# the trace ids are sampled from their low 32 bits.
+_SAMPLE_BITS = 32
+_SAMPLE_MASK = (1 << _SAMPLE_BITS) - 1
+
+DEFAULT_MAX_PENDING = 1000
+
+
+class RecordedSpanContext(opentracing.SpanContext):
+    """
+    The context of a RecordedSpan: W3C-sized ids (a 128-bit trace id
+    and a 64-bit span id), the sampled flag and the baggage.
+    @param root_id the span id of the local root span, None for the
+    contexts extracted from a carrier
+    """
+    __slots__ = ('trace_id', 'span_id', 'sampled', 'root_id', '_baggage')
+
+    def __init__(self, trace_id, span_id, sampled=True, baggage=None,
+                 root_id=None):
+        self.trace_id = trace_id
+        self.span_id = span_id
+        self.sampled = sampled
+        self.root_id = root_id
+        self._baggage = baggage or {}
+
+    @property
+    def baggage(self):
+        return self._baggage
+
+    def with_baggage_item(self, key, value):
+        baggage = dict(self._baggage)
+        baggage[key] = value
+        return RecordedSpanContext(self.trace_id, self.span_id,
+                                   self.sampled, baggage, self.root_id)
+
+
+class RecordedSpan(opentracing.Span):
+    """
+    A span recorded once, as plain values, for every destination of a
+    FanOutTracer to convert as it needs: operation_name, parent_id
+    (None for a root span), start_time and finish_time (in seconds),
+    tags (a dictionary) and logs (a list of (timestamp, key_values)).
+    @param sequence the order the span was started in, within its tracer
+    """
+    def __init__(self, tracer, context, operation_name, parent_id,
+                 start_time, tags=None, sequence=0):
+        super(RecordedSpan, self).__init__(tracer, context)
+        self.sequence = sequence
+        self.operation_name = operation_name
+        self.parent_id = parent_id
+        self.start_time = start_time
+        self.finish_time = None
+        self.tags = dict(tags) if tags else {}
+        self.logs = []
+
+    @property
+    def trace_id(self):
+        return self.context.trace_id
+
+    @property
+    def span_id(self):
+        return self.context.span_id
+
+    def set_operation_name(self, operation_name):
+        self.operation_name = operation_name
+        return self
+
+    def set_tag(self, key, value):
+        self.tags[key] = value
+        return self
+
+    def log_kv(self, key_values, timestamp=None):
+        self.logs.append((timestamp or time.time(), key_values))
+        return self
+
+    def set_baggage_item(self, key, value):
+        self._context = self._context.with_baggage_item(key, value)
+        return self
+
+    def get_baggage_item(self, key):
+        return self._context.baggage.get(key)
+
+    def finish(self, finish_time=None):
+        if self.finish_time is not None:
+            return
+
+        self.finish_time = finish_time or time.time()
+        self._tracer._span_finished(self)
+
+
+class Destination(object):
+    """
+    Where a FanOutTracer sends the traces to.
+    @param exporter a callable receiving the finished spans of a local
+    trace (the RecordedSpans under a root span, parents before their
+    children), e.g. a TracerExporter
+    @param sample_rate the fraction of the traces to export, decided
+    from their trace id so that every service sharing the rate keeps
+    the same traces
+    @param name a name for the destination, used in get_stats()
+    """
+    def __init__(self, exporter, sample_rate=1.0, name=None):
+        if not callable(exporter):
+            raise ValueError('exporter is not callable')
+
+        if not 0.0 <= sample_rate <= 1.0:
+            raise ValueError('sample_rate must be between 0 and 1')
+
+        self.exporter = exporter
+        self.sample_rate = sample_rate
+        self.name = name or getattr(exporter, '__name__',
+                                    type(exporter).__name__)
+        self._threshold = int(sample_rate * (1 << _SAMPLE_BITS))
+        self.exported = 0
+        self.errors = 0
+
+    def is_sampled(self, trace_id):
+        return (trace_id & _SAMPLE_MASK) < self._threshold
+
+    def export(self, spans):
+        if not self.is_sampled(spans[0].trace_id):
+            return
+
+        try:
+            self.exporter(spans)
+        except Exception:
+            # a failing backend must not fail the
+            # requests, nor the other destinations.
+            self.errors += 1
+        else:
+            self.exported += 1
+
+
+class TracerExporter(object):
+    """
+    Exports the recorded spans through another OpenTracing tracer,
+    e.g. the client of a tracing vendor. The spans are only converted
+    for the traces the destination samples.
+    The OpenTracing API does not let the span ids be chosen, so the
+    converted spans get new span ids from that tracer, and a new trace
+    id as well unless context_factory is given: the ids propagated to
+    the other services and returned in the response headers are not
+    found in that backend, except as the 'fanout.trace_id' and
+    'fanout.span_id' tags of the converted spans (hex-encoded, as
+    in the X-Trace-Id response header).
+    @param context_factory an optional callable returning a span
+    context of the tracer from (trace_id, span_id, sampled, baggage),
+    the local root spans being started as children of the context of
+    their remote parent, so they keep its trace id and are linked to it
+    """
+    def __init__(self, tracer, context_factory=None):
+        self.tracer = tracer
+        self.context_factory = context_factory
+
+    def __call__(self, spans):
+        tracer = self.tracer
+        contexts = {}
+        for span in spans:
+            parent = contexts.get(span.parent_id)
+            if (parent is None and span.parent_id is not None and
+                    self.context_factory is not None):
+                parent = self.context_factory(span.trace_id, span.parent_id,
+                                              span.context.sampled,
+                                              span.context.baggage)
+
+            converted = tracer.start_span(
+                span.operation_name,
+                child_of=parent,
+                tags=span.tags,
+                start_time=span.start_time,
+                ignore_active_span=True)
+            trace_id, span_id = span_ids(span)
+            converted.set_tag(TRACE_ID_TAG, trace_id)
+            converted.set_tag(SPAN_ID_TAG, span_id)
+            for key, value in span.context.baggage.items():
+                converted.set_baggage_item(key, value)
+            for timestamp, key_values in span.logs:
+                converted.log_kv(key_values, timestamp)
+
+            converted.finish(span.finish_time)
+            contexts[span.span_id] = converted.context
+
+
+class FanOutTracer(opentracing.Tracer):
+    """
+    An OpenTracing tracer sending every trace to several destinations,
+    e.g. two tracing vendors during a migration. The request is only
+    instrumented once: the context is extracted once and the spans are
+    started, tagged and logged once, into RecordedSpans, and the spans
+    of a local trace are only handed to the destinations when its root
+    span finishes, in one batch. Each destination then applies its own
+    sample rate and converts the spans it keeps, so an additional
+    backend only costs its export.
+    The context is propagated as a W3C traceparent header, along with
+    'ot-baggage-*' headers for the baggage.
+    @param destinations the Destination objects, or plain exporters
+    (exporting all the traces)
+    @param max_pending the maximum number of local traces waiting for
+    their root span to finish, the oldest one being exported as is
+    beyond it
+    """
+    def __init__(self, destinations, scope_manager=None,
+                 max_pending=DEFAULT_MAX_PENDING):
+        super(FanOutTracer, self).__init__(
+            scope_manager or ThreadLocalScopeManager())
+        self.destinations = [
+            dest if isinstance(dest, Destination) else Destination(dest)
+            for dest in destinations]
+        self.max_pending = max_pending
+        self._pending = {}
+        self._random = random.Random()
+        self._sequence = itertools.count()
+
+    def start_active_span(self,
+                          operation_name,
+                          child_of=None,
+                          references=None,
+                          tags=None,
+                          start_time=None,
+                          ignore_active_span=False,
+                          finish_on_close=True):
+        span = self.start_span(operation_name,
+                               child_of=child_of,
+                               references=references,
+                               tags=tags,
+                               start_time=start_time,
+                               ignore_active_span=ignore_active_span)
+        return self.scope_manager.activate(span, finish_on_close)
+
+    def start_span(self,
+                   operation_name=None,
+                   child_of=None,
+                   references=None,
+                   tags=None,
+                   start_time=None,
+                   ignore_active_span=False):
+        parent = child_of
+        if parent is None and references:
+            parent = references[0].referenced_context
+        if parent is None and not ignore_active_span:
+            active = self.active_span
+            if active is not None:
+                parent = active
+        if isinstance(parent, opentracing.Span):
+            parent = parent.context
+
+        span_id = self._random.getrandbits(64)
+        if parent is None:
+            context = RecordedSpanContext(self._random.getrandbits(128),
+                                          span_id, root_id=span_id)
+            parent_id = None
+        else:
+            # the baggage is shared, and only copied when
+            # an item is set (see with_baggage_item()).
+            context = RecordedSpanContext(parent.trace_id, span_id,
+                                          parent.sampled, parent.baggage,
+                                          parent.root_id or span_id)
+            parent_id = parent.span_id
+
+        span = RecordedSpan(self, context, operation_name, parent_id,
+                            start_time or time.time(), tags,
+                            next(self._sequence))
+        if context.root_id == span_id and context.sampled:
+            self._add_pending(span_id)
+
+        return span
+
+    def _add_pending(self, root_id):
+        pending = self._pending
+        pending[root_id] = []
+        while len(pending) > self.max_pending:
+            try:
+                oldest = next(iter(pending))
+                spans = pending.pop(oldest)
+            except (KeyError, RuntimeError, StopIteration):
+                break  # emptied, or changed, by another thread.
+            if spans:
+                self._export(spans)
+
+    def _span_finished(self, span):
+        context = span.context
+        if not context.sampled:
+            return
+
+        if context.root_id != context.span_id:
+            spans = self._pending.get(context.root_id)
+            if spans is not None:
+                spans.append(span)
+            else:  # finished after its local root.
+                self._export([span])
+            return
+
+        spans = self._pending.pop(context.span_id, None) or []
+        spans.append(span)
+        self._export(spans)
+
+    def _export(self, spans):
+        # in start order, which puts the parents before their children.
+        if len(spans) > 1:
+            spans.sort(key=lambda span: span.sequence)
+        for destination in self.destinations:
+            destination.export(spans)
+
+    def get_stats(self):
+        """
+        Returns the number of traces exported, and of failed exports,
+        per destination.
+        """
+        return dict((dest.name, {'exported': dest.exported,
+                                 'errors': dest.errors})
+                    for dest in self.destinations)
+
+    def inject(self, span_context, format, carrier):
+        if format not in (opentracing.Format.HTTP_HEADERS,
+                          opentracing.Format.TEXT_MAP):
+            raise opentracing.UnsupportedFormatException(format)
+
+        carrier[TRACEPARENT] = '00-%032x-%016x-%s' % (
+            span_context.trace_id, span_context.span_id,
+            '01' if span_context.sampled else '00')
+        for key, value in span_context.baggage.items():
+            carrier[BAGGAGE_PREFIX + key] = value
+
+    def extract(self, format, carrier):
+        if format not in (opentracing.Format.HTTP_HEADERS,
+                          opentracing.Format.TEXT_MAP):
+            raise opentracing.UnsupportedFormatException(format)
+
+        traceparent = None
+        baggage = {}
+        for key, value in carrier.items():
+            key = key.lower()
+            if key == TRACEPARENT:
+                traceparent = value
+            elif key.startswith(BAGGAGE_PREFIX):
+                baggage[key[len(BAGGAGE_PREFIX):]] = value
+
+        if traceparent is None:
+            return None
+
+        try:
+            version, trace_id, span_id, flags = traceparent.strip().split('-')
+            trace_id = int(trace_id, 16)
+            span_id = int(span_id, 16)
+            sampled = bool(int(flags, 16) & 1)
+        except ValueError:
+            raise opentracing.SpanContextCorruptedException(traceparent)
+
+        return RecordedSpanContext(trace_id, span_id, sampled, baggage)
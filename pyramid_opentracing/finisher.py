@@ -0,0 +1,152 @@
+import threading
+
+try:
+    from queue import Full, Queue
+except ImportError:  # Python 2.
+    from Queue import Full, Queue
+
+from pyramid.settings import asbool, falsey, truthy
+
+
+DEFERRED_RESPONSE = 'response'
+DEFERRED_BACKGROUND = 'background'
+DEFERRED_MODES = (DEFERRED_RESPONSE, DEFERRED_BACKGROUND)
+
+DEFAULT_MAX_QUEUE = 10000
+
+
+class _Once(object):
+    def __init__(self, func):
+        self.func = func
+
+    def __call__(self, *args):
+        func, self.func = self.func, None
+        if func is not None:
+            func()
+
+
+class _ClosingIterable(object):
+    """
+    Wraps the body of a response to call back once the WSGI server
+    closes it, after it was sent.
+    """
+    def __init__(self, app_iter, callback):
+        self.app_iter = app_iter
+        self.callback = callback
+
+    def __iter__(self):
+        return iter(self.app_iter)
+
+    def close(self):
+        try:
+            close = getattr(self.app_iter, 'close', None)
+            if close is not None:
+                close()
+        finally:
+            self.callback()
+
+
+class ResponseFinisher(object):
+    """
+    Completes the tracing of the requests once their response has been
+    sent, i.e. when the WSGI server closes its body, or at the end of
+    the request (see request.add_finished_callback()) if there is no
+    response, or its body was replaced after leaving the tween.
+    """
+    def defer(self, request, response, finish):
+        finish = _Once(finish)
+        app_iter = getattr(response, 'app_iter', None)
+        if app_iter is None:
+            request.add_finished_callback(finish)
+            return
+
+        # the app_iter setter drops the Content-Length header.
+        content_length = response.content_length
+        wrapper = _ClosingIterable(app_iter, finish)
+        response.app_iter = wrapper
+        response.content_length = content_length
+
+        def finish_if_replaced(request):
+            if response.app_iter is not wrapper:
+                finish()
+
+        request.add_finished_callback(finish_if_replaced)
+
+
+class BackgroundFinisher(object):
+    """
+    Completes the tracing of the requests in a background thread,
+    started with the first request (and so, after the workers fork).
+    Beyond max_queue pending requests, the tracing is completed right
+    away, as it would without a finisher.
+    """
+    def __init__(self, max_queue=DEFAULT_MAX_QUEUE):
+        self._queue = Queue(max_queue)
+        self._thread = None
+        self._lock = threading.Lock()
+        self.overflows = 0
+        self.errors = 0
+
+    def defer(self, request, response, finish):
+        thread = self._thread
+        if thread is None or not thread.is_alive():
+            self._start()
+
+        try:
+            self._queue.put_nowait(finish)
+        except Full:
+            self.overflows += 1
+            finish()
+
+    def flush(self):
+        """
+        Waits until the pending requests are completed.
+        """
+        self._queue.join()
+
+    def _start(self):
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive():
+                return
+
+            thread = threading.Thread(target=self._run,
+                                      name='pyramid-opentracing-finisher')
+            thread.daemon = True
+            thread.start()
+            self._thread = thread
+
+    def _run(self):
+        queue = self._queue
+        while True:
+            finish = queue.get()
+            try:
+                finish()
+            except Exception:
+                self.errors += 1
+            finally:
+                queue.task_done()
+
+
+def finisher_from_settings(settings):
+    """
+    Returns the finisher for the 'ot.deferred_finish' setting: 'response'
+    (or true) for a ResponseFinisher, 'background' for a BackgroundFinisher
+    holding at most 'ot.deferred_queue_size' requests, or None if it is
+    false or not set.
+    """
+    value = settings.get('ot.deferred_finish', None)
+    if value is None:
+        return None
+
+    if value == DEFERRED_BACKGROUND:
+        return BackgroundFinisher(int(settings.get('ot.deferred_queue_size',
+                                                   DEFAULT_MAX_QUEUE)))
+
+    if value == DEFERRED_RESPONSE:
+        return ResponseFinisher()
+
+    if isinstance(value, bool) or str(value).lower() in truthy | falsey:
+        return ResponseFinisher() if asbool(value) else None
+
+    raise ValueError('ot.deferred_finish must be one of %s, or a boolean' %
+                     ', '.join(DEFERRED_MODES))
@@ -0,0 +1,48 @@
+class SpanLimits(object):
+    """
+    Per-request limits on the data a single traced request may accumulate.
+    Data over the limits is discarded, and overflow counters are set as
+    tags on the request span. Any limit set to None is disabled.
+    @param max_child_spans maximum number of child spans per request
+    @param max_span_logs maximum number of log_kv() entries per span
+    @param max_tag_bytes maximum total size of the tags, in bytes,
+    per request (keys and values as strings)
+    @param max_span_duration maximum time, in seconds, after which
+    the request stops recording and its open child spans are finished
+    """
+    def __init__(self, max_child_spans=None, max_span_logs=None,
+                 max_tag_bytes=None, max_span_duration=None):
+        self.max_child_spans = max_child_spans
+        self.max_span_logs = max_span_logs
+        self.max_tag_bytes = max_tag_bytes
+        self.max_span_duration = max_span_duration
+
+    def copy(self, **changes):
+        """
+        Returns a copy of these limits, with the given ones changed.
+        """
+        values = {
+            'max_child_spans': self.max_child_spans,
+            'max_span_logs': self.max_span_logs,
+            'max_tag_bytes': self.max_tag_bytes,
+            'max_span_duration': self.max_span_duration,
+        }
+        values.update(changes)
+        return SpanLimits(**values)
+
+    @classmethod
+    def from_settings(cls, settings):
+        """
+        Returns a SpanLimits from the 'ot.max_*' settings,
+        or None if none of them is set.
+        """
+        values = {}
+        for name, conv in (('max_child_spans', int),
+                           ('max_span_logs', int),
+                           ('max_tag_bytes', int),
+                           ('max_span_duration', float)):
+            value = settings.get('ot.' + name, None)
+            if value is not None:
+                values[name] = conv(value)
+
+        return cls(**values) if values else None
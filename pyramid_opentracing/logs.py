@@ -0,0 +1,134 @@
+import collections
+import logging
+
+from pyramid.threadlocal import get_current_request
+
+from ._constants import LOG_BUFFER_ATTR
+from ._ids import is_sampled, span_ids
+
+
+NO_ID = '-'
+DEFAULT_CAPACITY = 100
+
+
+def _get_span(tracing):
+    if tracing._tracer_obj is None and tracing._tracer_factory is not None:
+        return None  # Not created until the first request is traced.
+
+    span = tracing.tracer.active_span
+    if span is not None:
+        return span
+
+    request = get_current_request()
+    if request is None:
+        return None
+
+    return tracing.get_span(request)
+
+
+class TraceContextFilter(logging.Filter):
+    """
+    Logging filter setting the trace_id and span_id attributes of the
+    records to the ids of the active span, or of the current request
+    span, so they can be used in format strings. Records logged outside
+    a traced request get '-' instead.
+    @param tracing the PyramidTracing used to trace the requests
+    """
+    def __init__(self, tracing, name=''):
+        super(TraceContextFilter, self).__init__(name)
+        self.tracing = tracing
+
+    def filter(self, record):
+        span = _get_span(self.tracing)
+        if span is None:
+            record.trace_id = record.span_id = NO_ID
+        else:
+            trace_id, span_id = span_ids(span)
+            record.trace_id = trace_id or NO_ID
+            record.span_id = span_id or NO_ID
+
+        return True
+
+
+class _LogBuffer(object):
+    # the (created, levelname, name, message) of the records,
+    # not the records, which keep their args and exc_info alive.
+    def __init__(self, capacity, slow_threshold):
+        self.records = collections.deque(maxlen=capacity)
+        self.slow_threshold = slow_threshold
+
+    def flush(self, span, failed, duration):
+        """
+        Logs the buffered records to the span if the request failed
+        or was slow, and discards them otherwise.
+        """
+        slow = (self.slow_threshold is not None and
+                duration >= self.slow_threshold)
+        if failed or slow:
+            for entry in self.records:
+                _log_entry(span, entry)
+
+        self.records.clear()
+
+
+def _log_entry(span, entry):
+    created, levelname, name, message = entry
+    span.log_kv({
+        'event': 'log',
+        'level': levelname,
+        'logger': name,
+        'message': message,
+    }, created)
+
+
+class SpanLogHandler(logging.Handler):
+    """
+    Logging handler attaching the records emitted while serving
+    a sampled request to its span, as log_kv() entries.
+    Records at buffer_level or above are attached right away. Records
+    below it are buffered (up to capacity, keeping the latest ones),
+    and only attached when the request failed or took at least
+    slow_threshold seconds.
+    @param tracing the PyramidTracing used to trace the requests
+    @param buffer_level the level under which records are buffered
+    @param slow_threshold the request duration, in seconds, from which
+    the buffered records are attached, or None to attach them on
+    failures only
+    """
+    def __init__(self, tracing, level=logging.NOTSET,
+                 buffer_level=logging.WARNING, capacity=DEFAULT_CAPACITY,
+                 slow_threshold=None):
+        super(SpanLogHandler, self).__init__(level)
+        self.tracing = tracing
+        self.buffer_level = buffer_level
+        self.capacity = capacity
+        self.slow_threshold = slow_threshold
+
+    def emit(self, record):
+        request = get_current_request()
+        if request is None:
+            return
+
+        span = self.tracing.get_span(request)
+        if span is None or not is_sampled(span):
+            return
+
+        # formatted right away, so a bad format string or argument
+        # is reported by the logging module and never fails the request.
+        try:
+            entry = (record.created, record.levelname, record.name,
+                     record.getMessage())
+        except Exception:
+            self.handleError(record)
+            return
+
+        if record.levelno >= self.buffer_level:
+            _log_entry(span, entry)
+            return
+
+        log_buffer = getattr(request, LOG_BUFFER_ATTR, None)
+        if log_buffer is None:
+            log_buffer = _LogBuffer(self.capacity, self.slow_threshold)
+            setattr(request, LOG_BUFFER_ATTR, log_buffer)
+
+        log_buffer.records.append(entry)
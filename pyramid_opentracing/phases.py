@@ -0,0 +1,123 @@
+from pyramid.events import BeforeRender, ContextFound, NewRequest, NewResponse
+from pyramid.settings import asbool, falsey, truthy
+
+from ._constants import CLOCK_ATTR, PHASES_ATTR
+
+
+PHASES_TAGS = 'tags'
+PHASES_SPANS = 'spans'
+PHASE_MODES = (PHASES_TAGS, PHASES_SPANS)
+
+PHASE_TAG = 'pyramid.phase'
+TAG_PREFIX = PHASE_TAG + '.'
+
+# the slots of the per-request array.
+START = 0
+NEW_REQUEST = 1
+CONTEXT_FOUND = 2
+BEFORE_RENDER = 3
+END = 4
+NEW_RESPONSE = 5
+_SLOTS = 6
+
+
+def parse_mode(value):
+    """
+    Returns the phases mode for a setting: 'tags' (or true) to tag the
+    request spans with the phase durations, 'spans' to add a child span
+    per phase, or None if it is false or not set.
+    """
+    if value is None:
+        return None
+
+    if value in PHASE_MODES:
+        return value
+
+    if isinstance(value, bool) or str(value).lower() in truthy | falsey:
+        return PHASES_TAGS if asbool(value) else None
+
+    raise ValueError('ot.phases must be one of %s, or a boolean' %
+                     ', '.join(PHASE_MODES))
+
+
+def start_phases(request, start):
+    """
+    Preallocates the timestamps of a request, so the subscribers
+    only fill them in.
+    @param start the monotonic time tracing started at, see RequestClock
+    """
+    times = [None] * _SLOTS
+    times[START] = start
+    setattr(request, PHASES_ATTR, times)
+    return times
+
+
+def _mark(request, slot):
+    times = getattr(request, PHASES_ATTR, None)
+    if times is not None:
+        times[slot] = getattr(request, CLOCK_ATTR).now()
+
+
+def on_new_request(event):
+    _mark(event.request, NEW_REQUEST)
+
+
+def on_context_found(event):
+    _mark(event.request, CONTEXT_FOUND)
+
+
+def on_before_render(event):
+    # the last one wins, as templates rendered by the view
+    # itself come before the renderer of the view.
+    request = event.get('request')
+    if request is not None:
+        _mark(request, BEFORE_RENDER)
+
+
+def on_new_response(event):
+    _mark(event.request, NEW_RESPONSE)
+
+
+def get_phases(times):
+    """
+    Returns the phases of a request as (name, start, end) monotonic
+    times, leaving out the ones whose events did not fire:
+    'routing' from NewRequest to ContextFound (url dispatch or traversal)
+    'view' from ContextFound (or the start) to BeforeRender (or the end)
+    'render' from BeforeRender to the end
+    'callbacks' from the end to NewResponse (the response callbacks),
+    only known if the span is finished after them
+    """
+    phases = []
+    view_start = times[START]
+    if times[CONTEXT_FOUND] is not None:
+        view_start = times[CONTEXT_FOUND]
+        if times[NEW_REQUEST] is not None:
+            phases.append(('routing', times[NEW_REQUEST], view_start))
+
+    end = times[END]
+    render_start = times[BEFORE_RENDER]
+    if render_start is not None and render_start >= view_start:
+        phases.append(('view', view_start, render_start))
+        phases.append(('render', render_start, end))
+    else:
+        phases.append(('view', view_start, end))
+
+    if times[NEW_RESPONSE] is not None and times[NEW_RESPONSE] >= end:
+        phases.append(('callbacks', end, times[NEW_RESPONSE]))
+
+    return phases
+
+
+def add_subscribers(config):
+    """
+    Subscribes to the Pyramid events marking the phases of the requests,
+    if 'ot.phases' is set.
+    """
+    if parse_mode(config.get_settings().get('ot.phases', None)) is None:
+        return
+
+    config.add_subscriber(on_new_request, NewRequest)
+    config.add_subscriber(on_context_found, ContextFound)
+    config.add_subscriber(on_before_render, BeforeRender)
+    config.add_subscriber(on_new_response, NewResponse)
@@ -0,0 +1,209 @@
+import threading
+import time
+
+from ._shards import ThreadShards
+
+
+LEVEL_FULL = 0
+LEVEL_REDUCED = 1
+LEVEL_ROOT_ONLY = 2
+LEVEL_OFF = 3
+LEVEL_NAMES = ('full', 'reduced', 'root_only', 'off')
+
+DEFAULT_LOW_WATERMARK = 0.5
+DEFAULT_HOLD = 1.0
+DEFAULT_SMOOTHING = 0.2
+
+_perf_counter = getattr(time, 'perf_counter', time.time)
+
+
+def parse_request_start(value, now=None):
+    """
+    Returns the time, in seconds, a request spent queued before reaching
+    the worker, from an X-Request-Start header value such as 't=<epoch>'
+    in seconds, milliseconds or microseconds. Returns None if unparseable.
+    """
+    if not value:
+        return None
+
+    if value.startswith('t='):
+        value = value[2:]
+
+    try:
+        started = float(value)
+    except ValueError:
+        return None
+
+    if started > 1e14:  # microseconds
+        started /= 1e6
+    elif started > 1e11:  # milliseconds
+        started /= 1e3
+
+    if now is None:
+        now = time.time()
+
+    return max(now - started, 0.0)
+
+
+class PressureMonitor(object):
+    """
+    Tracks the worker pressure (in-flight requests, queue wait and
+    recent latency) and steps tracing down when it is too high:
+    full spans, then reduced tags (no traced attributes nor start span
+    callback), then root-only spans, then no tracing at all.
+
+    The pressure is the highest ratio of any signal to its maximum.
+    The level goes one step down when it reaches 1, and one step back
+    up when it falls under low_watermark, with at least hold seconds
+    between changes so it does not flap.
+
+    Request threads never wait on each other here: the in-flight and
+    per-level counts are kept per thread, the smoothed queue wait and
+    latency tolerate the occasional lost update, and the level is only
+    re-evaluated by whichever thread gets the lock first.
+    @param max_in_flight maximum concurrent requests, or None
+    @param max_queue_wait maximum smoothed X-Request-Start queue wait,
+    in seconds, or None
+    @param max_latency maximum smoothed request latency, in seconds,
+    or None
+    """
+    def __init__(self, max_in_flight=None, max_queue_wait=None,
+                 max_latency=None, low_watermark=DEFAULT_LOW_WATERMARK,
+                 hold=DEFAULT_HOLD, smoothing=DEFAULT_SMOOTHING):
+        self.max_in_flight = max_in_flight
+        self.max_queue_wait = max_queue_wait
+        self.max_latency = max_latency
+        self.low_watermark = low_watermark
+        self.hold = hold
+        self.smoothing = smoothing
+
+        self._lock = threading.Lock()
+        self._shards = ThreadShards(_PressureShard)
+        self.level = LEVEL_FULL
+        self.queue_wait = 0.0
+        self.latency = 0.0
+        self.level_changes = 0
+        self._last_change = _perf_counter()
+
+    @classmethod
+    def from_settings(cls, settings):
+        """
+        Returns a PressureMonitor from the 'ot.max_in_flight',
+        'ot.max_queue_wait', 'ot.max_latency', 'ot.pressure_low_watermark'
+        and 'ot.pressure_hold' settings, or None if no maximum is set.
+        """
+        values = {}
+        for name, conv in (('max_in_flight', int),
+                           ('max_queue_wait', float),
+                           ('max_latency', float),
+                           ('pressure_low_watermark', float),
+                           ('pressure_hold', float)):
+            value = settings.get('ot.' + name, None)
+            if value is not None:
+                values[name.replace('pressure_', '')] = conv(value)
+
+        if not any(name.startswith('max_') for name in values):
+            return None
+
+        return cls(**values)
+
+    @property
+    def in_flight(self):
+        return sum(shard.in_flight for shard in self._shards.all())
+
+    @property
+    def requests(self):
+        """
+        The number of requests started at each level.
+        """
+        requests = [0] * len(LEVEL_NAMES)
+        for shard in self._shards.all():
+            for level, count in enumerate(shard.requests):
+                requests[level] += count
+
+        return requests
+
+    def pressure(self):
+        """
+        Returns the current pressure, 1.0 meaning some maximum was reached.
+        """
+        ratios = [0.0]
+        if self.max_in_flight:
+            ratios.append(self.in_flight / float(self.max_in_flight))
+        if self.max_queue_wait:
+            ratios.append(self.queue_wait / self.max_queue_wait)
+        if self.max_latency:
+            ratios.append(self.latency / self.max_latency)
+
+        return max(ratios)
+
+    def _update_level(self, now):
+        if now - self._last_change < self.hold:
+            return
+
+        # another thread is already at it.
+        if not self._lock.acquire(False):
+            return
+
+        try:
+            self._change_level(now)
+        finally:
+            self._lock.release()
+
+    def _change_level(self, now):
+        pressure = self.pressure()
+        if pressure >= 1.0 and self.level < LEVEL_OFF:
+            self.level += 1
+        elif pressure < self.low_watermark and self.level > LEVEL_FULL:
+            self.level -= 1
+        else:
+            return
+
+        self.level_changes += 1
+        self._last_change = now
+
+    def request_started(self, request):
+        """
+        @param request the incoming request
+        Returns the tracing level to use for it.
+        """
+        queue_wait = None
+        if self.max_queue_wait:
+            queue_wait = parse_request_start(
+                request.headers.get('X-Request-Start'))
+
+        shard = self._shards.get()
+        shard.in_flight += 1
+        if queue_wait is not None:
+            self.queue_wait += self.smoothing * (queue_wait - self.queue_wait)
+
+        self._update_level(_perf_counter())
+        level = self.level
+        shard.requests[level] += 1
+
+        return level
+
+    def request_finished(self, duration):
+        """
+        Must be called from the thread that started the request.
+        @param duration the request duration, in seconds
+        """
+        self._shards.get().in_flight -= 1
+        self.latency += self.smoothing * (duration - self.latency)
+
+    def get_stats(self):
+        return {
+            'level': LEVEL_NAMES[self.level],
+            'pressure': self.pressure(),
+            'in_flight': self.in_flight,
+            'queue_wait': self.queue_wait,
+            'latency': self.latency,
+            'level_changes': self.level_changes,
+            'requests': dict(zip(LEVEL_NAMES, self.requests)),
+        }
+
+
+class _PressureShard(object):
+    def __init__(self):
+        self.in_flight = 0
+        self.requests = [0] * len(LEVEL_NAMES)
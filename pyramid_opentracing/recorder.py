@@ -0,0 +1,142 @@
+import atexit
+import collections
+import gzip
+import json
+import random
+import threading
+
+
+DEFAULT_FLUSH_SIZE = 100
+
+
+def _open(path, mode):
+    if path.endswith('.gz'):
+        return gzip.open(path, mode)
+
+    return open(path, mode)
+
+
+def make_envelope(route, method, headers, status, duration, error=False):
+    """
+    Returns the envelope of a request: its route, method, the names and
+    value sizes of its headers, the response status, the duration in
+    milliseconds and whether it raised an error. Neither the path nor
+    any header value is kept.
+    """
+    envelope = {
+        'r': route,
+        'm': method,
+        'h': [[key, len(value)] for key, value in headers.items()],
+        's': status,
+        'd': round(duration * 1e3, 3),
+    }
+    if error:
+        envelope['e'] = 1
+
+    return envelope
+
+
+def read_envelopes(path):
+    """
+    Returns the envelopes recorded in a file, see EnvelopeRecorder.
+    """
+    with _open(path, 'rb') as f:
+        return [json.loads(line.decode('utf-8')) for line in f
+                if line.strip()]
+
+
+class EnvelopeRecorder(object):
+    """
+    Records anonymised envelopes of the traced requests (see
+    make_envelope()) into a file, one JSON object per line, or gzipped
+    if the path ends with '.gz', so the actual traffic shape can be
+    replayed through the tween later on (see the replay module).
+    The envelopes are buffered and appended to the file by batches,
+    from a background thread started with the first full batch (and so,
+    after the workers fork), and when the process exits.
+    @param path the file the envelopes are appended to
+    @param sample_rate the fraction of the requests to record
+    @param flush_size the number of envelopes written at once
+    """
+    def __init__(self, path, sample_rate=1.0, flush_size=DEFAULT_FLUSH_SIZE):
+        self.path = path
+        self.sample_rate = sample_rate
+        self.flush_size = flush_size
+        self._buffer = collections.deque()
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._thread = None
+        self._thread_lock = threading.Lock()
+        self.errors = 0
+        atexit.register(self.flush)
+
+    @classmethod
+    def from_settings(cls, settings):
+        """
+        Returns an EnvelopeRecorder from the 'ot.record_path' and
+        'ot.record_sample_rate' settings, or None if no path is set.
+        """
+        path = settings.get('ot.record_path', None)
+        if not path:
+            return None
+
+        return cls(path, float(settings.get('ot.record_sample_rate', 1.0)))
+
+    def record(self, request, route, status, duration):
+        """
+        Records the envelope of a request, if it is part of the sample.
+        @param route the route (or operation) name
+        @param status the response status, or None if the request raised
+        an error
+        @param duration the request duration, in seconds
+        """
+        if self.sample_rate < 1.0 and random.random() >= self.sample_rate:
+            return
+
+        error = status is None
+        self._buffer.append(make_envelope(route, request.method,
+                                          request.headers,
+                                          500 if error else status,
+                                          duration, error))
+        if len(self._buffer) >= self.flush_size:
+            # written by the background thread, off the request.
+            thread = self._thread
+            if thread is None or not thread.is_alive():
+                self._start()
+            self._wake.set()
+
+    def flush(self):
+        """
+        Appends the buffered envelopes to the file.
+        """
+        buffer = self._buffer
+        with self._lock:
+            lines = []
+            while buffer:
+                lines.append(json.dumps(buffer.popleft(),
+                                        separators=(',', ':')))
+            if not lines:
+                return
+
+            with _open(self.path, 'ab') as f:
+                f.write(('\n'.join(lines) + '\n').encode('utf-8'))
+
+    def _start(self):
+        with self._thread_lock:
+            if self._thread is not None and self._thread.is_alive():
+                return
+
+            thread = threading.Thread(target=self._run,
+                                      name='pyramid-opentracing-recorder')
+            thread.daemon = True
+            thread.start()
+            self._thread = thread
+
+    def _run(self):
+        while True:
+            self._wake.wait()
+            self._wake.clear()
+            try:
+                self.flush()
+            except Exception:
+                self.errors += 1
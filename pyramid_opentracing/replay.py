@@ -0,0 +1,181 @@
+"""
+Replays the request envelopes recorded by EnvelopeRecorder through the
+tween, in-process and as fast as possible, and reports the tracing
+overhead per route: every pass runs the requests through the tween
+with tracing disabled, then enabled with the given settings.
+
+    $ python -m pyramid_opentracing.replay envelopes.jsonl [--repeat 5]
+        [--setting ot.max_child_spans=100 ...] [--tracer module.tracer]
+"""
+import argparse
+import collections
+import sys
+import time
+
+from opentracing.mocktracer import MockTracer
+from pyramid.config import Configurator
+from pyramid.request import Request
+from pyramid.response import Response
+
+from .recorder import read_envelopes
+from .tracing import PyramidTracing
+from .tween_factory import _get_callable_from_name, opentracing_tween_factory
+
+
+ENVELOPE_KEY = 'ot.replay.envelope'
+DEFAULT_REPEAT = 3
+
+# the trace context and baggage headers of the common tracers, which
+# cannot be refilled with placeholder values.
+PROPAGATION_PREFIXES = ('ot-tracer-', 'ot-baggage-', 'uberctx-',
+                        'uber-trace-id', 'traceparent', 'tracestate',
+                        'baggage', 'x-b3-', 'b3')
+
+_perf_counter = getattr(time, 'perf_counter', time.time)
+
+
+class ReplayError(Exception):
+    """
+    Raised by the replayed requests that failed when recorded.
+    """
+
+
+class _Route(object):
+    def __init__(self, name):
+        self.name = name
+
+
+def build_request(envelope, registry=None):
+    """
+    Rebuilds a request from its envelope, with header values of the
+    recorded sizes. The propagation headers are left out, so the
+    requests start new traces.
+    """
+    headers = dict((key, 'x' * size) for key, size in envelope['h']
+                   if not key.lower().startswith(PROPAGATION_PREFIXES))
+    request = Request.blank('/', headers=headers)
+    request.registry = registry
+    request.method = envelope['m']
+    request.environ[ENVELOPE_KEY] = envelope
+    request.matched_route = _Route(envelope['r'])
+    return request
+
+
+def replay_handler(request):
+    """
+    Stands in for the application: returns a response with the recorded
+    status, or raises ReplayError if the request failed.
+    """
+    envelope = request.environ[ENVELOPE_KEY]
+    if envelope.get('e'):
+        raise ReplayError(envelope['r'])
+
+    request.response.status_code = envelope['s']
+    return Response(status=envelope['s'])
+
+
+def _make_tween(settings, tracer):
+    settings = dict(settings)
+    settings.setdefault('ot.tracing', PyramidTracing(tracer))
+    registry = Configurator(settings=settings).registry
+    return opentracing_tween_factory(replay_handler, registry), registry
+
+
+def _run(tween, registry, envelopes, totals):
+    requests = [build_request(envelope, registry) for envelope in envelopes]
+    for request in requests:
+        start = _perf_counter()
+        try:
+            tween(request)
+        except ReplayError:
+            pass
+        totals[request.matched_route.name] += _perf_counter() - start
+
+
+def replay(envelopes, settings=None, repeat=DEFAULT_REPEAT, tracer=None):
+    """
+    Replays the envelopes, repeat times, through the tween with tracing
+    disabled and enabled, and returns the seconds spent per route in
+    either case, as a dictionary of
+    {route: {'requests': n, 'baseline': seconds, 'traced': seconds}},
+    the requests being counted once.
+    @param settings the settings of the traced tween
+    @param tracer the tracer, defaults to a MockTracer, reset after
+    every pass
+    """
+    if tracer is None:
+        tracer = MockTracer()
+
+    settings = dict(settings or {})
+    baseline_tween, baseline_registry = _make_tween(
+        dict(settings, **{'ot.trace_all': 'false'}), tracer)
+    traced_tween, traced_registry = _make_tween(
+        dict(settings, **{'ot.trace_all': 'true'}), tracer)
+
+    baseline_totals = collections.defaultdict(float)
+    traced_totals = collections.defaultdict(float)
+    for _ in range(repeat):
+        _run(baseline_tween, baseline_registry, envelopes, baseline_totals)
+        _run(traced_tween, traced_registry, envelopes, traced_totals)
+        if hasattr(tracer, 'reset'):
+            tracer.reset()
+
+    counts = collections.Counter(envelope['r'] for envelope in envelopes)
+    return dict((route, {
+        'requests': count,
+        'baseline': baseline_totals[route] / repeat,
+        'traced': traced_totals[route] / repeat,
+    }) for route, count in counts.items())
+
+
+def format_report(results):
+    """
+    Returns the per-route overhead, the most requested routes first.
+    """
+    lines = ['%-32s %9s %12s %12s %12s %8s' % (
+        'route', 'requests', 'baseline us', 'traced us', 'overhead us',
+        'overhead')]
+    total = {'requests': 0, 'baseline': 0.0, 'traced': 0.0}
+    rows = sorted(results.items(), key=lambda item: -item[1]['requests'])
+    for route, result in rows + [('TOTAL', total)]:
+        count = result['requests']
+        baseline = result['baseline'] / count * 1e6
+        traced = result['traced'] / count * 1e6
+        lines.append('%-32s %9d %12.1f %12.1f %12.1f %7.1f%%' % (
+            route[:32], count, baseline, traced, traced - baseline,
+            (traced - baseline) / baseline * 100 if baseline else 0.0))
+
+        if result is not total:
+            for key in total:
+                total[key] += result[key]
+
+    return '\n'.join(lines)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Replays recorded request envelopes through the '
+                    'tween and reports the tracing overhead per route.')
+    parser.add_argument('path', help='the recorded envelopes')
+    parser.add_argument('--repeat', type=int, default=DEFAULT_REPEAT)
+    parser.add_argument('--setting', action='append', default=[],
+                        metavar='KEY=VALUE',
+                        help='a setting of the traced tween')
+    parser.add_argument('--tracer', default=None,
+                        help='the dotted name of the tracer to use')
+    args = parser.parse_args(argv)
+
+    settings = dict(setting.split('=', 1) for setting in args.setting)
+    tracer = None
+    if args.tracer is not None:
+        tracer = _get_callable_from_name(args.tracer)
+
+    envelopes = read_envelopes(args.path)
+    if not envelopes:
+        parser.error('no envelopes in %s' % args.path)
+
+    print(format_report(replay(envelopes, settings, args.repeat, tracer)))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
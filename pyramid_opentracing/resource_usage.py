@@ -0,0 +1,150 @@
+import gc
+import threading
+import time
+
+try:
+    import resource
+except ImportError:  # Not available on Windows.
+    resource = None
+
+try:
+    import tracemalloc
+except ImportError:  # Python 2.
+    tracemalloc = None
+
+
+_perf_counter = getattr(time, 'perf_counter', time.time)
+_thread_time_ns = getattr(time, 'thread_time_ns', None)
+_RUSAGE_THREAD = getattr(resource, 'RUSAGE_THREAD', None)
+
+# Cumulative gc pause time (ns) and collection count, process-wide.
+# A collection stops every thread holding the GIL, so the delta seen
+# between two snapshots is the time the request was stalled by gc.
+_gc_state = {
+    'pause_ns': 0,
+    'collections': 0,
+    'started': None,
+}
+_gc_lock = threading.Lock()
+
+
+def _gc_callback(phase, info):
+    if phase == 'start':
+        _gc_state['started'] = _perf_counter()
+    elif _gc_state['started'] is not None:
+        elapsed = _perf_counter() - _gc_state['started']
+        _gc_state['started'] = None
+        _gc_state['pause_ns'] += int(elapsed * 1e9)
+        _gc_state['collections'] += 1
+
+
+def _install_gc_callback():
+    callbacks = getattr(gc, 'callbacks', None)
+    if callbacks is None:  # Python 2.
+        return
+
+    with _gc_lock:
+        if _gc_callback not in callbacks:
+            callbacks.append(_gc_callback)
+
+
+class ResourceUsage(object):
+    """
+    Takes cheap per-thread resource snapshots at the start of a request
+    and converts their deltas into span tags at its end.
+    @param trace_memory whether to report the tracemalloc peak; starts
+    tracemalloc if it is not already tracing. The peak is process-wide,
+    so it is only reported for the requests served while no other one
+    was in flight.
+    """
+    def __init__(self, trace_memory=False):
+        self._trace_memory = trace_memory and tracemalloc is not None
+        self._reset_peak = getattr(tracemalloc, 'reset_peak', None)
+        self._mem_lock = threading.Lock()
+        self._in_flight = 0
+        self._starts = 0
+
+        _install_gc_callback()
+        if self._trace_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    def snapshot(self):
+        """
+        Returns an opaque tuple to be passed to delta() later on,
+        from the same thread.
+        """
+        cpu_ns = None
+        if _thread_time_ns is not None:
+            cpu_ns = _thread_time_ns()
+
+        rusage = None
+        if _RUSAGE_THREAD is not None:
+            rusage = resource.getrusage(_RUSAGE_THREAD)
+
+        mem = None
+        if self._trace_memory:
+            mem = self._start_memory()
+
+        return (_perf_counter(), cpu_ns, rusage,
+                _gc_state['pause_ns'], _gc_state['collections'], mem)
+
+    def delta(self, start):
+        """
+        @param start the snapshot taken at the start of the request
+        Returns a dictionary of tags with the resources consumed since
+        the snapshot was taken.
+        """
+        wall, cpu_ns, rusage, gc_pause_ns, gc_count, mem = start
+        wall_ms = (_perf_counter() - wall) * 1e3
+        result = {
+            'resource.wall_ms': wall_ms,
+            'resource.gc_pause_ms': (_gc_state['pause_ns'] -
+                                     gc_pause_ns) / 1e6,
+            'resource.gc_collections': _gc_state['collections'] - gc_count,
+        }
+
+        if cpu_ns is not None:
+            cpu_ms = (_thread_time_ns() - cpu_ns) / 1e6
+            result['resource.cpu_ms'] = cpu_ms
+            result['resource.off_cpu_ms'] = max(wall_ms - cpu_ms, 0.0)
+
+        if rusage is not None:
+            now = resource.getrusage(_RUSAGE_THREAD)
+            result['resource.user_ms'] = (now.ru_utime -
+                                          rusage.ru_utime) * 1e3
+            result['resource.system_ms'] = (now.ru_stime -
+                                            rusage.ru_stime) * 1e3
+            result['resource.voluntary_ctx_switches'] = (now.ru_nvcsw -
+                                                         rusage.ru_nvcsw)
+
+        if mem is not None:
+            peak = self._finish_memory(*mem)
+            if peak is not None:
+                result['resource.mem_peak_bytes'] = peak
+
+        return result
+
+    def _start_memory(self):
+        # (the current memory if no other request is in flight,
+        # the number of requests started so far).
+        with self._mem_lock:
+            self._in_flight += 1
+            self._starts += 1
+            if self._in_flight > 1:
+                return None, self._starts
+
+            if self._reset_peak is not None:
+                self._reset_peak()
+            return tracemalloc.get_traced_memory()[0], self._starts
+
+    def _finish_memory(self, mem, starts):
+        with self._mem_lock:
+            self._in_flight -= 1
+            # another request started since, and may have
+            # allocated, or reset the peak.
+            if mem is None or starts != self._starts:
+                return None
+
+            peak = tracemalloc.get_traced_memory()[1]
+
+        return max(peak - mem, 0)
@@ -0,0 +1,96 @@
+from pyramid.settings import asbool, aslist
+
+from ._ids import is_sampled, traceresponse, span_ids
+
+
+TRACERESPONSE = 'traceresponse'
+TRACE_ID = 'x-trace-id'
+SERVER_TIMING = 'server-timing'
+HEADERS = (TRACERESPONSE, TRACE_ID, SERVER_TIMING)
+
+TRACE_ID_HEADER = 'X-Trace-Id'
+SERVER_TIMING_HEADER = 'Server-Timing'
+DEFAULT_TIMING_NAME = 'total'
+
+
+class ResponseHeaders(object):
+    """
+    Adds the trace context and timings of traced requests to their
+    responses, so clients, CDNs and edge logs can link them to traces:
+    'traceresponse' the W3C trace context of the request span, with
+    its sampled flag
+    'x-trace-id' the trace id, for sampled requests only
+    'server-timing' the request duration, measured from the moment
+    tracing started, and any additional timings, in milliseconds
+    The encoded trace context is cached per span.
+    @param headers the headers to add, defaults to all of them
+    @param timing_name the name of the duration in Server-Timing
+    """
+    def __init__(self, headers=HEADERS, timing_name=DEFAULT_TIMING_NAME):
+        headers = [header.lower() for header in headers]
+        for header in headers:
+            if header not in HEADERS:
+                raise ValueError('Unknown response header %r, must be one '
+                                 'of %s' % (header, ', '.join(HEADERS)))
+
+        self.traceresponse = TRACERESPONSE in headers
+        self.trace_id = TRACE_ID in headers
+        self.server_timing = SERVER_TIMING in headers
+        self._timing_prefix = '%s;dur=' % timing_name
+
+    @classmethod
+    def from_settings(cls, settings):
+        """
+        Returns a ResponseHeaders from the 'ot.response_headers' setting,
+        either true (for all of them) or a list of headers, or None
+        if it is not set.
+        """
+        value = settings.get('ot.response_headers', None)
+        if value is None:
+            return None
+
+        headers = aslist(value)
+        if len(headers) == 1 and headers[0].lower() not in HEADERS:
+            return cls() if asbool(headers[0]) else None
+
+        return cls(headers)
+
+    def inject(self, span, response, duration, timings=None):
+        """
+        Sets the headers on the response.
+        @param span the request span
+        @param response the response
+        @param duration the request duration, in seconds
+        @param timings an optional list of additional (name, seconds)
+        timings for Server-Timing
+        """
+        headers = response.headers
+
+        if self.traceresponse:
+            value = traceresponse(span)
+            if value is not None:
+                headers[TRACERESPONSE] = value
+
+        if self.trace_id and is_sampled(span):
+            trace_id = span_ids(span)[0]
+            if trace_id is not None:
+                headers[TRACE_ID_HEADER] = trace_id
+
+        if self.server_timing:
+            value = '%s%.3f' % (self._timing_prefix, duration * 1e3)
+            if timings:
+                value += ''.join(', %s;dur=%.3f' % (name, seconds * 1e3)
+                                 for name, seconds in timings)
+            self._add_server_timing(headers, value)
+
+    def _add_server_timing(self, headers, value):
+        # after the entries the application may have set.
+        add = getattr(headers, 'add', None)
+        if add is not None:
+            add(SERVER_TIMING_HEADER, value)
+            return
+
+        existing = headers.get(SERVER_TIMING_HEADER)
+        if existing:
+            value = '%s, %s' % (existing, value)
+        headers[SERVER_TIMING_HEADER] = value
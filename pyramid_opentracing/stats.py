@@ -0,0 +1,63 @@
+from ._shards import ThreadShards
+
+
+class RouteStats(object):
+    """
+    In-process per-route aggregates of the resources consumed by
+    traced requests. Routes are keyed by their operation name.
+    Every thread accumulates into its own shard, which snapshot()
+    merges, so recording never waits on other threads.
+    """
+    def __init__(self):
+        self._shards = ThreadShards(dict)
+
+    def record(self, route, values, error=False):
+        """
+        @param route the route (or operation) name
+        @param values a dictionary of numeric values to accumulate,
+        as returned by ResourceUsage.delta()
+        @param error whether the request failed
+        """
+        routes = self._shards.get()
+        entry = routes.get(route)
+        if entry is None:
+            entry = routes[route] = ({'count': 0, 'errors': 0}, {})
+
+        # the number of requests each value was reported for, as some
+        # are not for every request (e.g. resource.mem_peak_bytes).
+        totals, samples = entry
+        totals['count'] += 1
+        if error:
+            totals['errors'] += 1
+
+        for key, value in values.items():
+            totals[key] = totals.get(key, 0) + value
+            samples[key] = samples.get(key, 0) + 1
+
+    def snapshot(self):
+        """
+        Returns a copy of the aggregates, with the averages of every
+        accumulated value over the requests it was reported for.
+        """
+        routes = {}
+        route_samples = {}
+        for shard in self._shards.all():
+            for route, (totals, samples) in list(shard.items()):
+                entry = routes.setdefault(route, {})
+                for key, value in list(totals.items()):
+                    entry[key] = entry.get(key, 0) + value
+
+                counts = route_samples.setdefault(route, {})
+                for key, value in list(samples.items()):
+                    counts[key] = counts.get(key, 0) + value
+
+        for route, entry in routes.items():
+            for key, count in route_samples[route].items():
+                if count and key in entry:  # Else being recorded.
+                    entry[key + '.avg'] = entry[key] / float(count)
+
+        return routes
+
+    def reset(self):
+        for shard in self._shards.all():
+            shard.clear()
@@ -0,0 +1,118 @@
+import functools
+import weakref
+
+import opentracing
+from opentracing.ext import tags
+
+
+DEFAULT_HEADERS_KWARG = 'trace_headers'
+
+# Injected headers per span context, so enqueuing many tasks from
+# the same span only serializes its context once. Setting a baggage
+# item replaces the context of a span, and so, its headers.
+_context_headers = weakref.WeakKeyDictionary()
+
+
+def inject_task_headers(tracing, span=None):
+    """
+    Returns a dictionary with the context of a span, to be sent
+    along with a task (e.g. as Celery or RQ headers or as part of
+    a queue.Queue item).
+    @param tracing the PyramidTracing tracing the requests
+    @param span the span to propagate, defaults to the active one
+    Returns an empty dictionary if there is no span.
+    """
+    if span is None:
+        span = tracing.tracer.active_span
+        if span is None:
+            return {}
+
+    context = span.context
+    try:
+        headers = _context_headers.get(context)
+    except TypeError:  # Not weak-referenceable.
+        headers = None
+
+    if headers is None:
+        headers = {}
+        tracing.tracer.inject(context, opentracing.Format.TEXT_MAP, headers)
+        try:
+            _context_headers[context] = headers
+        except TypeError:
+            pass
+
+    return dict(headers)
+
+
+def _extract(tracer, headers):
+    if not headers:
+        return None
+
+    try:
+        return tracer.extract(opentracing.Format.TEXT_MAP, headers)
+    except (opentracing.InvalidCarrierException,
+            opentracing.SpanContextCorruptedException):
+        return None
+
+
+def start_task_span(tracing, operation_name, headers_list):
+    """
+    Starts and activates a span processing the tasks enqueued with the
+    given headers, following from each of their spans. A single span
+    can process a whole batch of tasks this way.
+    @param tracing the PyramidTracing tracing the requests
+    @param operation_name the operation name of the span
+    @param headers_list the headers of every processed task
+    Returns the Scope of the span.
+    """
+    tracer = tracing.tracer
+    references = []
+    for headers in headers_list:
+        span_ctx = _extract(tracer, headers)
+        if span_ctx is not None:
+            references.append(opentracing.follows_from(span_ctx))
+
+    scope = tracer.start_active_span(operation_name,
+                                     references=references or None,
+                                     ignore_active_span=True)
+    scope.span.set_tag(tags.COMPONENT, 'pyramid')
+    scope.span.set_tag(tags.SPAN_KIND, tags.SPAN_KIND_CONSUMER)
+    if len(headers_list) > 1:
+        scope.span.set_tag('task.batch_size', len(headers_list))
+
+    return scope
+
+
+def trace_task(tracing, operation_name=None,
+               headers_kwarg=DEFAULT_HEADERS_KWARG, batch=False):
+    """
+    Function decorator tracing a task, with a span following from the
+    span that enqueued it. The headers returned by inject_task_headers()
+    are taken from (and removed from) the headers_kwarg keyword argument.
+    If batch is True, headers_kwarg is expected to be a list of headers,
+    one per processed task.
+    """
+    def decorator(func):
+        name = operation_name or func.__name__
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            headers = kwargs.pop(headers_kwarg, None)
+            if batch:
+                headers_list = headers or []
+            else:
+                headers_list = [headers]
+
+            scope = start_task_span(tracing, name, headers_list)
+            try:
+                r = func(*args, **kwargs)
+            except Exception as e:
+                tracing._log_error(scope.span, e)
+                scope.close()
+                raise
+
+            scope.close()
+            return r
+
+        return wrapper
+    return decorator
@@ -1,14 +1,65 @@
+import json
+import logging
 import mock
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
 import unittest
+import weakref
 from pyramid import testing
+from pyramid.config import Configurator
+from pyramid.events import BeforeRender, ContextFound, NewRequest, NewResponse
+from pyramid.request import Request
+from pyramid.response import Response
+from pyramid.threadlocal import manager
+from pyramid.httpexceptions import HTTPNotFound
 from pyramid.tweens import INGRESS
 import opentracing
 from opentracing.ext import tags
 from opentracing.mocktracer import MockTracer
+from opentracing.mocktracer.context import SpanContext as MockSpanContext
 from opentracing.scope_managers import ThreadLocalScopeManager
 
+from ._request_tracer import SpanRecord
+from .analysis import critical_path, self_times, summarize, summary_tags
+from .attributes import TracedAttribute, compile_attributes, compile_getter
+from .baggage import BaggagePolicy
+from .cardinality import CardinalityLimiter, HyperLogLog
+from .clock import Clock
+from .dependencies import DependencyGraph, LatencySketch
+from .errors import ErrorRecorder
+from .exemplars import ExemplarTable
+from .fanout import Destination, FanOutTracer, TracerExporter
+from .finisher import (
+    BackgroundFinisher,
+    ResponseFinisher,
+    finisher_from_settings,
+)
+from .limits import SpanLimits
+from .logs import SpanLogHandler, TraceContextFilter
+from .phases import (
+    get_phases,
+    on_before_render,
+    on_context_found,
+    on_new_request,
+    on_new_response,
+    parse_mode,
+)
+from .pressure import PressureMonitor, parse_request_start
+from .recorder import EnvelopeRecorder, read_envelopes
+from .replay import format_report, main as replay_main, replay
+from .resource_usage import ResourceUsage
+from .response_headers import ResponseHeaders
+from .stats import RouteStats
+from .tasks import inject_task_headers
+from .timeline import TraceBuffer
 from .tracing import PyramidTracing
 from .tween_factory import includeme, opentracing_tween_factory
+from .views import dependencies_view, exemplars_view, timeline_view
 
 
 class TestPyramidTracing(unittest.TestCase):
@@ -35,6 +86,38 @@ class TestPyramidTracing(unittest.TestCase):
         with self.assertRaises(ValueError):
             PyramidTracing(MockTracer(), start_span_cb=4)
 
+    def test_ctor_tracer_factory(self):
+        tracer = MockTracer()
+        calls = []
+
+        def factory():
+            calls.append(1)
+            return tracer
+
+        tracing = PyramidTracing(tracer_factory=factory)
+        self.assertEqual([], calls, '#A0')
+        self.assertEqual(tracer, tracing.tracer, '#A1')
+        self.assertEqual(tracer, tracing.tracer, '#A2')
+        self.assertEqual([1], calls, '#A3')
+
+    def test_ctor_tracer_factory_error(self):
+        with self.assertRaises(ValueError):
+            PyramidTracing(tracer_factory=4)
+
+    def test_lazy_import(self):
+        code = ('import sys, pyramid_opentracing; '
+                'assert "pyramid_opentracing.tracing" not in sys.modules; '
+                'assert "pyramid" not in sys.modules; '
+                'pyramid_opentracing.PyramidTracing; '
+                'assert "pyramid_opentracing.tracing" in sys.modules')
+        subprocess.check_call([sys.executable, '-c', code])
+
+        import pyramid_opentracing
+        self.assertEqual(PyramidTracing, pyramid_opentracing.PyramidTracer)
+        self.assertEqual(includeme, pyramid_opentracing.includeme)
+        with self.assertRaises(AttributeError):
+            pyramid_opentracing.DoesNotExist
+
     def test_get_span_none(self):
         tracing = PyramidTracing(MockTracer())
         self.assertIsNone(tracing.get_span(DummyRequest()), '#A0')
@@ -161,6 +244,580 @@ class TestPyramidTracing(unittest.TestCase):
             'path': '/',
         }, span.tags, '#C0')
 
+    def test_apply_tracing_attr_specs(self):
+        tracing = PyramidTracing(MockTracer())
+        req = DummyRequest(path='/users/1', params={'page': '2'},
+                           headers={'User-Agent': 'curl/7.0'},
+                           environ={'REMOTE_ADDR': '10.0.0.1'})
+        req.matchdict = {'id': '1'}
+
+        span = tracing._apply_tracing(req, compile_attributes([
+            'headers[User-Agent]|tag=http.user_agent|max_length=4',
+            'matchdict.id|tag=user.id',
+            'params.page',
+            'environ.REMOTE_ADDR|redact',
+            'headers[User-Agent]|tag=ua.hash|hash',
+            'headers[Missing]',
+            TracedAttribute('path', tag='http.path'),
+        ]))
+        tracing._finish_tracing(req)
+
+        self.assertEqual('curl', span.tags['http.user_agent'], '#A0')
+        self.assertEqual('1', span.tags['user.id'], '#A1')
+        self.assertEqual('2', span.tags['params.page'], '#A2')
+        self.assertEqual('<redacted>', span.tags['environ.REMOTE_ADDR'])
+        self.assertEqual(16, len(span.tags['ua.hash']), '#A3')
+        self.assertFalse('curl' in span.tags['ua.hash'], '#A4')
+        self.assertFalse('headers[Missing]' in span.tags, '#A5')
+        self.assertEqual('/users/1', span.tags['http.path'], '#A6')
+
+    def test_apply_tracing_attr_sampling(self):
+        tracing = PyramidTracing(MockTracer())
+        attrs = compile_attributes(['path|sample=0', 'method|sample=1',
+                                    'matchdict.id'])
+
+        req = DummyRequest()
+        req.matchdict = None  # No route matched.
+        span = tracing._apply_tracing(req, attrs)
+        tracing._finish_tracing(req)
+        self.assertFalse('path' in span.tags, '#A0')
+        self.assertEqual('GET', span.tags['method'], '#A1')
+        self.assertFalse('matchdict.id' in span.tags, '#A2')
+
+    def test_attr_specs_invalid(self):
+        for spec in ('', 'headers[', 'path|foo', 'path|hash=1',
+                     'path|max_length=x'):
+            with self.assertRaises(ValueError):
+                TracedAttribute.parse(spec)
+
+        with self.assertRaises(ValueError):
+            TracedAttribute('path', policy='foo')
+
+    def test_cardinality(self):
+        tracer = MockTracer()
+        limiter = CardinalityLimiter(max_values=2)
+        tracing = PyramidTracing(tracer, cardinality=limiter,
+                                 resource_usage=True, exemplars=True)
+        attrs = compile_attributes(['path|tag=http.path'])
+
+        for path in ('/1', '/2', '/3', '/4', '/1'):
+            req = DummyRequest(path=path)
+            req.method = 'M' + path  # Made up methods.
+            tracing._apply_tracing(req, attrs)
+            tracing._finish_tracing(req)
+
+        spans = tracer.finished_spans()
+        self.assertEqual(['M/1', 'M/2', '__other__', '__other__', 'M/1'],
+                         [span.operation_name for span in spans], '#A0')
+        self.assertEqual(['/1', '/2', '__other__', '__other__', '/1'],
+                         [span.tags['http.path'] for span in spans], '#A1')
+
+        stats = tracing.get_stats()['cardinality']
+        self.assertEqual({'values': 2, 'estimate': 4, 'overflow': 2},
+                         stats['http.path'], '#B0')
+        # counted once per request.
+        self.assertEqual(2, stats['operation_name']['overflow'], '#B1')
+
+    def test_hyperloglog(self):
+        hll = HyperLogLog()
+        self.assertEqual(0, hll.estimate(), '#A0')
+
+        for n in (100, 10000):
+            for i in range(n):
+                hll.add('/users/%d' % i)
+                hll.add('/users/%d' % i)
+            self.assertTrue(abs(hll.estimate() - n) < n * 0.1, n)
+
+    def test_response_headers(self):
+        tracer = MockTracer()
+        tracing = PyramidTracing(tracer, response_headers=ResponseHeaders())
+        req = DummyRequest()
+        response = DummyResponse()
+
+        span = tracing._apply_tracing(req, [])
+        tracing._finish_tracing(req, response=response)
+
+        trace_id = '%x' % span.context.trace_id
+        span_id = '%x' % span.context.span_id
+        self.assertEqual('00-%s-%s-01' % (trace_id.zfill(32),
+                                          span_id.zfill(16)),
+                         response.headers['traceresponse'], '#A0')
+        self.assertEqual(trace_id, response.headers['X-Trace-Id'], '#A1')
+        self.assertTrue(response.headers['Server-Timing'].startswith(
+            'total;dur='), '#A2')
+
+    def test_response_headers_inject(self):
+        headers = ResponseHeaders(['Server-Timing', 'x-trace-id'], 'app')
+        context = mock.Mock(spec=['trace_id', 'span_id', 'sampled'],
+                            trace_id='abc', span_id='def', sampled=False)
+        span = mock.Mock(context=context)
+        response = DummyResponse()
+
+        headers.inject(span, response, 0.0125, [('db', 0.005)])
+        self.assertEqual({'Server-Timing': 'app;dur=12.500, db;dur=5.000'},
+                         response.headers, '#A0')
+
+        # appended to the entries already set.
+        response = DummyResponse({'Server-Timing': 'cache;desc=hit'})
+        headers.inject(span, response, 0.0125)
+        self.assertEqual('cache;desc=hit, app;dur=12.500',
+                         response.headers['Server-Timing'], '#B0')
+
+        response = Response()
+        response.headers['Server-Timing'] = 'cache;desc=hit'
+        headers.inject(span, response, 0.0125)
+        self.assertEqual(['cache;desc=hit', 'app;dur=12.500'],
+                         response.headers.getall('Server-Timing'), '#B1')
+
+        with self.assertRaises(ValueError):
+            ResponseHeaders(['foo'])
+
+    def test_response_headers_settings(self):
+        self.assertIsNone(ResponseHeaders.from_settings({}), '#A0')
+        self.assertIsNone(ResponseHeaders.from_settings(
+            {'ot.response_headers': 'false'}), '#A1')
+
+        headers = ResponseHeaders.from_settings(
+            {'ot.response_headers': 'true'})
+        self.assertTrue(headers.traceresponse and headers.server_timing)
+
+        headers = ResponseHeaders.from_settings(
+            {'ot.response_headers': 'server-timing'})
+        self.assertEqual((False, False, True),
+                         (headers.traceresponse, headers.trace_id,
+                          headers.server_timing), '#A2')
+
+    def test_phases(self):
+        tracer = MockTracer()
+        tracing = PyramidTracing(tracer, phases='tags',
+                                 response_headers=ResponseHeaders())
+        req = DummyRequest()
+        response = DummyResponse()
+        event = mock.Mock(request=req)
+
+        tracing._apply_tracing(req, [])
+        on_new_request(event)
+        on_context_found(event)
+        on_before_render({'request': req})
+        tracing._finish_tracing(req, response=response)
+
+        span = tracer.finished_spans()[0]
+        for name in ('routing', 'view', 'render'):
+            self.assertTrue(span.tags['pyramid.phase.%s_ms' % name] >= 0,
+                            name)
+        self.assertFalse('pyramid.phase.callbacks_ms' in span.tags, '#A0')
+        self.assertTrue(', routing;dur=' in
+                        response.headers['Server-Timing'], '#A1')
+
+        # events outside of a traced request are ignored.
+        on_context_found(event)
+
+    def test_phases_spans(self):
+        tracer = MockTracer()
+        tracing = PyramidTracing(tracer, phases='spans')
+        req = DummyRequest()
+
+        tracing._apply_tracing(req, [])
+        on_before_render({'request': req})
+        tracing._finish_tracing(req)
+
+        spans = tracer.finished_spans()
+        self.assertEqual(['view', 'render', 'GET'],
+                         [span.operation_name for span in spans], '#A0')
+        self.assertEqual([spans[2].context.span_id] * 2,
+                         [span.parent_id for span in spans[:2]], '#A1')
+        self.assertEqual('render', spans[1].tags['pyramid.phase'], '#A2')
+        self.assertTrue(spans[0].finish_time <= spans[1].start_time, '#A3')
+
+        with self.assertRaises(ValueError):
+            PyramidTracing(tracer, phases='foo')
+
+    def test_clock(self):
+        ticks = []
+
+        def monotonic():
+            ticks.append(None)
+            return len(ticks) * 1000000  # 1ms per call.
+
+        tracer = MockTracer()
+        clock = Clock(lambda: 1000.0, monotonic)
+        tracing = PyramidTracing(tracer, clock=clock, trace_summary=1)
+        req = DummyRequest()
+
+        tracing._apply_tracing(req, [])
+        tracing.tracer.start_span('child').finish()
+        tracing._finish_tracing(req)
+
+        child, root = tracer.finished_spans()
+        self.assertEqual(1000.0, root.start_time, '#A0')
+        self.assertEqual((1000.001, 1000.002),
+                         (child.start_time, child.finish_time), '#A1')
+        self.assertEqual(1000.003, root.finish_time, '#A2')
+        self.assertEqual(4, len(ticks), '#A3')
+
+        # without any span accounting, the child spans still
+        # follow the clock.
+        tracing.configure(trace_summary=None)
+        tracing._apply_tracing(req, [])
+        tracing.tracer.start_span('child').finish()
+        tracing._finish_tracing(req)
+        child, root = tracer.finished_spans()[-2:]
+        self.assertEqual((1000.0, 1000.003),
+                         (root.start_time, root.finish_time), '#B0')
+        self.assertEqual((1000.001, 1000.002),
+                         (child.start_time, child.finish_time), '#B1')
+
+        # the tracer is only wrapped for a clock of its own.
+        tracing.configure(clock=None)
+        self.assertIs(tracer, tracing.tracer, '#C0')
+
+    def test_fanout(self):
+        exported = []
+
+        def fail(spans):
+            raise IOError('unavailable')
+
+        vendor = MockTracer()
+        tracer = FanOutTracer([exported.append,
+                               Destination(TracerExporter(vendor), 1.0,
+                                           'vendor'),
+                               Destination(fail, name='fail')])
+        tracing = PyramidTracing(tracer)
+        req = DummyRequest(headers={
+            'traceparent': '00-%032x-%016x-01' % (5, 7),
+            'ot-baggage-user': 'bob',
+        })
+
+        span = tracing._apply_tracing(req, [])
+        with tracer.start_active_span('child') as scope:
+            scope.span.set_tag('db', 'users')
+            scope.span.log_kv({'event': 'query'})
+        self.assertEqual([], exported, '#A0')
+        tracing._finish_tracing(req)
+
+        # every destination gets the trace once, in start order.
+        self.assertEqual(1, len(exported), '#B0')
+        root, child = exported[0]
+        self.assertEqual((5, 7), (root.trace_id, root.parent_id), '#B1')
+        self.assertEqual(root.span_id, child.parent_id, '#B2')
+        self.assertEqual('bob', child.get_baggage_item('user'), '#B3')
+        self.assertIs(span, root, '#B4')
+
+        vendor_root, vendor_child = vendor.finished_spans()
+        self.assertEqual(vendor_root.context.span_id,
+                         vendor_child.parent_id, '#C0')
+        self.assertEqual(('5', '%x' % child.span_id),
+                         (vendor_child.tags['fanout.trace_id'],
+                          vendor_child.tags['fanout.span_id']), '#C5')
+        self.assertEqual('users', vendor_child.tags['db'], '#C1')
+        self.assertEqual(root.start_time, vendor_root.start_time, '#C2')
+        self.assertEqual({'exported': 1, 'errors': 0},
+                         tracer.get_stats()['vendor'], '#C3')
+        self.assertEqual({'exported': 0, 'errors': 1},
+                         tracer.get_stats()['fail'], '#C4')
+
+        # unsampled upstream.
+        req = DummyRequest(headers={
+            'traceparent': '00-%032x-%016x-00' % (5, 7)})
+        tracing._apply_tracing(req, [])
+        tracing._finish_tracing(req)
+        self.assertEqual(1, len(exported), '#D0')
+
+    def test_fanout_context_factory(self):
+        def context_factory(trace_id, span_id, sampled, baggage):
+            return MockSpanContext(trace_id, span_id, baggage=baggage)
+
+        vendor = MockTracer()
+        tracer = FanOutTracer([TracerExporter(vendor, context_factory)])
+        context = tracer.extract(opentracing.Format.HTTP_HEADERS, {
+            'traceparent': '00-%032x-%016x-01' % (5, 7)})
+        tracer.start_span('root', child_of=context).finish()
+
+        # linked to the remote parent, in the same trace.
+        span = vendor.finished_spans()[0]
+        self.assertEqual((5, 7), (span.context.trace_id, span.parent_id),
+                         '#A0')
+
+    def test_fanout_sampling(self):
+        half = Destination(lambda spans: None, 0.5)
+        sampled = [half.is_sampled(trace_id)
+                   for trace_id in range(0, 1 << 32, 1 << 20)]
+        self.assertEqual(len(sampled) // 2, sum(sampled), '#A0')
+        self.assertTrue(half.is_sampled(0) and not half.is_sampled(-1),
+                        '#A1')
+
+        with self.assertRaises(ValueError):
+            Destination(lambda spans: None, 2.0)
+
+        tracer = FanOutTracer([], max_pending=2)
+        spans = [tracer.start_span('root') for _ in range(3)]
+        self.assertEqual(2, len(tracer._pending), '#B0')
+        for span in spans:
+            span.finish()
+        self.assertEqual(0, len(tracer._pending), '#B1')
+
+        carrier = {}
+        span = tracer.start_span('root').set_baggage_item('a', '1')
+        tracer.inject(span.context, opentracing.Format.TEXT_MAP, carrier)
+        context = tracer.extract(opentracing.Format.HTTP_HEADERS, carrier)
+        self.assertEqual((span.trace_id, span.span_id, True, {'a': '1'}),
+                         (context.trace_id, context.span_id,
+                          context.sampled, context.baggage), '#C0')
+        with self.assertRaises(opentracing.SpanContextCorruptedException):
+            tracer.extract(opentracing.Format.TEXT_MAP,
+                           {'traceparent': 'foo'})
+
+    def test_fanout_baggage(self):
+        tracer = FanOutTracer([])
+        root = tracer.start_span('root').set_baggage_item('a', '1')
+        child = tracer.start_span('child', child_of=root)
+
+        # shared with the parent until an item is set.
+        self.assertIs(root.context.baggage, child.context.baggage, '#A0')
+        child.set_baggage_item('b', '2')
+        self.assertEqual({'a': '1'}, root.context.baggage, '#A1')
+        self.assertEqual({'a': '1', 'b': '2'}, child.context.baggage, '#A2')
+
+    def test_baggage_policy(self):
+        policy = BaggagePolicy(allowed_keys=['User', 'tenant', 'big'],
+                               max_item_bytes=10, max_total_bytes=20)
+        headers = {'ot-baggage-user': 'bob', 'Uberctx-Tenant': 'acme',
+                   'ot-baggage-other': 'x', 'ot-baggage-big': 'x' * 10,
+                   'ot-tracer-traceid': '1'}
+        trimmed, removed = policy.trim_carrier(headers)
+        self.assertEqual({'ot-baggage-user': 'bob', 'Uberctx-Tenant': 'acme',
+                          'ot-tracer-traceid': '1'}, trimmed, '#A0')
+        self.assertEqual(2, removed, '#A1')
+
+        # beyond max_total_bytes, the first items are kept.
+        trimmed, removed = policy.trim_carrier({
+            'baggage': 'user=bob;p=1, tenant=acme, big=x,other=y'})
+        self.assertEqual({'baggage': 'user=bob;p=1,tenant=acme'}, trimmed,
+                         '#B0')
+        self.assertEqual(2, removed, '#B1')
+
+        headers = {'ot-baggage-user': 'bob'}
+        self.assertIs(headers, policy.trim_carrier(headers)[0], '#C0')
+        self.assertEqual({}, policy.trim_carrier({'baggage': 'other=1'})[0],
+                         '#C1')
+
+        self.assertTrue(policy.allows_item({'user': 'bob'}, 'user', 'alice'),
+                        '#D0')
+        self.assertFalse(policy.allows_item({'user': 'bob', 'tenant': 'acme'},
+                                            'big', 'x'), '#D1')
+
+    def test_baggage(self):
+        tracer = MockTracer()
+        limiter = CardinalityLimiter(max_values=1)
+        policy = BaggagePolicy(allowed_keys=['user', 'tenant'],
+                               max_item_bytes=10, tag_keys=['tenant'])
+        tracing = PyramidTracing(tracer, baggage=policy, cardinality=limiter)
+        for tenant in ('acme', 'corp'):
+            req = DummyRequest(headers={
+                'ot-tracer-traceid': '1', 'ot-tracer-spanid': '2',
+                'ot-baggage-tenant': tenant,
+                'ot-baggage-user': 'x' * 10,
+            })
+            span = tracing._apply_tracing(req, [])
+            self.assertEqual({'tenant': tenant}, span.context.baggage, '#A0')
+            tracing.tracer.active_span.set_baggage_item('user', 'bob')
+            tracing.tracer.active_span.set_baggage_item('session', 'abc')
+            tracing._finish_tracing(req)
+
+        first, second = tracer.finished_spans()
+        self.assertEqual(1, first.tags['baggage.trimmed'], '#B0')
+        self.assertEqual('acme', first.tags['baggage.tenant'], '#B1')
+        self.assertEqual('__other__', second.tags['baggage.tenant'], '#B2')
+        self.assertEqual('bob', first.context.baggage['user'], '#B3')
+        self.assertFalse('session' in first.context.baggage, '#B4')
+        self.assertEqual(1, first.tags['baggage.dropped'], '#B5')
+
+    def test_recorder(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+
+        for name in ('envelopes.jsonl', 'envelopes.jsonl.gz'):
+            path = os.path.join(tmpdir, name)
+            recorder = EnvelopeRecorder(path, flush_size=2)
+            tracing = PyramidTracing(MockTracer(), recorder=recorder)
+
+            for route, error, response in (
+                    ('users', None, None),
+                    ('items', ValueError(), None),
+                    ('users', None, Response(status=503))):
+                req = DummyRequest(headers={'Cookie': 'secret=1'})
+                req.matched_route = DummyRoute(route)
+                tracing._apply_tracing(req, [])
+                tracing._finish_tracing(req, error=error, response=response)
+
+            # full batches are written by a background thread.
+            self.assertTrue(recorder._thread.is_alive(), name)
+            recorder.flush()
+            envelopes = read_envelopes(path)
+            self.assertEqual(['users', 'items', 'users'],
+                             [e['r'] for e in envelopes], name)
+            self.assertEqual([['Cookie', 8]], envelopes[0]['h'], name)
+            # the status of the response returned, if any.
+            self.assertEqual((200, 500, 1, 503), (envelopes[0]['s'],
+                                                  envelopes[1]['s'],
+                                                  envelopes[1]['e'],
+                                                  envelopes[2]['s']), name)
+            self.assertFalse('secret' in str(envelopes), name)
+
+        self.assertIsNone(EnvelopeRecorder.from_settings({}), '#A0')
+
+    def test_replay(self):
+        envelopes = [
+            {'r': 'users', 'm': 'GET', 'h': [['Host', 11]], 's': 200,
+             'd': 1.5},
+            # recorded from a traced caller.
+            {'r': 'users', 'm': 'GET', 'h': [['Ot-Tracer-Traceid', 16],
+                                             ['Ot-Tracer-Spanid', 16],
+                                             ['traceparent', 55]],
+             's': 200, 'd': 1.5},
+            {'r': 'users', 'm': 'POST', 'h': [], 's': 201, 'd': 2.5},
+            {'r': 'items', 'm': 'GET', 'h': [], 's': 500, 'd': 1.0, 'e': 1},
+        ]
+        tracer = MockTracer()
+        results = replay(envelopes, {'ot.max_child_spans': '10'}, 2,
+                         tracer)
+        self.assertEqual({'users': 3, 'items': 1},
+                         dict((route, result['requests'])
+                              for route, result in results.items()), '#A0')
+        self.assertTrue(results['users']['traced'] > 0, '#A1')
+        self.assertEqual([], tracer.finished_spans(), '#A2')
+
+        report = format_report(results).splitlines()
+        self.assertEqual(['route', 'users', 'items', 'TOTAL'],
+                         [line.split()[0] for line in report], '#B0')
+
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        path = os.path.join(tmpdir, 'envelopes.jsonl')
+        with open(path, 'w') as f:
+            f.write('\n'.join(json.dumps(e) for e in envelopes))
+
+        with mock.patch('sys.stdout') as stdout:
+            replay_main([path, '--repeat', '1'])
+        self.assertTrue('TOTAL' in ''.join(
+            call[0][0] for call in stdout.write.call_args_list), '#C0')
+
+    def test_deferred_finish(self):
+        ticks = []
+
+        def monotonic():
+            ticks.append(None)
+            return len(ticks) * 1000000
+
+        tracer = MockTracer()
+        tracing = PyramidTracing(tracer, clock=Clock(lambda: 1000.0,
+                                                     monotonic),
+                                 finisher=ResponseFinisher(), phases='tags')
+        req = DummyRequest()
+        response = Response(body=b'ok')
+
+        tracing._apply_tracing(req, [])
+        tracing._finish_tracing(req, response=response)
+        on_new_response(mock.Mock(request=req))
+        self.assertEqual([], tracer.finished_spans(), '#A0')
+        self.assertIsNone(tracing.tracer.active_span, '#A1')
+        self.assertEqual('2', response.headers['Content-Length'], '#A2')
+
+        # finished once the body is sent, at the time the request ended.
+        self.assertEqual([b'ok'], list(response.app_iter), '#B0')
+        response.app_iter.close()
+        req._process_finished_callbacks()
+        spans = tracer.finished_spans()
+        self.assertEqual(1, len(spans), '#B1')
+        self.assertEqual(1000.001, spans[0].finish_time, '#B2')
+        self.assertEqual(200, spans[0].tags[tags.HTTP_STATUS_CODE], '#B3')
+        self.assertTrue('pyramid.phase.callbacks_ms' in spans[0].tags, '#B4')
+
+        # or at the end of the request, if the body was replaced.
+        req = DummyRequest()
+        tracing._apply_tracing(req, [])
+        tracing._finish_tracing(req, response=response)
+        response.body = b'replaced'
+        req._process_finished_callbacks()
+        self.assertEqual(2, len(tracer.finished_spans()), '#C0')
+
+        # or if there is no response.
+        req = DummyRequest()
+        tracing._apply_tracing(req, [])
+        tracing._finish_tracing(req, error=ValueError())
+        self.assertEqual(2, len(tracer.finished_spans()), '#D0')
+        req._process_finished_callbacks()
+        self.assertTrue(tracer.finished_spans()[2].tags[tags.ERROR], '#D1')
+
+    def test_deferred_finish_background(self):
+        tracer = MockTracer()
+        finisher = BackgroundFinisher()
+        tracing = PyramidTracing(tracer, finisher=finisher)
+
+        for _ in range(10):
+            req = DummyRequest()
+            tracing._apply_tracing(req, [])
+            tracing._finish_tracing(req)
+
+        finisher.flush()
+        self.assertEqual(10, len(tracer.finished_spans()), '#A0')
+        self.assertEqual(0, finisher.errors, '#A1')
+
+        self.assertIsNone(finisher_from_settings({}), '#B0')
+        self.assertIsNone(finisher_from_settings(
+            {'ot.deferred_finish': 'false'}), '#B1')
+        self.assertIsInstance(finisher_from_settings(
+            {'ot.deferred_finish': 'true'}), ResponseFinisher, '#B2')
+        self.assertIsInstance(finisher_from_settings(
+            {'ot.deferred_finish': 'background'}), BackgroundFinisher, '#B3')
+        with self.assertRaises(ValueError):
+            finisher_from_settings({'ot.deferred_finish': 'later'})
+
+    def test_deferred_finish_compact_error(self):
+        tracer = MockTracer()
+        tracing = PyramidTracing(tracer, error_mode='compact',
+                                 finisher=ResponseFinisher())
+        req = DummyRequest()
+        tracing._apply_tracing(req, [])
+
+        class Boom(ValueError):
+            pass
+
+        def fail():
+            try:
+                raise Boom('boom')
+            except Boom as e:
+                return e
+
+        # only the summary is kept until the span is completed.
+        error = fail()
+        tracing._finish_tracing(req, error=error)
+        ref = weakref.ref(error)
+        del error
+        self.assertIsNone(ref(), '#A0')
+
+        req._process_finished_callbacks()
+        span = tracer.finished_spans()[0]
+        self.assertTrue(span.tags[tags.ERROR], '#B0')
+        self.assertEqual(('Boom', 'boom'),
+                         (span.logs[0].key_values['error.kind'],
+                          span.logs[0].key_values['message']), '#B1')
+
+    def test_get_phases(self):
+        # traced by trace(), from within the view.
+        self.assertEqual([('view', 1.0, 2.0)],
+                         get_phases([1.0, None, None, None, 2.0, None]),
+                         '#A0')
+        self.assertEqual([('routing', 1.5, 2.0), ('view', 2.0, 3.0),
+                          ('render', 3.0, 4.0), ('callbacks', 4.0, 4.5)],
+                         get_phases([1.0, 1.5, 2.0, 3.0, 4.0, 4.5]), '#A1')
+
+        self.assertEqual('tags', parse_mode('true'), '#B0')
+        self.assertEqual('spans', parse_mode('spans'), '#B1')
+        self.assertIsNone(parse_mode('off'), '#B2')
+        with self.assertRaises(ValueError):
+            parse_mode('foo')
+
     def test_apply_tracing_child(self):
         tracer = MockTracer()
         tracing = PyramidTracing(tracer)
@@ -215,6 +872,19 @@ class TestPyramidTracing(unittest.TestCase):
         }, spans[0].tags, '#A1')
         self.assertEqual(True, spans[0].finished, '#A2')
 
+    def test_decorator_response_headers(self):
+        tracing = PyramidTracing(MockTracer(),
+                                 response_headers=ResponseHeaders())
+        req = DummyRequest()
+
+        @tracing.trace()
+        def sample_func(req):
+            return {'rendered': 'later'}
+
+        sample_func(req)
+        self.assertTrue('traceresponse' in req.response.headers, '#A0')
+        self.assertTrue('Server-Timing' in req.response.headers, '#A1')
+
     def test_decorator_attributes(self):
         tracer = MockTracer()
         tracing = PyramidTracing(tracer)
@@ -273,6 +943,659 @@ class TestPyramidTracing(unittest.TestCase):
 
         self.assertIsNone(tracing.tracer.active_span)
 
+    def test_resource_usage(self):
+        tracing = PyramidTracing(MockTracer(), resource_usage=True)
+        req = DummyRequest()
+        req.matched_route = DummyRoute('foo')
+
+        span = tracing._apply_tracing(req, [])
+        sum(range(10000))
+        tracing._finish_tracing(req)
+
+        self.assertTrue(span.tags['resource.wall_ms'] >= 0, '#A0')
+        self.assertTrue(span.tags['resource.gc_pause_ms'] >= 0, '#A1')
+        self.assertTrue('resource.cpu_ms' in span.tags, '#A2')
+        self.assertFalse('resource.mem_peak_bytes' in span.tags, '#A3')
+
+        stats = tracing.route_stats.snapshot()
+        self.assertEqual(1, stats['foo']['count'], '#B0')
+        self.assertEqual(0, stats['foo']['errors'], '#B1')
+        self.assertTrue('resource.cpu_ms.avg' in stats['foo'], '#B2')
+
+    def test_route_stats_partial(self):
+        stats = RouteStats()
+        stats.record('foo', {'resource.wall_ms': 10.0,
+                             'resource.mem_peak_bytes': 1000})
+        stats.record('foo', {'resource.wall_ms': 20.0})
+
+        # averaged over the requests reporting the value.
+        snapshot = stats.snapshot()['foo']
+        self.assertEqual(2, snapshot['count'], '#A0')
+        self.assertEqual(15.0, snapshot['resource.wall_ms.avg'], '#A1')
+        self.assertEqual(1000.0, snapshot['resource.mem_peak_bytes.avg'],
+                         '#A2')
+
+    @unittest.skipIf(sys.version_info < (3,), 'no tracemalloc')
+    def test_resource_usage_memory(self):
+        import tracemalloc
+        if not tracemalloc.is_tracing():
+            self.addCleanup(tracemalloc.stop)
+        usage = ResourceUsage(trace_memory=True)
+
+        start = usage.snapshot()
+        self.assertTrue('resource.mem_peak_bytes' in usage.delta(start),
+                        '#A0')
+
+        # not reported for overlapping requests.
+        first = usage.snapshot()
+        second = usage.snapshot()
+        self.assertFalse('resource.mem_peak_bytes' in usage.delta(first),
+                         '#B0')
+        self.assertFalse('resource.mem_peak_bytes' in usage.delta(second),
+                         '#B1')
+
+        start = usage.snapshot()
+        self.assertTrue('resource.mem_peak_bytes' in usage.delta(start),
+                        '#C0')
+
+    def test_resource_usage_disabled(self):
+        tracing = PyramidTracing(MockTracer())
+        req = DummyRequest()
+
+        span = tracing._apply_tracing(req, [])
+        tracing._finish_tracing(req)
+        self.assertFalse('resource.wall_ms' in span.tags, '#A0')
+        self.assertEqual({}, tracing.route_stats.snapshot(), '#A1')
+
+    def test_limits_child_spans(self):
+        tracer = MockTracer()
+        tracing = PyramidTracing(tracer, limits=SpanLimits(max_child_spans=2,
+                                                           max_span_logs=1))
+        req = DummyRequest()
+
+        tracing._apply_tracing(req, [])
+        for i in range(4):
+            with tracing.tracer.start_active_span('child') as scope:
+                scope.span.log_kv({'event': 'first'})
+                scope.span.log_kv({'event': 'second'})
+        tracing._finish_tracing(req)
+
+        spans = tracer.finished_spans()
+        self.assertEqual(3, len(spans), '#A0')
+        self.assertEqual(['child', 'child', 'GET'],
+                         [span.operation_name for span in spans], '#A1')
+        self.assertEqual(1, len(spans[0].logs), '#A2')
+        self.assertEqual(spans[2].context.span_id, spans[0].parent_id, '#A3')
+        self.assertEqual(2, spans[2].tags['limits.dropped_spans'], '#B0')
+        self.assertEqual(6, spans[2].tags['limits.dropped_logs'], '#B1')
+        self.assertIsNone(tracing.tracer.active_span, '#B2')
+
+    def test_limits_tag_bytes(self):
+        tracer = MockTracer()
+        tracing = PyramidTracing(tracer, limits=SpanLimits(max_tag_bytes=100))
+        req = DummyRequest()
+
+        span = tracing._apply_tracing(req, [])
+        span.set_tag('big', 'x' * 100)
+        tracing._finish_tracing(req)
+
+        self.assertFalse('big' in span.tags, '#A0')
+        self.assertEqual(1, span.tags['limits.dropped_tags'], '#A1')
+        # the wrapper exposes the attributes of the tracer.
+        self.assertEqual(tracer.finished_spans(),
+                         tracing.tracer.finished_spans(), '#A2')
+
+        # the standard tags of the request span are kept regardless.
+        req = DummyRequest()
+        req.matched_route = DummyRoute('foo')
+        span = tracing._apply_tracing(req, [])
+        with tracing.tracer.start_active_span('child') as scope:
+            scope.span.set_tag('big', 'x' * 90)
+        tracing._finish_tracing(req, error=ValueError())
+
+        self.assertTrue(span.tags[tags.ERROR], '#B0')
+        self.assertEqual('foo', span.tags['pyramid.route'], '#B1')
+        self.assertEqual('GET', span.tags[tags.HTTP_METHOD], '#B2')
+
+    def test_limits_duration(self):
+        tracer = MockTracer()
+        tracing = PyramidTracing(tracer,
+                                 limits=SpanLimits(max_span_duration=0))
+        req = DummyRequest()
+
+        tracing._apply_tracing(req, [])
+        child = tracing.tracer.start_span('child')
+        tracing._finish_tracing(req)
+
+        spans = tracer.finished_spans()
+        self.assertEqual(1, len(spans), '#A0')
+        self.assertTrue(spans[0].tags['limits.deadline_exceeded'], '#A1')
+        self.assertEqual(1, spans[0].tags['limits.dropped_spans'], '#A2')
+        child.finish()
+
+        # the error of the request is logged regardless.
+        for limits in (SpanLimits(max_span_duration=0),
+                       SpanLimits(max_span_logs=0)):
+            tracing.configure(limits=limits, error_recorder=ErrorRecorder())
+            req = DummyRequest()
+            span = tracing._apply_tracing(req, [])
+            span.log_kv({'event': 'other'})
+            tracing._finish_tracing(req, error=ValueError('boom'))
+            self.assertEqual(['boom'], [log.key_values['message']
+                                        for log in span.logs], '#B0')
+
+    def test_limits_forced_finish(self):
+        tracer = MockTracer()
+        tracing = PyramidTracing(tracer, limits=SpanLimits())
+        req = DummyRequest()
+
+        tracing._apply_tracing(req, [])
+        child = tracing.tracer.start_span('leaked')
+        tracing._finish_tracing(req)
+
+        spans = tracer.finished_spans()
+        self.assertEqual(['leaked', 'GET'],
+                         [span.operation_name for span in spans], '#A0')
+        self.assertEqual(1, spans[1].tags['limits.forced_finishes'], '#A1')
+        child.finish()
+        self.assertEqual(2, len(tracer.finished_spans()), '#A2')
+
+    def test_error_mode_error(self):
+        with self.assertRaises(ValueError):
+            PyramidTracing(MockTracer(), error_mode='foo')
+
+    def test_error_mode_compact(self):
+        tracer = MockTracer()
+        tracing = PyramidTracing(tracer, error_mode='compact')
+
+        @tracing.trace()
+        def sample_func(req):
+            raise ValueError('Testing exception')
+
+        for i in range(3):
+            try:
+                sample_func(DummyRequest())
+            except ValueError:
+                pass
+
+        spans = tracer.finished_spans()
+        self.assertEqual(3, len(spans), '#A0')
+        self.assertTrue(all(span.tags[tags.ERROR] for span in spans), '#A1')
+
+        logs = [span.logs[0].key_values for span in spans]
+        self.assertEqual('ValueError', logs[0]['error.kind'], '#B0')
+        self.assertEqual('Testing exception', logs[0]['message'], '#B1')
+        self.assertTrue('sample_func' in logs[0]['stack'], '#B2')
+        self.assertFalse('error.object' in logs[0], '#B3')
+
+        # Repeated errors only carry their fingerprint and count.
+        self.assertEqual([1, 2, 3], [log['error.count'] for log in logs])
+        self.assertEqual(1, len(set(log['error.fingerprint']
+                                    for log in logs)), '#C0')
+        self.assertFalse('stack' in logs[1], '#C1')
+        self.assertFalse('stack' in logs[2], '#C2')
+
+    def test_error_recorder_bounded(self):
+        recorder = ErrorRecorder(max_fingerprints=2)
+        tracer = MockTracer()
+        for exc_type in (ValueError, KeyError, TypeError, ValueError):
+            try:
+                raise exc_type()
+            except Exception as e:
+                recorder.log_error(tracer.start_span('foo'), e)
+
+        self.assertEqual(2, len(recorder.counts()), '#A0')
+
+    def test_exemplars(self):
+        tracer = MockTracer()
+        tracing = PyramidTracing(tracer, exemplars=True)
+        req = DummyRequest()
+        req.matched_route = DummyRoute('foo')
+
+        span = tracing._apply_tracing(req, [])
+        tracing._finish_tracing(req)
+
+        trace_id = '%x' % span.context.trace_id
+        span_id = '%x' % span.context.span_id
+        exemplar = tracing.exemplars.get_exemplar('foo', 0)
+        self.assertEqual((trace_id, span_id), exemplar[:2], '#A0')
+
+        output = tracing.exemplars.export()
+        self.assertTrue('pyramid_request_duration_seconds_count'
+                        '{route="foo"} 1' in output, '#B0')
+        self.assertTrue('# {trace_id="%s",span_id="%s"}' % (trace_id, span_id)
+                        in output, '#B1')
+
+    def test_exemplar_table(self):
+        table = ExemplarTable(buckets=[0.1, 1.0], max_routes=1)
+        table.observe('foo', 0.05, ('a', 'b'))
+        table.observe('foo', 0.5, ('c', 'd'))
+        table.observe('foo', 0.07)
+        table.observe('bar', 5.0, ('e', 'f'))
+
+        self.assertEqual('a', table.get_exemplar('foo', 0.01)[0], '#A0')
+        self.assertEqual('c', table.get_exemplar('foo', 0.2)[0], '#A1')
+        self.assertIsNone(table.get_exemplar('foo', 3.0), '#A2')
+        self.assertEqual('e', table.get_exemplar('__other__', 3.0)[0])
+
+        output = table.export()
+        self.assertTrue('{route="foo",le="0.1"} 2 # {trace_id="a"' in output)
+        self.assertTrue('{route="foo",le="+Inf"} 3\n' in output, '#B1')
+
+    def test_pressure_levels(self):
+        tracer = MockTracer()
+        tracing = PyramidTracing(tracer, start_span_cb=start_span_cb,
+                                 pressure_monitor=PressureMonitor())
+
+        for level, name in enumerate(['full', 'reduced', 'root_only']):
+            req = DummyRequest()
+            span = tracing._apply_tracing(req, ['path'], level)
+            tracing.tracer.start_span('child').finish()
+            tracing._finish_tracing(req)
+            self.assertEqual(name, span.tags['pyramid.tracing_level'])
+
+        spans = tracer.finished_spans()
+        self.assertEqual(['child', 'testing_name', 'child', 'GET', 'GET'],
+                         [span.operation_name for span in spans], '#A0')
+        self.assertEqual('/', spans[1].tags['path'], '#A1')
+        self.assertFalse('path' in spans[3].tags, '#A2')
+        self.assertEqual(1, spans[4].tags['limits.dropped_spans'], '#A3')
+
+    def test_pressure_monitor(self):
+        monitor = PressureMonitor(max_in_flight=2, low_watermark=0.6, hold=0)
+        req = DummyRequest()
+
+        self.assertEqual(0, monitor.request_started(req), '#A0')
+        self.assertEqual(1, monitor.request_started(req), '#A1')
+        self.assertEqual(2, monitor.request_started(req), '#A2')
+        self.assertEqual(3, monitor.request_started(req), '#A3')
+        self.assertEqual(3, monitor.request_started(req), '#A4')
+
+        # Going back up happens one step at a time.
+        for i in range(5):
+            monitor.request_finished(0.1)
+        self.assertEqual(2, monitor.request_started(req), '#B0')
+        monitor.request_finished(0.1)
+        self.assertEqual(1, monitor.request_started(req), '#B1')
+        monitor.request_finished(0.1)
+
+        stats = monitor.get_stats()
+        self.assertEqual('reduced', stats['level'], '#C0')
+        self.assertEqual(0, stats['in_flight'], '#C1')
+        self.assertEqual(2, stats['requests']['off'], '#C2')
+        self.assertEqual(5, stats['level_changes'], '#C3')
+
+    def test_pressure_hold(self):
+        monitor = PressureMonitor(max_in_flight=1, hold=60)
+        req = DummyRequest()
+        for i in range(5):
+            self.assertEqual(0, monitor.request_started(req))
+
+    def test_configure(self):
+        tracing = PyramidTracing(MockTracer())
+        config = tracing._config
+
+        tracing.configure(trace_all=True, limits=SpanLimits(max_span_logs=1))
+        self.assertTrue(tracing._trace_all, '#A0')
+        self.assertEqual(1, tracing._limits.max_span_logs, '#A1')
+        self.assertFalse(config.trace_all, '#A2')
+        self.assertIsNone(config.limits, '#A3')
+
+        with self.assertRaises(AttributeError):
+            tracing._trace_all = False
+        with self.assertRaises(TypeError):
+            tracing.configure(foo=1)
+        with self.assertRaises(ValueError):
+            tracing.configure(start_span_cb=4)
+
+    def test_configure_during_request(self):
+        tracer = MockTracer()
+        tracing = PyramidTracing(tracer)
+        req = DummyRequest()
+        calls = []
+
+        tracing._apply_tracing(req, [])
+        tracing.configure(start_span_cb=lambda span, req: calls.append(span),
+                          error_recorder=ErrorRecorder())
+        tracing._finish_tracing(req, error=ValueError())
+
+        # The request finished with the options it started with.
+        span = tracer.finished_spans()[0]
+        self.assertEqual([], calls, '#A0')
+        self.assertTrue('error.object' in span.logs[0].key_values, '#A1')
+
+    def test_dependencies(self):
+        tracer = MockTracer()
+        graph = DependencyGraph('front', caller_header='X-Caller')
+        tracing = PyramidTracing(tracer, dependencies=graph,
+                                 limits=SpanLimits(max_child_spans=2))
+        req = DummyRequest(headers={'X-Caller': 'edge'})
+        client = {tags.SPAN_KIND: tags.SPAN_KIND_RPC_CLIENT}
+
+        tracing._apply_tracing(req, [])
+        tracing.tracer.start_span('local').finish()
+        with tracing.tracer.start_active_span('query', tags=client) as scope:
+            scope.span.set_tag(tags.PEER_SERVICE, 'db')
+        # Dropped by the limits, yet still accounted for.
+        span = tracing.tracer.start_span('GET', tags=client)
+        span.set_tag(tags.PEER_HOSTNAME, 'api')
+        span.set_tag(tags.HTTP_STATUS_CODE, 503)
+        span.finish()
+        tracing._finish_tracing(req)
+
+        self.assertEqual(3, len(tracer.finished_spans()), '#A0')
+        edges = dict(((e['caller'], e['route'], e['peer'], e['operation']),
+                      e) for e in graph.export()['edges'])
+        self.assertEqual(set([('edge', None, 'front', 'GET'),
+                              ('front', 'GET', 'db', 'query'),
+                              ('front', 'GET', 'api', 'GET')]),
+                         set(edges), '#A1')
+        self.assertEqual(0, edges[('front', 'GET', 'db', 'query')]['errors'])
+        self.assertEqual(1, edges[('front', 'GET', 'api', 'GET')]['errors'])
+        self.assertEqual(1, edges[('edge', None, 'front', 'GET')]['calls'])
+
+    def test_dependencies_bounded(self):
+        graph = DependencyGraph('front', max_edges=2)
+        for peer in ('a', 'b', 'c', 'd'):
+            graph.record('front', 'GET', peer, 'op', 0.1)
+
+        edges = graph.export()['edges']
+        self.assertEqual(3, len(edges), '#A0')
+        self.assertEqual(('__other__', 2),
+                         (edges[0]['peer'], edges[0]['calls']), '#A1')
+
+        # callers named by the clients are bounded too.
+        graph = DependencyGraph('front', caller_header='X-Caller',
+                                max_edges=10)
+        limiter = CardinalityLimiter(max_values=3)
+        for i in range(100):
+            req = DummyRequest(headers={'X-Caller': 'caller-%d' % i})
+            graph.record_request(req, 'GET', 0.1, False, [], limiter)
+
+        edges = graph.export()['edges']
+        self.assertEqual(4, len(edges), '#B0')
+        self.assertEqual(('__other__', 97),
+                         (edges[0]['caller'], edges[0]['calls']), '#B1')
+
+        graph = DependencyGraph('front', caller_header='X-Caller',
+                                max_edges=10)
+        for i in range(100):
+            req = DummyRequest(headers={'X-Caller': 'caller-%d' % i})
+            graph.record_request(req, 'GET', 0.1, False, [])
+        self.assertEqual(11, len(graph.export()['edges']), '#C0')
+
+    def test_latency_sketch(self):
+        sketch = LatencySketch(relative_accuracy=0.05)
+        self.assertEqual([None], sketch.quantiles([0.5]), '#A0')
+
+        values = [i / 1000.0 for i in range(1, 1001)]
+        for value in values:
+            sketch.add(value)
+
+        for estimate, actual in zip(sketch.quantiles([0.5, 0.9, 0.99]),
+                                    (0.5, 0.9, 0.99)):
+            self.assertTrue(abs(estimate - actual) <= actual * 0.05,
+                            (estimate, actual))
+        self.assertEqual(1.0, sketch.max, '#A1')
+
+    def test_timeline(self):
+        tracer = MockTracer()
+        tracing = PyramidTracing(tracer, timeline=TraceBuffer(2))
+
+        for path in ('/1', '/2', '/3'):
+            req = DummyRequest(path=path)
+            tracing._apply_tracing(req, [])
+            with tracing.tracer.start_active_span('child') as scope:
+                scope.span.set_tag('path', path)
+                tracing.tracer.start_span('grandchild').finish()
+            tracing._finish_tracing(req)
+
+        traces = tracing.timeline.traces()
+        self.assertEqual(2, len(traces), '#A0')
+        root, child, grandchild = traces[0].spans
+        self.assertEqual('%x' % tracer.finished_spans()[-1].context.trace_id,
+                         traces[0].trace_id, '#A1')
+        self.assertEqual({'path': '/3'}, child.tags, '#A2')
+        self.assertEqual((None, root, child),
+                         (root.parent, child.parent, grandchild.parent))
+        self.assertEqual(200, root.tags[tags.HTTP_STATUS_CODE], '#A3')
+        self.assertTrue(traces[0].duration >= child.duration, '#A4')
+        self.assertIs(traces[1], tracing.timeline.get(traces[1].trace_id))
+
+    def test_timeline_disabled(self):
+        tracer = MockTracer()
+        tracing = PyramidTracing(tracer)
+        self.assertIsNone(tracing.timeline, '#A0')
+        self.assertIs(tracer, tracing.tracer, '#A1')
+
+    def _get_records(self, *spans):
+        # (name, start, duration, parent index) tuples.
+        records = []
+        for name, start, duration, parent in spans:
+            record = SpanRecord(name, None if parent is None
+                                else records[parent])
+            record.start, record.duration = start, duration
+            record.index = len(records)
+            records.append(record)
+
+        return records
+
+    def _get_trace_records(self):
+        return self._get_records(
+            ('root', 0.0, 10.0, None),
+            ('a', 1.0, 3.0, 0),
+            ('b', 2.0, 1.0, 0),  # Overlapped by a.
+            ('c', 3.0, 5.0, 0),
+            ('d', 4.0, 2.0, 3),
+        )
+
+    def test_critical_path(self):
+        records = self._get_trace_records()
+        path = [(r.operation_name, seconds)
+                for r, seconds in critical_path(records)]
+        self.assertEqual([('root', 1.0), ('a', 2.0), ('c', 1.0), ('d', 2.0),
+                          ('c', 2.0), ('root', 2.0)], path, '#A0')
+        summary = summarize(critical_path(records))
+        self.assertEqual({'c': 3.0, 'root': 3.0, 'a': 2.0, 'd': 2.0},
+                         dict(summary), '#A1')
+        self.assertEqual(('a', 2.0), summary[2], '#A2')
+
+    def test_self_times(self):
+        records = self._get_trace_records()
+        self.assertEqual([3.0, 3.0, 1.0, 3.0, 2.0], self_times(records))
+
+        # A child outliving its parent is clipped.
+        records = self._get_records(('root', 0.0, 2.0, None),
+                                    ('a', 1.0, 5.0, 0))
+        self.assertEqual([1.0, 5.0], self_times(records))
+
+    def test_analysis_many_children(self):
+        spans = [('root', 0.0, 1000.0, None)]
+        for i in range(1000):
+            spans.append(('child', float(i), 1.0, 0))
+            spans.append(('grandchild', i + 0.25, 0.5, len(spans) - 1))
+        records = self._get_records(*spans)
+
+        self.assertEqual(3000, len(critical_path(records)), '#A0')
+        self.assertEqual({'child': 500.0, 'grandchild': 500.0},
+                         dict(summarize(critical_path(records))), '#A1')
+        self.assertEqual(0.0, self_times(records)[0], '#A2')
+        self.assertEqual({'pyramid.self_time': 'child:500000.0',
+                          'pyramid.critical_path': 'child:500000.0'},
+                         summary_tags(records, 1), '#A3')
+
+    def test_trace_summary(self):
+        tracer = MockTracer()
+        tracing = PyramidTracing(tracer, trace_summary=2)
+        req = DummyRequest()
+
+        tracing._apply_tracing(req, [])
+        with tracing.tracer.start_active_span('query'):
+            tracing.tracer.start_span('fetch').finish()
+        tracing._finish_tracing(req)
+
+        span = tracer.finished_spans()[-1]
+        for key in ('pyramid.self_time', 'pyramid.critical_path'):
+            names = [item.split(':')[0] for item in span.tags[key].split(',')]
+            self.assertEqual(2, len(names), key)
+            self.assertTrue(set(names) <= set(['GET', 'query', 'fetch']))
+
+    def test_log_filter(self):
+        tracer = MockTracer()
+        tracing = PyramidTracing(tracer)
+        log_filter = TraceContextFilter(tracing)
+        record = logging.LogRecord('foo', logging.INFO, '', 0, 'msg', (), None)
+
+        log_filter.filter(record)
+        self.assertEqual(('-', '-'), (record.trace_id, record.span_id))
+
+        req = DummyRequest()
+        span = tracing._apply_tracing(req, [])
+        log_filter.filter(record)
+        self.assertEqual('%x' % span.context.trace_id, record.trace_id)
+        self.assertEqual('%x' % span.context.span_id, record.span_id)
+
+        with tracer.start_active_span('child') as scope:
+            log_filter.filter(record)
+            self.assertEqual('%x' % scope.span.context.span_id,
+                             record.span_id)
+
+        # Out of the active scope, the current request span is used.
+        tracer.scope_manager.active.close()
+        manager.push({'request': req, 'registry': manager.get()['registry']})
+        try:
+            log_filter.filter(record)
+        finally:
+            manager.pop()
+        self.assertEqual('%x' % span.context.span_id, record.span_id)
+        tracing._finish_tracing(req)
+
+    def _log_request(self, tracing, handler, error=None, path='/'):
+        logger = logging.getLogger('pyramid_opentracing.tests.logs')
+        logger.addHandler(handler)
+        logger.setLevel(logging.DEBUG)
+
+        req = DummyRequest(path=path)
+        manager.push({'request': req, 'registry': manager.get()['registry']})
+        try:
+            span = tracing._apply_tracing(req, [])
+            logger.debug('debug %s', 1)
+            logger.warning('warning %s', 2)
+            tracing._finish_tracing(req, error=error)
+        finally:
+            manager.pop()
+            logger.removeHandler(handler)
+
+        return [log.key_values.get('message') for log in span.logs]
+
+    def test_log_handler(self):
+        tracing = PyramidTracing(MockTracer())
+        handler = SpanLogHandler(tracing)
+
+        # Buffered records are discarded for fast, successful requests.
+        self.assertEqual(['warning 2'], self._log_request(tracing, handler))
+
+        messages = self._log_request(tracing, handler, error=ValueError())
+        self.assertEqual(['warning 2', None, 'debug 1'], messages, '#A0')
+
+        handler = SpanLogHandler(tracing, slow_threshold=0)
+        self.assertEqual(['warning 2', 'debug 1'],
+                         self._log_request(tracing, handler), '#B0')
+
+        handler = SpanLogHandler(tracing, buffer_level=logging.DEBUG)
+        self.assertEqual(['debug 1', 'warning 2'],
+                         self._log_request(tracing, handler), '#C0')
+
+    def test_log_handler_bad_format(self):
+        tracing = PyramidTracing(MockTracer())
+        handler = SpanLogHandler(tracing, slow_threshold=0)
+        handler.handleError = mock.Mock()
+        # not passed on to the handlers of the test runner.
+        logger = logging.getLogger('pyramid_opentracing.tests.bad_format')
+        logger.propagate = False
+        logger.addHandler(handler)
+        logger.setLevel(logging.DEBUG)
+
+        req = DummyRequest()
+        manager.push({'request': req, 'registry': manager.get()['registry']})
+        try:
+            span = tracing._apply_tracing(req, [])
+            logger.debug('user %d', 'bob')
+            logger.debug('user %s', 'bob')
+            tracing._finish_tracing(req)
+        finally:
+            manager.pop()
+            logger.removeHandler(handler)
+
+        # reported through handleError(), and only the record is lost.
+        self.assertEqual(1, handler.handleError.call_count, '#A0')
+        self.assertEqual(['user bob'], [log.key_values['message']
+                                        for log in span.logs], '#A1')
+
+    def test_task_propagation(self):
+        tracer = MockTracer()
+        tracing = PyramidTracing(tracer)
+
+        @tracing.trace_task()
+        def process(value):
+            return value * 2
+
+        self.assertEqual({}, inject_task_headers(tracing), '#A0')
+
+        req = DummyRequest()
+        span = tracing._apply_tracing(req, [])
+        headers = inject_task_headers(tracing)
+        self.assertEqual(headers, inject_task_headers(tracing, span), '#A1')
+        # the baggage set after the first injection is propagated too.
+        span.set_baggage_item('user', 'bob')
+        self.assertEqual('bob', inject_task_headers(tracing, span).get(
+            'ot-baggage-user'), '#A2')
+        tracing._finish_tracing(req)
+
+        self.assertEqual(4, process(2, trace_headers=headers), '#B0')
+        task_span = tracer.finished_spans()[-1]
+        self.assertEqual('process', task_span.operation_name, '#B1')
+        self.assertEqual(span.context.trace_id,
+                         task_span.context.trace_id, '#B2')
+        self.assertEqual(span.context.span_id, task_span.parent_id, '#B3')
+        self.assertEqual(tags.SPAN_KIND_CONSUMER,
+                         task_span.tags[tags.SPAN_KIND], '#B4')
+
+        # Without headers, a new trace is started.
+        self.assertEqual(6, process(3), '#C0')
+        self.assertIsNone(tracer.finished_spans()[-1].parent_id, '#C1')
+
+    def test_task_propagation_batch(self):
+        tracer = MockTracer()
+        tracing = PyramidTracing(tracer)
+
+        @tracing.trace_task('consume', headers_kwarg='headers', batch=True)
+        def consume(items):
+            raise ValueError()
+
+        headers_list = []
+        for i in range(3):
+            with tracer.start_active_span('producer'):
+                headers_list.append(inject_task_headers(tracing))
+
+        with self.assertRaises(ValueError):
+            consume([1, 2, 3], headers=headers_list)
+
+        span = tracer.finished_spans()[-1]
+        self.assertEqual('consume', span.operation_name, '#A0')
+        self.assertEqual(3, span.tags['task.batch_size'], '#A1')
+        self.assertTrue(span.tags[tags.ERROR], '#A2')
+        self.assertIsNone(tracer.active_span, '#A3')
+
+    def test_parse_request_start(self):
+        now = 1600000000.5
+        self.assertEqual(0.5, parse_request_start('t=1600000000', now))
+        self.assertEqual(0.5, parse_request_start('t=1600000000000', now))
+        self.assertEqual(0.5, parse_request_start('1600000000000000', now))
+        self.assertEqual(0.0, parse_request_start('t=1600000001', now))
+        self.assertIsNone(parse_request_start('foo', now))
+        self.assertIsNone(parse_request_start(None, now))
+
 
 def tracing_callable(**settings):
     tracer = MockTracer()
@@ -359,6 +1682,19 @@ class TestTweenFactory(unittest.TestCase):
         self.assertEqual(tracer_parameters['scope_manager'],
                          tracer.scope_manager)
 
+    def test_tracer_callable_lazy(self):
+        tracer_callable = mock.Mock(return_value=MockTracer())
+        registry = DummyRegistry()
+        registry.settings['ot.tracer_callable'] = tracer_callable
+        registry.settings['ot.trace_all'] = False
+
+        tween = opentracing_tween_factory(self.default_handler, registry)
+        tween(DummyRequest())
+        self.assertEqual(0, tracer_callable.call_count, '#A0')
+
+        self.assertIsNotNone(registry.settings['ot.tracing'].tracer)
+        self.assertEqual(1, tracer_callable.call_count, '#A1')
+
     def test_deprecated_base_tracer(self):
         base_tracer = MockTracer()
         registry = DummyRegistry()
@@ -570,6 +1906,113 @@ class TestTweenFactory(unittest.TestCase):
             tags.HTTP_STATUS_CODE: 200,
         }, spans[0].tags, '#B1')
 
+    def test_tracetags_specs(self):
+        registry = DummyRegistry()
+        tracer = MockTracer()
+        registry.settings['ot.tracing'] = PyramidTracing(tracer)
+        registry.settings['ot.traced_attributes'] = (
+            'headers[User-Agent]|tag=http.user_agent params.page')
+
+        with mock.patch('pyramid_opentracing.attributes.compile_getter',
+                        wraps=compile_getter) as getter:
+            tween = opentracing_tween_factory(lambda req: None, registry)
+            for i in range(3):
+                tween(DummyRequest(headers={'User-Agent': 'curl'},
+                                   params={'page': str(i)}))
+
+        # Compiled once, when the tween was created.
+        self.assertEqual(2, getter.call_count, '#A0')
+        spans = tracer.finished_spans()
+        self.assertEqual(['curl'] * 3,
+                         [span.tags['http.user_agent'] for span in spans])
+        self.assertEqual(['0', '1', '2'],
+                         [span.tags['params.page'] for span in spans])
+
+    def test_cardinality(self):
+        registry = DummyRegistry()
+        tracer = MockTracer()
+        tracing = PyramidTracing(tracer)
+        registry.settings['ot.tracing'] = tracing
+        registry.settings['ot.max_cardinality'] = '1'
+        registry.settings['ot.traced_attributes'] = ['path']
+        registry.settings['ot.resource_usage'] = 'true'
+
+        tween = opentracing_tween_factory(lambda req: None, registry)
+        for path in ('/1', '/2'):
+            req = DummyRequest(path=path)
+            req.matched_route = DummyRoute(path)
+            tween(req)
+
+        self.assertEqual(['/1', '__other__'],
+                         [span.tags['path'] for span in
+                          tracer.finished_spans()], '#A0')
+        self.assertEqual(set(['/1', '__other__']),
+                         set(tracing.route_stats.snapshot()), '#A1')
+
+    def test_clock(self):
+        registry = DummyRegistry()
+        tracing = PyramidTracing(MockTracer())
+        clock = Clock()
+        registry.settings['ot.tracing'] = tracing
+        registry.settings['ot.clock'] = clock
+
+        opentracing_tween_factory(lambda req: None, registry)
+        self.assertIs(clock, tracing._config.clock, '#A0')
+
+        registry.settings['ot.clock'] = 'pyramid_opentracing.clock.Clock'
+        opentracing_tween_factory(lambda req: None, registry)
+        self.assertIsInstance(tracing._config.clock, Clock, '#A1')
+        self.assertIsNot(clock, tracing._config.clock, '#A2')
+
+    def test_deferred_finish(self):
+        registry = DummyRegistry()
+        tracer = MockTracer()
+        registry.settings['ot.tracing'] = PyramidTracing(tracer)
+        registry.settings['ot.deferred_finish'] = 'response'
+
+        req = DummyRequest()
+        response = Response()
+        tween = opentracing_tween_factory(lambda req: response, registry)
+        self.assertIs(response, tween(req), '#A0')
+        self.assertEqual([], tracer.finished_spans(), '#A1')
+
+        # the body is still to be sent at the end of the request.
+        req._process_finished_callbacks()
+        self.assertEqual([], tracer.finished_spans(), '#B0')
+        response.app_iter.close()
+        self.assertEqual(1, len(tracer.finished_spans()), '#B1')
+
+    def test_baggage(self):
+        registry = DummyRegistry()
+        tracing = PyramidTracing(MockTracer())
+        registry.settings['ot.tracing'] = tracing
+
+        opentracing_tween_factory(lambda req: None, registry)
+        self.assertIsNone(tracing._config.baggage, '#A0')
+
+        registry.settings['ot.baggage_keys'] = 'user tenant'
+        registry.settings['ot.baggage_max_bytes'] = '1024'
+        registry.settings['ot.baggage_tags'] = 'tenant'
+        opentracing_tween_factory(lambda req: None, registry)
+        policy = tracing._config.baggage
+        self.assertEqual(frozenset(['user', 'tenant']), policy.allowed_keys,
+                         '#B0')
+        self.assertEqual((None, 1024), (policy.max_item_bytes,
+                                        policy.max_total_bytes), '#B1')
+        self.assertEqual(('tenant',), policy.tag_keys, '#B2')
+        self.assertTrue(tracing._config.track_spans, '#B3')
+
+    def test_response_headers(self):
+        registry = DummyRegistry()
+        tracer = MockTracer()
+        registry.settings['ot.tracing'] = PyramidTracing(tracer)
+        registry.settings['ot.response_headers'] = 'traceresponse'
+
+        response = DummyResponse()
+        tween = opentracing_tween_factory(lambda req: response, registry)
+        self.assertIs(response, tween(DummyRequest()), '#A0')
+        self.assertEqual(['traceresponse'], list(response.headers), '#A1')
+
     def test_tracetags_as_str(self):
         registry = DummyRegistry()
         tracer = MockTracer()
@@ -661,6 +2104,103 @@ class TestTweenFactory(unittest.TestCase):
 
         self.assertIsNone(registry.settings['ot.tracing'].tracer.active_span)
 
+    def test_resource_usage(self):
+        registry = DummyRegistry()
+        tracer = MockTracer()
+        registry.settings['ot.tracing'] = PyramidTracing(tracer)
+        registry.settings['ot.resource_usage'] = 'true'
+
+        self._call(registry=registry)
+        spans = tracer.finished_spans()
+        self.assertEqual(1, len(spans), '#A0')
+        self.assertTrue('resource.wall_ms' in spans[0].tags, '#A1')
+
+        stats = registry.settings['ot.tracing'].route_stats.snapshot()
+        self.assertEqual(1, stats['GET']['count'], '#B0')
+
+    def test_limits(self):
+        registry = DummyRegistry()
+        tracer = MockTracer()
+        tracing = PyramidTracing(tracer)
+        registry.settings['ot.tracing'] = tracing
+        registry.settings['ot.max_child_spans'] = '1'
+
+        def handler(req):
+            tracing.tracer.start_span('child1').finish()
+            tracing.tracer.start_span('child2').finish()
+
+        self._call(registry=registry, handler=handler)
+        spans = tracer.finished_spans()
+        self.assertEqual(2, len(spans), '#A0')
+        self.assertEqual(1, spans[1].tags['limits.dropped_spans'], '#A1')
+        self.assertEqual(1, tracing._limits.max_child_spans, '#A2')
+
+    def test_error_mode_compact(self):
+        registry = DummyRegistry()
+        tracer = MockTracer()
+        registry.settings['ot.tracing'] = PyramidTracing(tracer)
+        registry.settings['ot.error_mode'] = 'compact'
+
+        def handler(req):
+            raise ValueError('Testing error')
+
+        with self.assertRaises(ValueError):
+            self._call(registry=registry, handler=handler)
+
+        spans = tracer.finished_spans()
+        self.assertEqual(1, len(spans), '#A0')
+        self.assertEqual('ValueError',
+                         spans[0].logs[0].key_values['error.kind'], '#A1')
+        self.assertFalse('error.object' in spans[0].logs[0].key_values)
+
+    def test_dependencies(self):
+        registry = DummyRegistry()
+        tracer = MockTracer()
+        tracing = PyramidTracing(tracer)
+        registry.settings['ot.tracing'] = tracing
+        registry.settings['ot.dependencies'] = 'true'
+        registry.settings['ot.service_name'] = 'front'
+
+        def handler(req):
+            tracing.tracer.start_span('query', tags={
+                tags.SPAN_KIND: tags.SPAN_KIND_RPC_CLIENT,
+                tags.PEER_SERVICE: 'db',
+            }).finish()
+
+        self._call(registry=registry, handler=handler)
+        edges = tracing.dependencies.export()['edges']
+        self.assertEqual(1, len(edges), '#A0')
+        self.assertEqual(('front', 'GET', 'db', 'query', 1),
+                         (edges[0]['caller'], edges[0]['route'],
+                          edges[0]['peer'], edges[0]['operation'],
+                          edges[0]['calls']), '#A1')
+
+    def test_pressure(self):
+        registry = DummyRegistry()
+        tracer = MockTracer()
+        tracing = PyramidTracing(tracer)
+        registry.settings['ot.tracing'] = tracing
+        registry.settings['ot.max_in_flight'] = '2'
+        registry.settings['ot.pressure_hold'] = '0'
+
+        def handler(req):
+            # A nested request drives the worker over its maximum.
+            if req.path == '/':
+                tween(DummyRequest(path='/1'))
+
+        tween = opentracing_tween_factory(handler, registry)
+        tween(DummyRequest())
+
+        spans = tracer.finished_spans()
+        self.assertEqual(2, len(spans), '#A0')
+        self.assertEqual('reduced', spans[0].tags['pyramid.tracing_level'])
+        self.assertEqual('full', spans[1].tags['pyramid.tracing_level'])
+
+        stats = tracing.get_stats()['pressure']
+        self.assertEqual(0, stats['in_flight'], '#B0')
+        self.assertEqual({'full': 1, 'reduced': 1, 'root_only': 0, 'off': 0},
+                         stats['requests'], '#B1')
+
 
 class TestIncludeme(unittest.TestCase):
 
@@ -672,6 +2212,282 @@ class TestIncludeme(unittest.TestCase):
             INGRESS,
             None
         )])
+        self.assertEqual([], config.routes)
+        self.assertEqual([], config.subscribers)
+
+    def test_phases(self):
+        config = DummyConfig({'ot.phases': 'spans'})
+        includeme(config)
+        self.assertEqual([NewRequest, ContextFound, BeforeRender, NewResponse],
+                         [iface for _, iface in config.subscribers], '#A0')
+
+    def test_phases_app(self):
+        tracer = MockTracer()
+        config = Configurator(settings={
+            'ot.tracing': PyramidTracing(tracer),
+            'ot.phases': 'true',
+        })
+        config.include('pyramid_opentracing')
+        config.add_route('items', '/items')
+        config.add_view(lambda req: {'items': list(range(100))},
+                        route_name='items', renderer='json')
+        app = config.make_wsgi_app()
+
+        response = Request.blank('/items').get_response(app)
+        self.assertEqual(200, response.status_code, '#A0')
+
+        span = tracer.finished_spans()[0]
+        self.assertEqual('items', span.tags['pyramid.route'], '#A1')
+        self.assertEqual(['routing', 'view', 'render'],
+                         [name for name in ('routing', 'view', 'render',
+                                            'callbacks')
+                          if 'pyramid.phase.%s_ms' % name in span.tags],
+                         '#A2')
+
+    def test_phases_trace_deferred(self):
+        tracer = MockTracer()
+        tracing = PyramidTracing(tracer)
+        config = Configurator(settings={
+            'ot.tracing': tracing,
+            'ot.trace_all': 'false',
+            'ot.phases': 'true',
+            'ot.deferred_finish': 'response',
+        })
+        config.include('pyramid_opentracing')
+
+        def slow_renderer(info):
+            def render(value, system):
+                time.sleep(0.02)
+                return json.dumps(value)
+            return render
+
+        config.add_renderer('slow', slow_renderer)
+        config.add_route('items', '/items')
+        config.add_view(tracing.trace()(lambda req: {'items': []}),
+                        route_name='items', renderer='slow')
+        app = config.make_wsgi_app()
+
+        response = Request.blank('/items').get_response(app)
+        self.assertEqual(b'{"items": []}', response.body, '#A0')
+
+        # the renderer runs after the span of the view ended,
+        # and is not reported as part of the callbacks.
+        span = tracer.finished_spans()[0]
+        self.assertEqual(['view'],
+                         [name for name in ('routing', 'view', 'render',
+                                            'callbacks')
+                          if 'pyramid.phase.%s_ms' % name in span.tags],
+                         '#A1')
+        self.assertTrue(span.tags['pyramid.phase.view_ms'] < 20, '#A2')
+
+    def test_exemplars_view(self):
+        config = DummyConfig({'ot.exemplars_path': '/_exemplars'})
+        includeme(config)
+        self.assertEqual([('ot.exemplars', '/_exemplars')], config.routes)
+        self.assertEqual([(exemplars_view, 'ot.exemplars')], config.views)
+
+        request = DummyRequest()
+        request.registry = DummyRegistry()
+        with self.assertRaises(HTTPNotFound):
+            exemplars_view(request)
+
+        tracing = PyramidTracing(MockTracer(), exemplars=True)
+        request.registry.settings['ot.tracing'] = tracing
+        response = exemplars_view(request)
+        self.assertTrue(response.content_type.startswith(
+            'application/openmetrics-text'))
+        self.assertTrue(response.text.endswith('# EOF\n'))
+
+    def test_dependencies_view(self):
+        config = DummyConfig({'ot.dependencies_path': '/_dependencies'})
+        includeme(config)
+        self.assertEqual([('ot.dependencies', '/_dependencies')],
+                         config.routes)
+        self.assertEqual([(dependencies_view, 'ot.dependencies')],
+                         config.views)
+
+        request = DummyRequest()
+        request.registry = DummyRegistry()
+        with self.assertRaises(HTTPNotFound):
+            dependencies_view(request)
+
+        graph = DependencyGraph('front')
+        graph.record('front', 'GET', 'db', 'query', 0.01)
+        tracing = PyramidTracing(MockTracer(), dependencies=graph)
+        request.registry.settings['ot.tracing'] = tracing
+        response = dependencies_view(request)
+        self.assertEqual('application/json', response.content_type)
+        self.assertEqual('front', response.json_body['service'])
+        self.assertEqual(1, response.json_body['edges'][0]['calls'])
+
+    def test_timeline_view(self):
+        config = DummyConfig({'ot.timeline_path': '/_timeline'})
+        includeme(config)
+        self.assertEqual([('ot.timeline', '/_timeline')], config.routes)
+        self.assertEqual([(timeline_view, 'ot.timeline')], config.views)
+
+        request = DummyRequest()
+        request.registry = DummyRegistry()
+        with self.assertRaises(HTTPNotFound):
+            timeline_view(request)
+
+        tracing = PyramidTracing(MockTracer(), timeline=TraceBuffer())
+        req = DummyRequest()
+        tracing._apply_tracing(req, [])
+        tracing.tracer.start_span('<child>').finish()
+        tracing._finish_tracing(req)
+        trace_id = tracing.timeline.traces()[0].trace_id
+
+        request.registry.settings['ot.tracing'] = tracing
+        response = timeline_view(request)
+        self.assertEqual('text/html', response.content_type, '#A0')
+        self.assertTrue('?trace_id=%s' % trace_id in response.text, '#A1')
+
+        request = DummyRequest(params={'trace_id': trace_id})
+        request.registry = DummyRegistry()
+        request.registry.settings['ot.tracing'] = tracing
+        response = timeline_view(request)
+        self.assertTrue('&lt;child&gt;' in response.text, '#B0')
+        self.assertTrue('Critical path' in response.text, '#B1')
+
+        request = DummyRequest(params={'trace_id': 'foo'})
+        request.registry = DummyRegistry()
+        request.registry.settings['ot.tracing'] = tracing
+        with self.assertRaises(HTTPNotFound):
+            timeline_view(request)
+
+
+class TestConcurrency(unittest.TestCase):
+    THREADS = 16
+    REQUESTS = 50
+
+    def setUp(self):
+        # switch threads as often as possible.
+        if hasattr(sys, 'setswitchinterval'):
+            self._switch_interval = sys.getswitchinterval()
+            sys.setswitchinterval(1e-6)
+        else:  # Python 2.
+            self._check_interval = sys.getcheckinterval()
+            sys.setcheckinterval(1)
+
+    def tearDown(self):
+        if hasattr(sys, 'setswitchinterval'):
+            sys.setswitchinterval(self._switch_interval)
+        else:
+            sys.setcheckinterval(self._check_interval)
+
+    def _get_tween(self, handler, **settings):
+        registry = DummyRegistry()
+        tracer = MockTracer(ThreadLocalScopeManager())
+        tracing = PyramidTracing(tracer)
+        registry.settings['ot.tracing'] = tracing
+        registry.settings.update(settings)
+        return tracing, tracer, opentracing_tween_factory(handler, registry)
+
+    def _run_threads(self, target, count):
+        errors = []
+
+        def run():
+            try:
+                target()
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=run) for _ in range(count)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(30)
+
+        self.assertEqual([], errors)
+
+    def test_stress(self):
+        leaks = []
+
+        def handler(req):
+            tracer = tracing.tracer
+            root = tracing.get_span(req)
+            for i in range(2):
+                with tracer.start_active_span('child') as scope:
+                    if scope.span.parent_id != root.context.span_id:
+                        leaks.append(scope.span)
+
+        tracing, tracer, tween = self._get_tween(
+            handler, **{
+                'ot.max_child_spans': '10',
+                'ot.resource_usage': 'true',
+                'ot.exemplars': 'true',
+                'ot.max_in_flight': '1000',
+                'ot.pressure_hold': '0',
+            })
+
+        def send_requests():
+            for i in range(self.REQUESTS):
+                tween(DummyRequest(path='/%d' % i))
+                if tracing.tracer.active_span is not None:
+                    leaks.append(tracing.tracer.active_span)
+
+        done = threading.Event()
+
+        def reconfigure():
+            while not done.is_set():
+                tracing.configure(start_span_cb=lambda span, req: None)
+                tracing.configure(start_span_cb=None)
+
+        reconfigurer = threading.Thread(target=reconfigure)
+        reconfigurer.start()
+        try:
+            self._run_threads(send_requests, self.THREADS)
+        finally:
+            done.set()
+            reconfigurer.join()
+
+        total = self.THREADS * self.REQUESTS
+        self.assertEqual([], leaks, '#A0')
+
+        spans = tracer.finished_spans()
+        roots = dict((span.context.span_id, span) for span in spans
+                     if span.parent_id is None)
+        self.assertEqual(total * 3, len(spans), '#B0')
+        self.assertEqual(total, len(roots), '#B1')
+        self.assertEqual(total, len(set(span.context.trace_id
+                                        for span in roots.values())), '#B2')
+        for span in spans:
+            if span.parent_id is not None:
+                root = roots[span.parent_id]
+                self.assertEqual(root.context.trace_id, span.context.trace_id)
+
+        self.assertEqual(total, tracing.route_stats.snapshot()['GET']['count'],
+                         '#C0')
+        stats = tracing.get_stats()['pressure']
+        self.assertEqual(0, stats['in_flight'], '#C1')
+        self.assertEqual(total, sum(stats['requests'].values()), '#C2')
+
+    def test_no_serialization(self):
+        # Every request waits for all the others to be in their
+        # handler: this only completes if tracing lets them run at once.
+        # (threading.Barrier is not available on Python 2).
+        lock = threading.Lock()
+        arrived = []
+        all_arrived = threading.Event()
+
+        def handler(req):
+            with lock:
+                arrived.append(req)
+                if len(arrived) == self.THREADS:
+                    all_arrived.set()
+            if not all_arrived.wait(10):
+                raise RuntimeError('the requests were serialized')
+
+        tracing, tracer, tween = self._get_tween(
+            handler, **{
+                'ot.max_child_spans': '10',
+                'ot.resource_usage': 'true',
+                'ot.max_in_flight': '1000',
+            })
+
+        self._run_threads(lambda: tween(DummyRequest()), self.THREADS)
+        self.assertEqual(self.THREADS, len(tracer.finished_spans()), '#A0')
 
 
 class DummyTracer(MockTracer):
@@ -695,12 +2511,28 @@ class DummyRegistry(object):
 
 
 class DummyConfig(object):
-    def __init__(self):
+    def __init__(self, settings=None):
         self.tweens = []
+        self.routes = []
+        self.views = []
+        self.subscribers = []
+        self.settings = settings or {}
+
+    def get_settings(self):
+        return self.settings
 
     def add_tween(self, x, under=None, over=None):
         self.tweens.append((x, under, over))
 
+    def add_route(self, name, pattern):
+        self.routes.append((name, pattern))
+
+    def add_view(self, view, route_name=None):
+        self.views.append((view, route_name))
+
+    def add_subscriber(self, subscriber, iface):
+        self.subscribers.append((subscriber, iface))
+
 
 class DummyRequest(testing.DummyRequest):
     def __init__(self, *args, **kwargs):
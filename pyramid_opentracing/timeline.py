@@ -0,0 +1,98 @@
+import itertools
+import time
+
+from pyramid.settings import asbool
+
+from .analysis import critical_path
+
+
+DEFAULT_CAPACITY = 100
+
+
+class Trace(object):
+    """
+    A completed request trace, as kept by TraceBuffer.
+    @param trace_id the hex-encoded trace id, if the tracer exposes it
+    @param operation_name the route (or operation) name
+    @param timestamp the wall clock time the request started at
+    @param duration the request duration, in seconds
+    @param error whether the request failed
+    @param spans the SpanRecords of the request, the root one first
+    and every parent before its children
+    """
+    def __init__(self, trace_id, operation_name, timestamp, duration,
+                 error, spans):
+        self.trace_id = trace_id
+        self.operation_name = operation_name
+        self.timestamp = timestamp
+        self.duration = duration
+        self.error = error
+        self.spans = spans
+
+    def critical_path(self):
+        return critical_path(self.spans)
+
+
+class TraceBuffer(object):
+    """
+    Fixed-size ring buffer of the last completed request traces, with
+    their span tree, durations and tags, for local debugging without
+    a collector. Adding a trace is O(1) and takes no locks: the slot
+    comes from an atomic counter, and is replaced with a single
+    reference assignment.
+    @param capacity the number of traces kept
+    """
+    def __init__(self, capacity=DEFAULT_CAPACITY):
+        self.capacity = capacity
+        self._slots = [None] * capacity
+        self._counter = itertools.count()
+
+    @classmethod
+    def from_settings(cls, settings):
+        """
+        Returns a TraceBuffer from the 'ot.timeline_capacity' setting,
+        or None unless 'ot.timeline' is set.
+        """
+        if not asbool(settings.get('ot.timeline', False)):
+            return None
+
+        return cls(int(settings.get('ot.timeline_capacity',
+                                    DEFAULT_CAPACITY)))
+
+    def add(self, trace):
+        sequence = next(self._counter)
+        self._slots[sequence % self.capacity] = (sequence, trace)
+
+    def record_request(self, trace_id, operation_name, duration, error,
+                       records):
+        """
+        Adds the trace of a finished request.
+        @param trace_id the hex-encoded trace id, or None
+        @param operation_name the route (or operation) name
+        @param duration the request duration, in seconds
+        @param error whether the request failed
+        @param records the SpanRecords of the request
+        """
+        self.add(Trace(trace_id, operation_name, time.time() - duration,
+                       duration, error, records))
+
+    def traces(self):
+        """
+        Returns the kept traces, the most recent first.
+        """
+        slots = [slot for slot in list(self._slots) if slot is not None]
+        slots.sort(key=lambda slot: slot[0], reverse=True)
+        return [trace for _, trace in slots]
+
+    def get(self, trace_id):
+        """
+        Returns the kept trace with this trace id, or None.
+        """
+        for trace in self.traces():
+            if trace.trace_id == trace_id:
+                return trace
+
+        return None
+
+    def clear(self):
+        self._slots = [None] * self.capacity
@@ -1,7 +1,93 @@
+import functools
+import threading
+
 import opentracing
 from opentracing.ext import tags
 
-from ._constants import SCOPE_ATTR
+from ._constants import (
+    SCOPE_ATTR,
+    CLOCK_ATTR,
+    CONFIG_ATTR,
+    LOG_BUFFER_ATTR,
+    OPERATION_ATTR,
+    PHASES_ATTR,
+    RESOURCE_ATTR,
+)
+from ._ids import is_sampled, span_ids
+from ._request_tracer import RequestSpan, RequestState, RequestTracer
+from .attributes import compile_attributes
+from .baggage import TAG_PREFIX as BAGGAGE_TAG_PREFIX
+from .cardinality import OPERATION_KEY
+from .clock import Clock
+from .errors import ErrorRecorder, ERROR_MODE_COMPACT, ERROR_MODES
+from .exemplars import ExemplarTable
+from .limits import SpanLimits
+from .phases import (
+    END,
+    PHASE_MODES,
+    PHASES_SPANS,
+    PHASE_TAG,
+    TAG_PREFIX,
+    get_phases,
+    start_phases,
+)
+from .pressure import LEVEL_FULL, LEVEL_REDUCED, LEVEL_ROOT_ONLY, LEVEL_NAMES
+from .resource_usage import ResourceUsage
+from .stats import RouteStats
+from .tasks import trace_task, DEFAULT_HEADERS_KWARG
+
+
+# the clock used unless one is set, whose wall clock is the one the
+# tracers read by default.
+_DEFAULT_CLOCK = Clock()
+
+
+class _TracingConfig(object):
+    """
+    The options of a PyramidTracing. Never modified once created:
+    PyramidTracing.configure() swaps it for an updated copy instead.
+    """
+    FIELDS = ('start_span_cb', 'trace_all', 'resource_usage', 'limits',
+              'error_recorder', 'exemplars', 'pressure_monitor',
+              'dependencies', 'timeline', 'trace_summary', 'cardinality',
+              'response_headers', 'phases', 'clock', 'recorder', 'finisher',
+              'baggage')
+
+    def __init__(self, **values):
+        for name in self.FIELDS:
+            setattr(self, name, values.pop(name, None))
+
+        if values:
+            raise TypeError('Unknown tracing options: %s' %
+                            ', '.join(sorted(values)))
+
+        if self.start_span_cb is not None and not callable(self.start_span_cb):
+            raise ValueError('start_span_cb is not callable')
+
+        if self.phases is not None and self.phases not in PHASE_MODES:
+            raise ValueError('phases must be one of %s' %
+                             ', '.join(PHASE_MODES))
+
+        self.trace_all = bool(self.trace_all)
+        if self.clock is None:
+            self.clock = _DEFAULT_CLOCK
+
+        # whether the spans started while serving a request need to be
+        # accounted for, or timestamped by a clock other than the one
+        # the tracer reads by default.
+        self.custom_clock = self.clock is not _DEFAULT_CLOCK
+        self.track_spans = (self.custom_clock or
+                            self.limits is not None or
+                            self.pressure_monitor is not None or
+                            self.dependencies is not None or
+                            self.timeline is not None or
+                            self.baggage is not None or
+                            bool(self.trace_summary))
+
+    def copy(self, **changes):
+        values = dict((name, getattr(self, name)) for name in self.FIELDS)
+        values.update(changes)
+        return _TracingConfig(**values)
 
 
 # Ported from the Django library:
@@ -10,14 +96,147 @@ class PyramidTracing(object):
     """
     @param tracer the OpenTracing tracer to be used
     to trace requests using this PyramidTracing
+    @param resource_usage whether to tag spans with the CPU time, gc pauses
+    and context switches consumed by each request, and aggregate them
+    per route in route_stats
+    @param trace_memory whether to also report the tracemalloc peak,
+    only used if resource_usage is enabled
+    @param limits an optional SpanLimits bounding the child spans, logs
+    and tags a single request can accumulate
+    @param error_mode 'object' to log the exception object itself, or
+    'compact' to log its kind, message and a deduplicated stack
+    @param exemplars whether to keep a latency histogram per route in
+    exemplars, linking each bucket to its most recent sampled trace
+    @param pressure_monitor an optional PressureMonitor the tween uses
+    to step tracing down when the worker is overloaded
+    @param tracer_factory an optional callable returning the tracer,
+    invoked the first time the tracer is used, if none was passed
+    @param dependencies an optional DependencyGraph aggregating the
+    calls made by the traced requests
+    @param timeline an optional TraceBuffer keeping the last traces
+    @param trace_summary the number of operations to report in the
+    self time and critical path summary tags of the request spans,
+    or None to leave them out
+    @param cardinality an optional CardinalityLimiter bounding the
+    distinct operation names and traced attribute values
+    @param response_headers an optional ResponseHeaders adding the
+    trace context and timings to the responses
+    @param phases 'tags' to tag the sampled request spans with the time
+    spent routing, in the view and rendering, or 'spans' to add a child
+    span per phase, see includeme() for the event subscribers
+    @param clock an optional Clock the requests take their timestamps
+    from, passed as the explicit start and finish times of their spans
+    @param recorder an optional EnvelopeRecorder recording the traced
+    requests, to be replayed by the replay module
+    @param finisher an optional ResponseFinisher or BackgroundFinisher
+    completing the tracing of the requests (tagging, logging the error
+    and finishing their spans) off the path of their response
+    @param baggage an optional BaggagePolicy trimming the baggage of the
+    requests, and promoting some of its items to tags
+
+    The same instance is shared by all the request threads, so its
+    options are not modified in place once set: configure() replaces
+    them all at once, and each request keeps using the ones it started
+    with. No lock is taken while tracing requests.
     """
-    def __init__(self, tracer=None, start_span_cb=None):
-        if start_span_cb is not None and not callable(start_span_cb):
-            raise ValueError('start_span_cb is not callable')
+    def __init__(self, tracer=None, start_span_cb=None,
+                 resource_usage=False, trace_memory=False, limits=None,
+                 error_mode='object', exemplars=False,
+                 pressure_monitor=None, tracer_factory=None,
+                 dependencies=None, timeline=None, trace_summary=None,
+                 cardinality=None, response_headers=None, phases=None,
+                 clock=None, recorder=None, finisher=None, baggage=None):
+        if tracer_factory is not None and not callable(tracer_factory):
+            raise ValueError('tracer_factory is not callable')
+
+        if error_mode not in ERROR_MODES:
+            raise ValueError('error_mode must be one of %s' %
+                             ', '.join(ERROR_MODES))
 
         self._tracer_obj = tracer
-        self._start_span_cb = start_span_cb
-        self._trace_all = False
+        self._tracer_factory = tracer_factory
+        self._tracer_lock = threading.Lock()
+        self._request_tracer = None
+        self.route_stats = RouteStats()
+
+        self._config = _TracingConfig(
+            start_span_cb=start_span_cb,
+            trace_all=False,
+            resource_usage=(ResourceUsage(trace_memory) if resource_usage
+                            else None),
+            limits=limits,
+            error_recorder=(ErrorRecorder()
+                            if error_mode == ERROR_MODE_COMPACT else None),
+            exemplars=ExemplarTable() if exemplars else None,
+            pressure_monitor=pressure_monitor,
+            dependencies=dependencies,
+            timeline=timeline,
+            trace_summary=trace_summary,
+            cardinality=cardinality,
+            response_headers=response_headers,
+            phases=phases,
+            clock=clock,
+            recorder=recorder,
+            finisher=finisher,
+            baggage=baggage,
+        )
+
+    def configure(self, **changes):
+        """
+        Atomically replaces some of the options, e.g. trace_all,
+        start_span_cb, limits, trace_summary, or the resource_usage,
+        error_recorder, exemplars, pressure_monitor, dependencies,
+        timeline, cardinality, response_headers, recorder, finisher and
+        baggage objects, the phases mode (None to disable them) or the
+        clock.
+        Requests being traced keep the options they started with.
+        """
+        self._config = self._config.copy(**changes)
+
+    @property
+    def _trace_all(self):
+        return self._config.trace_all
+
+    @property
+    def _start_span_cb(self):
+        return self._config.start_span_cb
+
+    @property
+    def _resource_usage(self):
+        return self._config.resource_usage
+
+    @property
+    def _limits(self):
+        return self._config.limits
+
+    @property
+    def _error_recorder(self):
+        return self._config.error_recorder
+
+    @property
+    def _pressure_monitor(self):
+        return self._config.pressure_monitor
+
+    @property
+    def exemplars(self):
+        """
+        The ExemplarTable, if enabled.
+        """
+        return self._config.exemplars
+
+    @property
+    def dependencies(self):
+        """
+        The DependencyGraph, if enabled.
+        """
+        return self._config.dependencies
+
+    @property
+    def timeline(self):
+        """
+        The TraceBuffer, if enabled.
+        """
+        return self._config.timeline
 
     @property
     def _tracer(self):
@@ -30,10 +249,33 @@ class PyramidTracing(object):
     def tracer(self):
         """
         ADD docs here.
+        If limits, a pressure monitor, a dependency graph, a timeline,
+        the trace summary, a baggage policy or a clock are set, the
+        tracer is wrapped so the spans started while serving a request
+        are accounted for, and timestamped by the request clock.
         """
-        if self._tracer_obj is None:
+        tracer = self._tracer_obj
+        if tracer is None:
+            tracer = self._create_tracer()
+
+        config = self._config
+        if not config.track_spans:
+            return tracer
+
+        request_tracer = self._request_tracer
+        if request_tracer is None or request_tracer.tracer is not tracer:
+            request_tracer = self._request_tracer = RequestTracer(tracer)
+
+        return request_tracer
+
+    def _create_tracer(self):
+        if self._tracer_factory is None:
             return opentracing.tracer
 
+        with self._tracer_lock:
+            if self._tracer_obj is None:
+                self._tracer_obj = self._tracer_factory()
+
         return self._tracer_obj
 
     def get_span(self, request):
@@ -49,100 +291,368 @@ class PyramidTracing(object):
         Function decorator that traces functions
         NOTE: Must be placed after the @view_config decorator
         @param attributes any number of pyramid.request.Request attributes
-        (strings) to be set as tags on the created span
+        (specs such as 'path' or 'headers[User-Agent]|max_length=64', or
+        TracedAttribute objects) to be set as tags on the created span
         """
+        attributes = compile_attributes(attributes)
+
         def decorator(view_func):
             def wrapper(request):
                 if self._trace_all:
                     return view_func(request)
 
-                self._apply_tracing(request, list(attributes))
+                self._apply_tracing(request, attributes)
                 try:
                     r = view_func(request)
                 except Exception as e:
-                    self._finish_tracing(request, error=e)
+                    self._finish_tracing(request, error=e, in_view=True)
                     raise
 
-                self._finish_tracing(request)
+                if getattr(r, 'headers', None) is not None:
+                    self._finish_tracing(request, response=r, in_view=True)
+                else:  # Rendered into request.response.
+                    self._finish_tracing(request, response=request.response,
+                                         in_view=True)
                 return r
 
             return wrapper
         return decorator
 
+    def trace_task(self, operation_name=None,
+                   headers_kwarg=DEFAULT_HEADERS_KWARG, batch=False):
+        """
+        Function decorator that traces background tasks, following from
+        the span that enqueued them (see tasks.inject_task_headers)
+        @param operation_name the operation name, defaults to the
+        function name
+        @param headers_kwarg the keyword argument carrying the headers
+        @param batch whether headers_kwarg is a list of headers,
+        one per processed task
+        """
+        return trace_task(self, operation_name, headers_kwarg, batch)
+
     def _get_operation_name(self, request):
         if getattr(request, 'matched_route', None) is None:
-            return request.method
+            name = request.method
+        else:
+            name = request.matched_route.name
+
+        cardinality = getattr(request, CONFIG_ATTR, self._config).cardinality
+        if cardinality is None:
+            return name
+
+        # limited once per request, unless the route was matched
+        # after the span started.
+        cached = getattr(request, OPERATION_ATTR, None)
+        if cached is not None and cached[0] == name:
+            return cached[1]
 
-        return request.matched_route.name
+        limited = cardinality.limit(OPERATION_KEY, name)
+        setattr(request, OPERATION_ATTR, (name, limited))
+        return limited
 
-    def _apply_tracing(self, request, attributes):
+    def get_stats(self):
+        """
+        Returns a dictionary with the per-route aggregates and,
+        if set, the current state of the pressure monitor and the
+        estimated cardinalities of the operation names and tags.
+        """
+        config = self._config
+        stats = {'routes': self.route_stats.snapshot()}
+        if config.pressure_monitor is not None:
+            stats['pressure'] = config.pressure_monitor.get_stats()
+        if config.cardinality is not None:
+            stats['cardinality'] = config.cardinality.get_stats()
+
+        return stats
+
+    def _apply_tracing(self, request, attributes, level=LEVEL_FULL):
         """
         Helper function to avoid rewriting for middleware and decorator.
         Returns a new span from the request with logged attributes and
         correct operation name from the view_func.
+        The level, as decided by the pressure monitor, may leave out
+        the traced attributes, the callback and the child spans.
         """
+        config = self._config
+        setattr(request, CONFIG_ATTR, config)
         headers = request.headers
         operation_name = self._get_operation_name(request)
 
+        # trimmed before the tracer copies it into the span contexts.
+        trimmed_baggage = 0
+        if config.baggage is not None:
+            headers, trimmed_baggage = config.baggage.trim_carrier(headers)
+
         # start new span from trace info
         try:
             span_ctx = self._tracer.extract(opentracing.Format.HTTP_HEADERS,
                                             headers)
-            scope = self._tracer.start_active_span(operation_name,
-                                                   child_of=span_ctx)
         except (opentracing.InvalidCarrierException,
                 opentracing.SpanContextCorruptedException):
-            scope = self._tracer.start_active_span(operation_name)
+            span_ctx = None
+
+        # the request and all of its spans are timed from here.
+        clock = config.clock.request_clock()
+        setattr(request, CLOCK_ATTR, clock)
+
+        scope = self._start_active_span(config, operation_name, span_ctx,
+                                        level, clock)
 
         # add span to current spans
         setattr(request, SCOPE_ATTR, scope)
+        if config.phases is not None and is_sampled(scope.span):
+            start_phases(request, clock.start)
 
         # Standard tags.
         scope.span.set_tag(tags.COMPONENT, 'pyramid')
         scope.span.set_tag(tags.SPAN_KIND, tags.SPAN_KIND_RPC_SERVER)
         scope.span.set_tag(tags.HTTP_METHOD, request.method)
         scope.span.set_tag(tags.HTTP_URL, request.path_url)
+        if config.pressure_monitor is not None:
+            scope.span.set_tag('pyramid.tracing_level', LEVEL_NAMES[level])
+        if trimmed_baggage:
+            scope.span.set_tag(BAGGAGE_TAG_PREFIX + 'trimmed',
+                               trimmed_baggage)
+        if config.baggage is not None and span_ctx is not None:
+            config.baggage.promote(scope.span, span_ctx.baggage,
+                                   config.cardinality)
+
+        if level < LEVEL_REDUCED:
+            # log any traced attributes
+            for attr in compile_attributes(attributes):
+                attr.apply(scope.span, request, config.cardinality)
 
-        # log any traced attributes
-        for attr in attributes:
-            if hasattr(request, attr):
-                payload = str(getattr(request, attr))
-                if payload:
-                    scope.span.set_tag(attr, payload)
+            # invoke the start span callback, if any
+            self._call_start_span_cb(config, scope.span, request)
 
-        # invoke the start span callback, if any
-        self._call_start_span_cb(scope.span, request)
+        if config.resource_usage is not None:
+            setattr(request, RESOURCE_ATTR, config.resource_usage.snapshot())
 
         return scope.span
 
-    def _finish_tracing(self, request, error=None):
+    def _start_active_span(self, config, operation_name, span_ctx, level,
+                           clock):
+        # the span is finished by _finish_tracing(), with the clock.
+        tracer = self._tracer
+        limits = config.limits
+        if level >= LEVEL_ROOT_ONLY:
+            limits = (limits or SpanLimits()).copy(max_child_spans=0)
+
+        if (limits is None and config.dependencies is None and
+                config.timeline is None and config.baggage is None and
+                not config.trace_summary and not config.custom_clock):
+            return tracer.start_active_span(operation_name, child_of=span_ctx,
+                                            start_time=clock.wall,
+                                            finish_on_close=False)
+
+        state = RequestState(limits or SpanLimits(),
+                             track_calls=config.dependencies is not None,
+                             record_spans=config.timeline is not None,
+                             summary_size=config.trace_summary,
+                             clock=clock,
+                             baggage=config.baggage)
+        return tracer.start_active_root_span(state, operation_name, span_ctx,
+                                             finish_on_close=False)
+
+    def _finish_tracing(self, request, error=None, response=None,
+                        in_view=False):
+        """
+        Ends the tracing of a request. Only what has to happen before the
+        response is returned is done right away: reading the end time,
+        the status and the resource usage, setting the response headers
+        and deactivating the span. The rest is done by _complete_tracing(),
+        through the finisher if any.
+        @param response the response about to be returned, if any
+        @param in_view whether it is called from the view (see trace()),
+        before the renderer and the response callbacks run
+        """
         scope = getattr(request, SCOPE_ATTR, None)
         if scope is None:
             return
 
         delattr(request, SCOPE_ATTR)
+        config = getattr(request, CONFIG_ATTR, self._config)
+        clock = getattr(request, CLOCK_ATTR)
+        end = clock.now()
+        # the response returned, rather than request.response,
+        # unless it has no status.
+        status = None
+        if error is None:
+            status = getattr(response, 'status_code', None)
+            if status is None:
+                status = request.response.status_code
+
+        times = getattr(request, PHASES_ATTR, None)
+        if times is not None:
+            times[END] = end
+            if in_view:
+                # the phases are frozen, as the renderer and the
+                # callbacks run after the end of the span.
+                delattr(request, PHASES_ATTR)
+
+        if response is not None and config.response_headers is not None:
+            timings = None
+            if times is not None:
+                timings = [(name, (phase_end - start) / 1e9)
+                           for name, start, phase_end in get_phases(times)]
+            config.response_headers.inject(scope.span, response,
+                                           clock.to_seconds(end), timings)
 
-        if error is not None:
-            scope.span.set_tag(tags.ERROR, True)
-            scope.span.log_kv({
-                'event': tags.ERROR,
-                'error.object': error,
-            })
+        self._finish_resource_usage(config, request, scope.span, error)
+
+        # reduced right away, so the exception and its traceback are not
+        # kept alive until the tracing is completed.
+        if error is not None and config.error_recorder is not None:
+            error = config.error_recorder.summarize(error)
+
+        # the span is only deactivated here, and finished once completed.
+        scope.close()
+
+        complete = functools.partial(self._complete_tracing, config, request,
+                                     scope.span, error, status, end, times)
+        if config.finisher is None:
+            complete()
+        else:
+            config.finisher.defer(request, response, complete)
+
+    def _complete_tracing(self, config, request, span, error, status, end,
+                          times=None):
+        """
+        Tags the span, finishes it at the end time and reports the request.
+        @param error the exception, or its summary if there is an
+        error_recorder (see ErrorRecorder.summarize())
+        @param status the response status, None if the request failed
+        @param end the monotonic time the request ended at
+        @param times the phase timestamps of the request, if any
+        """
+        clock = getattr(request, CLOCK_ATTR)
+        duration = clock.to_seconds(end)
+        failed = status is None or status >= 500
+
+        if error is not None and config.error_recorder is not None:
+            config.error_recorder.log_summary(span, error)
+        elif error is not None:
+            self._log_error(span, error, config)
         else:
-            scope.span.set_tag(tags.HTTP_STATUS_CODE,
-                               request.response.status_code)
+            span.set_tag(tags.HTTP_STATUS_CODE, status)
 
         if getattr(request, 'matched_route', None) is not None:
-            scope.span.set_tag('pyramid.route', request.matched_route.name)
+            span.set_tag('pyramid.route', request.matched_route.name)
 
-        scope.close()
+        self._finish_phases(config, request, span, times)
+        self._observe_exemplar(config, request, span, duration)
+        self._flush_log_buffer(request, span, failed, duration)
+
+        span.finish(clock.to_wall(end))
+        self._record_dependencies(config, request, span, failed, duration)
+        self._record_timeline(config, request, span, failed)
+        self._record_envelope(config, request, status, duration)
+
+    def _log_error(self, span, error, config=None):
+        if config is None:
+            config = self._config
+
+        if config.error_recorder is not None:
+            config.error_recorder.log_error(span, error)
+            return
+
+        span.set_tag(tags.ERROR, True)
+        span.log_kv({
+            'event': tags.ERROR,
+            'error.object': error,
+        })
+
+    def _observe_exemplar(self, config, request, span, duration):
+        if config.exemplars is None:
+            return
+
+        ids = span_ids(span) if is_sampled(span) else None
+        config.exemplars.observe(self._get_operation_name(request),
+                                 duration, ids)
+
+    def _record_dependencies(self, config, request, span, failed, duration):
+        # once the span is finished, so its open children are too.
+        if config.dependencies is None or not isinstance(span, RequestSpan):
+            return
+
+        config.dependencies.record_request(request,
+                                           self._get_operation_name(request),
+                                           duration, failed, span.state.calls,
+                                           config.cardinality)
+
+    def _record_timeline(self, config, request, span, failed):
+        if config.timeline is None or not isinstance(span, RequestSpan):
+            return
+
+        config.timeline.record_request(span_ids(span)[0],
+                                       self._get_operation_name(request),
+                                       span.record.duration, failed,
+                                       span.state.records)
+
+    def _finish_phases(self, config, request, span, times):
+        """
+        Sets the phases of the request as tags or child spans of its span.
+        If deferred, they include the response callbacks (unless traced
+        from the view).
+        """
+        if times is None:
+            return
+
+        if getattr(request, PHASES_ATTR, None) is times:
+            delattr(request, PHASES_ATTR)
+        clock = getattr(request, CLOCK_ATTR)
+        phases = get_phases(times)
+
+        if config.phases == PHASES_SPANS:
+            # straight through the tracer, as these are not
+            # started while serving the request.
+            tracer = self._tracer_obj or self._create_tracer()
+            for name, start, end in phases:
+                tracer.start_span(name, child_of=span.context,
+                                  start_time=clock.to_wall(start),
+                                  tags={PHASE_TAG: name}
+                                  ).finish(clock.to_wall(end))
+        else:
+            for name, start, end in phases:
+                span.set_tag('%s%s_ms' % (TAG_PREFIX, name),
+                             round((end - start) / 1e6, 3))
+
+    def _record_envelope(self, config, request, status, duration):
+        if config.recorder is None:
+            return
+
+        config.recorder.record(request, self._get_operation_name(request),
+                               status, duration)
+
+    def _flush_log_buffer(self, request, span, failed, duration):
+        log_buffer = getattr(request, LOG_BUFFER_ATTR, None)
+        if log_buffer is None:
+            return
+
+        delattr(request, LOG_BUFFER_ATTR)
+        log_buffer.flush(span, failed, duration)
+
+    def _finish_resource_usage(self, config, request, span, error):
+        snapshot = getattr(request, RESOURCE_ATTR, None)
+        if snapshot is None:
+            return
+
+        delattr(request, RESOURCE_ATTR)
+
+        usage = config.resource_usage.delta(snapshot)
+        for key, value in usage.items():
+            span.set_tag(key, value)
+
+        self.route_stats.record(self._get_operation_name(request),
+                                usage, error is not None)
 
-    def _call_start_span_cb(self, span, request):
-        if self._start_span_cb is None:
+    def _call_start_span_cb(self, config, span, request):
+        if config.start_span_cb is None:
             return
 
         try:
-            self._start_span_cb(span, request)
+            config.start_span_cb(span, request)
         except Exception:
             # TODO - log the error to the Span?
             pass
@@ -1,12 +1,35 @@
 import importlib
+import time
 from pyramid.settings import asbool, aslist
 from pyramid.tweens import INGRESS
 
+from .attributes import compile_attributes
+from .baggage import BaggagePolicy
+from .cardinality import CardinalityLimiter
+from .clock import Clock
+from .dependencies import DependencyGraph
+from .errors import (
+    ErrorRecorder,
+    DEFAULT_MAX_FINGERPRINTS,
+    ERROR_MODE_COMPACT,
+)
+from .exemplars import ExemplarTable
+from .finisher import finisher_from_settings
+from .limits import SpanLimits
+from .phases import add_subscribers, parse_mode
+from .pressure import PressureMonitor, LEVEL_FULL, LEVEL_OFF
+from .recorder import EnvelopeRecorder
+from .resource_usage import ResourceUsage
+from .response_headers import ResponseHeaders
+from .timeline import TraceBuffer
 from .tracing import PyramidTracing
+from .views import add_views
 
 
 DEFAULT_TWEEN_TRACE_ALL = True
 
+_perf_counter = getattr(time, 'perf_counter', time.time)
+
 
 def _get_callable_from_name(full_name):
     mod_name, func_name = full_name.rsplit('.', 1)
@@ -29,6 +52,25 @@ def _get_deprecated_base_tracer(registry):
     return base_tracer_func(**registry.settings)
 
 
+def _get_tracer_factory(settings):
+    """
+    Returns a function creating the tracer from 'ot.tracer_callable', so
+    that the (possibly heavy) tracer client is only imported and created
+    once the first request is traced.
+    """
+    tracer_callable = settings.get('ot.tracer_callable')
+    tracer_params = settings.get('ot.tracer_parameters', {})
+
+    def create_tracer():
+        func = tracer_callable
+        if not callable(func):
+            func = _get_callable_from_name(func)
+
+        return func(**tracer_params)
+
+    return create_tracer
+
+
 def opentracing_tween_factory(handler, registry):
     """
     The factory method is called once, and we thus retrieve the settings as
@@ -37,7 +79,8 @@ def opentracing_tween_factory(handler, registry):
     it himself, for further usage.
     """
     tracing = registry.settings.get('ot.tracing', None)
-    traced_attrs = aslist(registry.settings.get('ot.traced_attributes', []))
+    traced_attrs = compile_attributes(
+        aslist(registry.settings.get('ot.traced_attributes', [])))
     trace_all = asbool(registry.settings.get('ot.trace_all',
                                              DEFAULT_TWEEN_TRACE_ALL))
     start_span_cb = registry.settings.get('ot.start_span_cb', None)
@@ -53,13 +96,9 @@ def opentracing_tween_factory(handler, registry):
         tracing = tracing_callable(**registry.settings)
 
     if 'ot.tracer_callable' in registry.settings:
-        tracer_callable = registry.settings.get('ot.tracer_callable')
-        tracer_params = registry.settings.get('ot.tracer_parameters', {})
-        if not callable(tracer_callable):
-            tracer_callable = _get_callable_from_name(tracer_callable)
-
-        tracer = tracer_callable(**tracer_params)
-        tracing = PyramidTracing(tracer)
+        tracing = PyramidTracing(
+            tracer_factory=_get_tracer_factory(registry.settings)
+        )
 
     # Try to use the deprecated names.
     base_tracer = _get_deprecated_base_tracer(registry)
@@ -69,25 +108,115 @@ def opentracing_tween_factory(handler, registry):
     if tracing is None:  # Fallback to the global tracer.
         tracing = PyramidTracing()
 
-    tracing._start_span_cb = start_span_cb
-    tracing._trace_all = trace_all
+    # collect every option first, so that they are all swapped at once.
+    changes = {
+        'start_span_cb': start_span_cb,
+        'trace_all': trace_all,
+    }
+
+    if asbool(registry.settings.get('ot.resource_usage', False)):
+        trace_memory = asbool(registry.settings.get('ot.trace_memory', False))
+        changes['resource_usage'] = ResourceUsage(trace_memory)
+
+    limits = SpanLimits.from_settings(registry.settings)
+    if limits is not None:
+        changes['limits'] = limits
+
+    if registry.settings.get('ot.error_mode') == ERROR_MODE_COMPACT:
+        max_fingerprints = int(registry.settings.get(
+            'ot.error_fingerprints', DEFAULT_MAX_FINGERPRINTS))
+        changes['error_recorder'] = ErrorRecorder(max_fingerprints)
+
+    if asbool(registry.settings.get('ot.exemplars', False)):
+        buckets = aslist(registry.settings.get('ot.exemplar_buckets', []))
+        if buckets:
+            changes['exemplars'] = ExemplarTable(buckets)
+        else:
+            changes['exemplars'] = ExemplarTable()
+
+    pressure = PressureMonitor.from_settings(registry.settings)
+    if pressure is not None:
+        changes['pressure_monitor'] = pressure
+
+    dependencies = DependencyGraph.from_settings(registry.settings)
+    if dependencies is not None:
+        changes['dependencies'] = dependencies
+
+    timeline = TraceBuffer.from_settings(registry.settings)
+    if timeline is not None:
+        changes['timeline'] = timeline
+
+    trace_summary = registry.settings.get('ot.trace_summary', None)
+    if trace_summary is not None:
+        changes['trace_summary'] = int(trace_summary)
+
+    cardinality = CardinalityLimiter.from_settings(registry.settings)
+    if cardinality is not None:
+        changes['cardinality'] = cardinality
+
+    response_headers = ResponseHeaders.from_settings(registry.settings)
+    if response_headers is not None:
+        changes['response_headers'] = response_headers
+
+    clock = registry.settings.get('ot.clock', None)
+    if clock is not None:
+        if not isinstance(clock, Clock):
+            if not callable(clock):
+                clock = _get_callable_from_name(clock)
+            clock = clock()
+        changes['clock'] = clock
+
+    phases = parse_mode(registry.settings.get('ot.phases', None))
+    if phases is not None:
+        changes['phases'] = phases
+
+    recorder = EnvelopeRecorder.from_settings(registry.settings)
+    if recorder is not None:
+        changes['recorder'] = recorder
+
+    finisher = finisher_from_settings(registry.settings)
+    if finisher is not None:
+        changes['finisher'] = finisher
+
+    baggage = BaggagePolicy.from_settings(registry.settings)
+    if baggage is not None:
+        changes['baggage'] = baggage
+
+    tracing.configure(**changes)
+    pressure = tracing._pressure_monitor
+
     registry.settings['ot.tracing'] = tracing
 
+    def trace_request(req, level=LEVEL_FULL):
+        tracing._apply_tracing(req, traced_attrs, level)
+        try:
+            res = handler(req)
+        except Exception as e:
+            tracing._finish_tracing(req, error=e)
+            raise
+
+        tracing._finish_tracing(req, response=res)
+        return res
+
     def opentracing_tween(req):
         # if tracing for all requests is disabled, continue with the
         # normal handlers flow and return immediately.
         if not tracing._trace_all:
             return handler(req)
 
-        tracing._apply_tracing(req, traced_attrs)
+        if pressure is None:
+            return trace_request(req)
+
+        # step tracing down (or off) when the worker is overloaded.
+        level = pressure.request_started(req)
+        start = _perf_counter()
         try:
-            res = handler(req)
-        except Exception as e:
-            tracing._finish_tracing(req, error=e)
-            raise
+            if level == LEVEL_OFF:
+                return handler(req)
 
-        tracing._finish_tracing(req)
-        return res
+            return trace_request(req, level)
+        finally:
+            pressure.request_finished(_perf_counter() - start)
 
     return opentracing_tween
 
@@ -99,3 +228,5 @@ def includeme(config):
     """
     config.add_tween('pyramid_opentracing.opentracing_tween_factory',
                      under=INGRESS)
+    add_subscribers(config)
+    add_views(config)
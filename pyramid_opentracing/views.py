@@ -0,0 +1,174 @@
+import time
+
+try:
+    from html import escape
+except ImportError:  # Python 2.
+    from cgi import escape
+
+from pyramid.httpexceptions import HTTPNotFound
+from pyramid.response import Response
+
+from .exemplars import CONTENT_TYPE
+from .analysis import summarize
+
+
+def _get_tracing(request):
+    return request.registry.settings.get('ot.tracing', None)
+
+
+def exemplars_view(request):
+    """
+    Exports the per-route latency histograms, along with their
+    exemplars, in the OpenMetrics text format.
+    """
+    tracing = _get_tracing(request)
+    if tracing is None or tracing.exemplars is None:
+        raise HTTPNotFound('Exemplars are not enabled')
+
+    return Response(body=tracing.exemplars.export().encode('utf-8'),
+                    headerlist=[('Content-Type', CONTENT_TYPE)])
+
+
+def dependencies_view(request):
+    """
+    Exports the service dependency graph as JSON.
+    """
+    tracing = _get_tracing(request)
+    if tracing is None or tracing.dependencies is None:
+        raise HTTPNotFound('Dependencies are not enabled')
+
+    return Response(json_body=tracing.dependencies.export())
+
+
+_PAGE = u"""<!DOCTYPE html>
+<html><head><meta charset="utf-8"><title>%(title)s</title><style>
+body { font: 13px sans-serif; margin: 1em; }
+table { border-collapse: collapse; width: 100%%; }
+td, th { padding: 2px 6px; text-align: left; white-space: nowrap; }
+tr:nth-child(even) { background: #f4f4f4; }
+.error { color: #c00; }
+.lane { position: relative; width: 60%%; min-width: 300px; }
+.bar { position: absolute; top: 3px; height: 12px; min-width: 1px;
+       background: #6a9fd8; }
+.critical .bar { background: #e08a2c; }
+</style></head><body>%(body)s</body></html>"""
+
+
+def _ms(seconds):
+    return '%.2f ms' % (seconds * 1e3)
+
+
+def _render_traces(request, traces):
+    rows = []
+    for trace in traces:
+        rows.append(
+            u'<tr%s><td>%s</td><td><a href="%s">%s</a></td><td>%s</td>'
+            u'<td>%d</td><td>%s</td></tr>' % (
+                ' class="error"' if trace.error else '',
+                time.strftime('%H:%M:%S', time.localtime(trace.timestamp)),
+                escape(request.path_url + '?trace_id=' +
+                       (trace.trace_id or ''), True),
+                escape(trace.operation_name),
+                _ms(trace.duration),
+                len(trace.spans),
+                escape(trace.trace_id or '-')))
+
+    return (u'<h1>Last traces</h1><table><tr><th>Time</th><th>Route</th>'
+            u'<th>Duration</th><th>Spans</th><th>Trace id</th></tr>%s'
+            u'</table>' % ''.join(rows))
+
+
+def _render_trace(trace):
+    spans = trace.spans
+    root_start = spans[0].start
+    total = trace.duration or 1e-9
+
+    path = trace.critical_path()
+    critical = set(record.index for record, _ in path)
+
+    depths = [0] * len(spans)
+    rows = []
+    for record in spans:
+        if record.parent is not None:
+            depths[record.index] = depths[record.parent.index] + 1
+
+        duration = record.duration or 0.0
+        left = (record.start - root_start) / total * 100
+        width = duration / total * 100
+        tags = u', '.join(u'%s=%s' % (k, v)
+                          for k, v in sorted((record.tags or {}).items()))
+        rows.append(
+            u'<tr class="%s"><td style="padding-left: %dpx" title="%s">%s'
+            u'</td><td>%s</td><td class="lane"><div class="bar" '
+            u'style="left: %.2f%%; width: %.2f%%"></div></td></tr>' % (
+                'critical' if record.index in critical else '',
+                6 + 16 * depths[record.index],
+                escape(tags, True),
+                escape(record.operation_name or ''),
+                _ms(duration), left, width))
+
+    summary = u''.join(
+        u'<tr><td>%s</td><td>%s</td><td>%.1f%%</td></tr>' % (
+            escape(name or ''), _ms(seconds), seconds / total * 100)
+        for name, seconds in summarize(path))
+
+    return (u'<h1>%s %s</h1><p>Trace %s, %s%s.</p>'
+            u'<table><tr><th>Span</th><th>Duration</th><th>Waterfall</th>'
+            u'</tr>%s</table><h2>Critical path</h2><table><tr><th>Span</th>'
+            u'<th>Time</th><th>Share</th></tr>%s</table>' % (
+                escape(trace.operation_name),
+                _ms(trace.duration),
+                escape(trace.trace_id or '-'),
+                time.strftime('%Y-%m-%d %H:%M:%S',
+                              time.localtime(trace.timestamp)),
+                u', failed' if trace.error else u'',
+                ''.join(rows), summary))
+
+
+def timeline_view(request):
+    """
+    Renders the last traces kept in the timeline, or the waterfall and
+    critical path of the one given as the trace_id parameter.
+    """
+    tracing = _get_tracing(request)
+    if tracing is None or tracing.timeline is None:
+        raise HTTPNotFound('The timeline is not enabled')
+
+    trace_id = request.params.get('trace_id')
+    if trace_id:
+        trace = tracing.timeline.get(trace_id)
+        if trace is None:
+            raise HTTPNotFound('Unknown trace')
+
+        title = u'Trace %s' % trace_id
+        body = _render_trace(trace)
+    else:
+        title = u'Traces'
+        body = _render_traces(request, tracing.timeline.traces())
+
+    page = _PAGE % {'title': escape(title), 'body': body}
+    return Response(body=page.encode('utf-8'),
+                    content_type='text/html', charset='utf-8')
+
+
+def add_views(config):
+    """
+    Registers the views for which a path was set:
+    'ot.exemplars_path', 'ot.dependencies_path', 'ot.timeline_path'
+    """
+    settings = config.get_settings()
+
+    path = settings.get('ot.exemplars_path', None)
+    if path:
+        config.add_route('ot.exemplars', path)
+        config.add_view(exemplars_view, route_name='ot.exemplars')
+
+    path = settings.get('ot.dependencies_path', None)
+    if path:
+        config.add_route('ot.dependencies', path)
+        config.add_view(dependencies_view, route_name='ot.dependencies')
+
+    path = settings.get('ot.timeline_path', None)
+    if path:
+        config.add_route('ot.timeline', path)
+        config.add_view(timeline_view, route_name='ot.timeline')